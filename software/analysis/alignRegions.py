@@ -0,0 +1,126 @@
+import numpy as np
+
+# Reason codes of the region boundaries, bit flags (a checkpoint can have several)
+BOUNDARY = 1    # first or last pose
+LOST = 2        # start or end of a lost tracking region (zero speed)
+RELOCALIZATION = 4  # speed jump: map merge or relocalization
+RESCALE = 8     # auxiliary checkpoint against scale drift
+
+
+def true_runs(mask):
+    """[start, end] index pairs (inclusive) of the runs of True in a boolean array"""
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return np.column_stack((starts, ends))
+
+
+def find_align_regions(traj_est, speed_threshold=3, rescale_threshold=5000000):
+    """Split a trajectory into regions to align separately.
+
+    Checkpoints are the first and last pose, the ends of lost tracking
+    regions (at least three consecutive zero speeds, the last such run is
+    not counted), speed jumps above speed_threshold and, with a
+    rescale_threshold, auxiliary checkpoints so no region is longer than
+    rescale_threshold poses. Consecutive checkpoints one pose apart are
+    merged as before: the region keeps its start, unless the start ends a
+    lost region and the next checkpoint is a speed jump.
+
+    Args:
+        traj_est (PoseTrajectory3D): estimated trajectory
+        speed_threshold (float): speed jump threshold in m/s
+        rescale_threshold (int): max region length in poses, None for no
+                                 auxiliary checkpoints
+    Returns:
+        align_regions_dict (dict):
+            "align_regions": [[start, end], ...] pose index regions
+            "lost_regions": [[start, end], ...] lost tracking regions
+            "shift_checkpoints": np.ndarray of speed jump indices
+            "aux_checkpoints": [...] auxiliary checkpoints
+            "regions": mx2 int64 array of the align regions
+            "start_reasons", "end_reasons": m uint8 reason flags of the
+                                            region boundaries
+    """
+    speeds = traj_est.speeds
+    num_poses = traj_est.num_poses
+
+    # 1. Lost tracking: runs of zero speed
+    runs = true_runs(speeds == 0.0)
+    lost = runs[:-1][runs[:-1, 1] - runs[:-1, 0] > 1] if len(runs) > 0 else runs
+    # 2. Map merge / relocalization moments
+    shift_checkpoints = np.flatnonzero(speeds > speed_threshold)
+    # 3. Checkpoints with their reasons
+    candidates = np.concatenate(([0, num_poses - 1], lost.ravel(), shift_checkpoints)).astype(np.int64)
+    flags = np.concatenate(([BOUNDARY, BOUNDARY], np.full(lost.size, LOST),
+                            np.full(len(shift_checkpoints), RELOCALIZATION))).astype(np.uint8)
+    checkpoints, reasons = merge_checkpoints(candidates, flags)
+    # 4. Auxiliary checkpoints every rescale_threshold poses in long gaps
+    aux_checkpoints = np.array([], dtype=np.int64)
+    if rescale_threshold is not None and len(checkpoints) > 1:
+        gaps = np.diff(checkpoints)
+        counts = np.maximum((gaps - 1) // rescale_threshold, 0)
+        if counts.sum() > 0:
+            first = np.repeat(checkpoints[:-1], counts)
+            steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+            aux_checkpoints = first + steps * rescale_threshold
+            checkpoints, reasons = merge_checkpoints(
+                np.concatenate((checkpoints, aux_checkpoints)),
+                np.concatenate((reasons, np.full(len(aux_checkpoints), RESCALE, dtype=np.uint8))))
+    # 5. Regions between the checkpoints
+    starts, ends = region_indices(checkpoints, reasons)
+    regions = np.column_stack((checkpoints[starts], checkpoints[ends])).reshape(-1, 2)
+
+    align_regions_dict = {}
+    align_regions_dict['align_regions'] = regions.tolist()
+    align_regions_dict['lost_regions'] = lost.tolist()
+    align_regions_dict['shift_checkpoints'] = shift_checkpoints
+    if rescale_threshold is not None:
+        align_regions_dict['aux_checkpoints'] = aux_checkpoints.tolist()
+    align_regions_dict['regions'] = regions
+    align_regions_dict['start_reasons'] = reasons[starts]
+    align_regions_dict['end_reasons'] = reasons[ends]
+    return align_regions_dict
+
+
+def merge_checkpoints(candidates, flags):
+    # Sorted unique checkpoints with the union of their reason flags
+    checkpoints, inverse = np.unique(candidates, return_inverse=True)
+    reasons = np.zeros(len(checkpoints), dtype=np.uint8)
+    np.bitwise_or.at(reasons, inverse, flags)
+    return checkpoints, reasons
+
+
+def region_indices(checkpoints, reasons):
+    """Checkpoint indices of the region starts and ends.
+
+    From a region start i the next region ends at checkpoint i + 1 if it is
+    more than one pose away. A checkpoint one pose away is skipped, the
+    region then ends at i + 2, unless i ends a lost region and i + 1 is a
+    speed jump: then i + 1 becomes the start. Checkpoint j is a start iff
+    j - 1 is not a start that skips j, so along a run of skipping
+    checkpoints the starts alternate, which run-length encoding gives
+    without a loop.
+    """
+    k = len(checkpoints)
+    if k < 2:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    adjacent = np.diff(checkpoints) <= 1
+    swap = adjacent & ((reasons[:-1] & LOST) > 0) & ((reasons[1:] & RELOCALIZATION) > 0)
+    skip = adjacent & ~swap
+
+    # is_start[j] for j >= 1: True after a non-skipping checkpoint, else
+    # alternating from the start of the skip run
+    is_start = np.ones(k, dtype=bool)
+    runs = true_runs(skip)
+    if len(runs) > 0:
+        lengths = runs[:, 1] - runs[:, 0] + 1
+        run_starts = np.repeat(runs[:, 0], lengths)
+        positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + run_starts
+        # j = position + 1 follows a skipping checkpoint of the run
+        is_start[positions + 1] = (positions + 1 - run_starts) % 2 == 0
+
+    starts = np.flatnonzero(is_start[:-1])
+    steps = np.where(skip[starts], 2, 1)
+    ends = starts + steps
+    keep = (ends < k) & ~swap[starts]
+    return starts[keep], ends[keep]
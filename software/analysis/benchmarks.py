@@ -1,14 +1,14 @@
 import os
-import numpy as np
 import pandas as pd
 import copy
 import tools
+import extrinsics
+import datasetStore
+import slamLog
 from collections import Counter
 
-from evo.tools import file_interface
-
 class XREVA:
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, calibration_file=None):
         self.root_dir = root_dir
         self.benchmark = "XREVA"
         self.scriptTemplate = "{}/Examples/Stereo-Inertial/stereo_inertial_customized {}/Vocabulary/ORBvoc.txt {}/Examples/Stereo-Inertial/stereo_inertial_customized.yaml {}/Datasets/{}/{}/ {}/Datasets/{}/{}/sensor/timestamp.txt"
@@ -38,20 +38,34 @@ class XREVA:
 
         self.trails = ["data0"]
 
-        # Get this matrix from the extrinsics calibration for Intel RealSense
-        self.localTransformMatrix = np.array(
-            [[ 1.   ,  0.   ,  0.   , -0.064],
-            [ 0.   ,  1.   ,  0.   ,  0.044],
-            [ 0.   ,  0.   ,  1.   ,  0.056],
-            [ 0.   ,  0.   ,  0.   ,  1.   ]])
+        # Get this matrix from the extrinsics calibration for Intel RealSense,
+        # calibration/extrinsics.json unless another calibration file is given
+        self.localTransform = extrinsics.get_registry(calibration_file).get("ORBSLAM3")
+        self.localTransformMatrix = self.localTransform.matrix
         
         self.scriptList = []
 
         self.traj_gt = None
         self.traj_est = None
-
-
-    def find_todo_trajectories(self):
+        # In-memory result of the last process_raw_SLAM_data
+        self.slam_data = None
+
+
+    def is_cached_trial(self, trial_dir, cache, params):
+        # The trial inputs are unchanged if the cache holds their aligned trajectories
+        ref_file = os.path.join(trial_dir, "gt", "gt_ORB.csv")
+        est_file = os.path.join(trial_dir, "xr", "ORB_traj.csv")
+        if not (os.path.exists(ref_file) and os.path.exists(est_file)):
+            return False
+        return cache.contains(cache.make_key([ref_file, est_file], params))
+
+    def find_todo_trajectories(self, cache=None, params=None):
+        # With a resultCache.ResultCache, trials whose inputs changed since the
+        # last evaluation are also todo. params: PoseErrorEvaluator.alignment_params()
+        # of the evaluation, default that of a default PoseErrorEvaluator
+        if cache is not None and params is None:
+            from poseEvaluation import PoseErrorEvaluator
+            params = PoseErrorEvaluator(self.root_dir).alignment_params()
         todo_trajectories = []
         # Walk through the dataset directory
         for root, dirs, files in os.walk(self.root_dir):
@@ -60,6 +74,8 @@ class XREVA:
                 # Check if 'orb_combined.csv' is missing
                 if 'orb_combined.csv' not in files:
                     todo_trajectories.append(os.path.dirname(root).split('/')[-1])
+                elif cache is not None and not self.is_cached_trial(root, cache, params):
+                    todo_trajectories.append(os.path.dirname(root).split('/')[-1])
         
         if len(todo_trajectories) == 0:
             print("All trials have been processed.")
@@ -68,7 +84,7 @@ class XREVA:
             counter = Counter(todo_trajectories)
             all_missing_trajs = []
             # Print the counts of each unique trajectory
-            print("The following trial folders are missing 'orb_combined.csv':")
+            print("The following trial folders are missing 'orb_combined.csv' or changed:")
             for path, count in counter.items():
                 print(f"{path}: {count} times")
                 if count > 1:
@@ -119,66 +135,48 @@ class XREVA:
         # The ORBSLAM3 share the groundtruth with the AppleVisionPro
         gt_csv_path = self.find_csv_with_prefix(gt_csv_folder_path, "AppleVisionPro")
         
-        self.traj_gt = file_interface.read_tum_trajectory_file(gt_csv_path)
+        self.traj_gt = datasetStore.read_tum_trajectory(gt_csv_path)
         # perform the local transformation
-        self.traj_gt.transform(t=self.localTransformMatrix, right_mul=True, propagate=False)
+        self.traj_gt = self.localTransform.transform_trajectory(self.traj_gt)
         # Save the transformed trajectory under the gt csv folder
-        file_interface.write_tum_trajectory_file(
-            file_path=gt_csv_folder_path + "gt_ORB.csv",
-            traj=self.traj_gt
-        )
+        datasetStore.write_tum_trajectory(gt_csv_folder_path + "gt_ORB.csv", self.traj_gt)
 
     # Step 3: Copy the raw SLAM data    
-    def process_raw_SLAM_data(self, benchmark,trajectory,trial):
-        # Step 1: Read, adjust, and save the CSV log file
-        raw_data_path = "{}/logs/log.csv".format(self.root_dir)
-        # load the raw data from the raw data path into dataframe
-        df_raw = pd.read_csv(raw_data_path,index_col=False)
-        orb_last_timestamp = df_raw["TimeStamp"].iloc[-1]
-        offset = self.traj_gt.timestamps[-1] - orb_last_timestamp
-        # Adjust the timestamps
-        df_raw["TimeStamp"] += offset
-        #Drop the rows of initialization
-        target = 2
-        df_raw = df_raw[df_raw['TrackMode'] == 2].reset_index(drop=True)
-
-
-        gt_first_timestamp = self.traj_gt.timestamps[0]
-        # Drop rows with timestamps less than the first timestamp of the ground truth
-        df_raw = df_raw[df_raw["TimeStamp"] >= gt_first_timestamp]
-
-        # Save the adjusted dataframe to a new CSV file
+    def process_raw_SLAM_data(self, benchmark,trajectory,trial, log_file=None, output_dir=None, columns=None):
+        # log_file: log of an isolated run (slamRunner), default the shared {root}/logs/log.csv
+        # output_dir: folder of ORB_log.csv and ORB_traj.csv, default the xr folder of the trial
+        # columns: feature columns kept in ORB_log.csv, default all
+        raw_data_path = log_file if log_file is not None else "{}/logs/log.csv".format(self.root_dir)
         destination_folder_path = "{}/Datasets/{}/{}/xr/".format(self.root_dir, trajectory, trial)
-        new_filename = "ORB_log.csv"
-        df_raw.to_csv(destination_folder_path + new_filename, index=False)
-
-        # Step 3: Select traj columns
-        df_traj = copy.deepcopy(df_raw)
-        selected_columns = ["TimeStamp","PX","PY","PZ","QX","QY","QZ","QW"]  # Replace with your desired column names
-        df_traj = df_traj[selected_columns]
-
-        # Step 4: Save the traj
-        new_filename = "ORB_traj.csv"
-        df_traj.to_csv(destination_folder_path+new_filename, sep=' ', index=False, header=False)  
-        # You can change the separator as needed
-        return df_raw, df_traj#, initial_rows
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            destination_folder_path = output_dir
+        # One streaming pass: offset to the ground truth end, tracked rows
+        # after the ground truth start, ORB_log.csv and ORB_traj.csv
+        df_raw, self.traj_est = slamLog.process_slam_log(raw_data_path, destination_folder_path,
+                                                         self.traj_gt.timestamps[0], self.traj_gt.timestamps[-1],
+                                                         columns=columns)
+        df_traj = df_raw[slamLog.POSE_COLUMNS]
+        # Kept for load_raw_SLAM_data and the evaluator, no need to read the files again
+        self.slam_data = {"trajectory": trajectory, "trial": trial, "output_dir": output_dir,
+                          "df_raw": df_raw, "df_traj": df_traj}
+        return df_raw, df_traj
 
     def load_raw_SLAM_data(self, benchmark, trajectory, trial):
-        # Load the ORB_log.csv file and the ORB_traj.csv file and return dataframes
+        # Load the ORB_log.csv file and the ORB_traj.csv file and return dataframes,
+        # the ones of the last process_raw_SLAM_data of the same trial without reading
+        slam_data = self.slam_data
+        if slam_data is not None and (slam_data["trajectory"], slam_data["trial"], slam_data["output_dir"]) == \
+                (trajectory, trial, None):
+            return slam_data["df_raw"], slam_data["df_traj"]
         raw_data_path = "{}/Datasets/{}/{}/xr/ORB_log.csv"
         raw_data_path = raw_data_path.format(self.root_dir, trajectory, trial)
-        #print("Debug: raw_data_path:", raw_data_path)
         # Load the raw data from the raw data path into dataframe
-        df_raw = pd.read_csv(raw_data_path,index_col=False)
-        #print("Debug: df_raw:", df_raw)
-        #raw_data_path = "{}/Datasets/{}/{}/xr/ORB_traj.csv"
+        df_raw = datasetStore.read_csv(raw_data_path)
         traj_data_path = "{}/Datasets/{}/{}/xr/ORB_traj.csv"
         traj_data_path = traj_data_path.format(self.root_dir, trajectory, trial)
-        #print("Debug: traj_data_path:", traj_data_path)
-        # Load the raw data from the raw data path into dataframe
-        df_traj = pd.read_csv(traj_data_path,index_col=False, sep=' ')
-        #print("Debug: df_traj:", df_traj)
-        # Return
+        # ORB_traj.csv has no header
+        df_traj = pd.read_csv(traj_data_path, index_col=False, sep=' ', header=None, names=slamLog.POSE_COLUMNS)
         return df_raw, df_traj
 
 
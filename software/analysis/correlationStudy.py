@@ -0,0 +1,386 @@
+import os
+import glob
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+import datasetStore
+from mergeStreams import ORB_STREAM, LABEL_COLUMNS
+from resultCache import ResultCache
+
+# Statistics of every (feature, error column) pair of a trial
+#   n             rows where both have a value
+#   pearson       Pearson correlation
+#   spearman      Spearman rank correlation
+#   mutual_info   mutual information in bits of the equal-frequency binned values,
+#                 about n^(1/3) bins, Miller-Madow bias corrected (values
+#                 around 0, also slightly negative, mean no dependence)
+#   best_lag      lag in rows with the largest |cross-correlation|, positive
+#                 when the feature leads the error
+#   best_lag_s    the same lag in seconds (median TimeStamp step)
+#   lag_corr      cross-correlation at best_lag
+STATS = ["n", "pearson", "spearman", "mutual_info", "best_lag", "best_lag_s", "lag_corr"]
+# Datasets/<set>_<motion>_<environment>_<pace>
+GROUP_COLUMNS = ["set", "motion", "environment", "pace"]
+MOTION_ALIASES = {"Petrol": "Patrol", "Rotation": "Rotate", "Side": "Shift"}
+# Signed sensor columns correlated by magnitude, as in the notebook
+ABS_COLUMNS = ["ACCx", "ACCy", "ACCz", "AngVelx", "AngVely", "AngVelz"]
+TABLE_FILE = "merge_result_filled.csv"
+
+
+def parse_trajectory(trajectory):
+    # "S1_Petrol_Featurerich_50" -> set, motion, environment and pace
+    parts = trajectory.split("_")
+    parts += [""] * (4 - len(parts))
+    return {"set": parts[0], "motion": MOTION_ALIASES.get(parts[1], parts[1]),
+            "environment": parts[2], "pace": parts[3]}
+
+
+def find_trials(root_dir, trajectories=None, table_file=TABLE_FILE):
+    # (trajectory, trial, table path) of every trial holding the merged table
+    trajectories = trajectories or sorted(os.listdir("{}/Datasets".format(root_dir)))
+    trials = []
+    for trajectory in trajectories:
+        for table_path in sorted(glob.glob("{}/Datasets/{}/*/{}".format(root_dir, trajectory, table_file))):
+            trials.append((trajectory, os.path.basename(os.path.dirname(table_path)), table_path))
+    return trials
+
+
+def error_columns(columns):
+    # Error column -> (device, error): RPE -> (ORBSLAM, RPE), AppleVisionPro_APE -> (AppleVisionPro, APE)
+    errors = {}
+    for col in columns:
+        if col in LABEL_COLUMNS:
+            errors[col] = (ORB_STREAM, col)
+        elif "_" in col and col.rsplit("_", 1)[1] in LABEL_COLUMNS:
+            errors[col] = tuple(col.rsplit("_", 1))
+    return errors
+
+
+def feature_columns(df, errors):
+    return [col for col in df.columns if col != "TimeStamp" and col not in errors
+            and pd.api.types.is_numeric_dtype(df[col])]
+
+
+def smooth(values, window):
+    """Trailing mean over window rows of every column, edge padded.
+
+    Same values as the sliding_window_smoothing of the notebook (a window
+    holding a NaN is NaN), from one strided view instead of rolling().
+    """
+    if window <= 1 or len(values) == 0:
+        return values
+    padded = np.concatenate((np.repeat(values[:1], window - 1, axis=0), values))
+    return sliding_window_view(padded, window, axis=0).mean(axis=-1)
+
+
+def pearson(X, y):
+    """Pearson correlation of every column of X with y on the rows where both have a value.
+
+    Returns:
+        corr (np.ndarray): one value per column, NaN below 3 rows or without variance
+        n (np.ndarray): rows used per column
+    """
+    valid = ~np.isnan(X) & ~np.isnan(y)[:, None]
+    n = valid.sum(axis=0).astype(np.float64)
+    x = np.where(valid, X, 0.0)
+    yv = np.where(valid, y[:, None], 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x, mean_y = x.sum(axis=0) / n, yv.sum(axis=0) / n
+        # Centered before the products against cancellation
+        dx = np.where(valid, x - mean_x, 0.0)
+        dy = np.where(valid, yv - mean_y, 0.0)
+        corr = (dx * dy).sum(axis=0) / np.sqrt((dx * dx).sum(axis=0) * (dy * dy).sum(axis=0))
+    corr[n < 3] = np.nan
+    return corr, n
+
+
+def average_ranks(sorted_values):
+    # 1-based ranks of sorted values, ties get their mean rank
+    n = len(sorted_values)
+    starts = np.flatnonzero(np.concatenate(([True], sorted_values[1:] != sorted_values[:-1])))
+    ends = np.append(starts[1:], n)
+    return np.repeat((starts + ends + 1) / 2.0, ends - starts)
+
+
+def subset_ranks(values, order, valid):
+    # Ranks of values[valid] among themselves, from the argsort order of all values
+    kept = order[valid[order]]
+    ranks = np.empty(len(values))
+    ranks[kept] = average_ranks(values[kept])
+    return ranks[valid]
+
+
+def rank_pairs(X, y, x_order=None, y_order=None):
+    """Ranks of every column of X and of y on the rows where both have a value.
+
+    The columns are sorted once (x_order, y_order: argsort along the rows,
+    shared by all errors and statistics), the ranks of a row subset come
+    from the sorted order in linear time.
+
+    Yields:
+        x_ranks, y_ranks (np.ndarray): per column of X
+    """
+    x_order = np.argsort(X, axis=0, kind="stable") if x_order is None else x_order
+    y_order = np.argsort(y, kind="stable") if y_order is None else y_order
+    y_valid = ~np.isnan(y)
+    for idx in range(X.shape[1]):
+        valid = y_valid & ~np.isnan(X[:, idx])
+        yield subset_ranks(X[:, idx], x_order[:, idx], valid), subset_ranks(y, y_order, valid)
+
+
+def mutual_info_bins(n):
+    # Equal-frequency bins per axis for n rows, ~n^(1/3) keeps the cells populated
+    return max(2, int(round(n ** (1.0 / 3.0))))
+
+
+def binned_mutual_info(x_bins, y_bins, bins):
+    """Mutual information in bits of two binned samples, Miller-Madow corrected.
+
+    Every plug-in entropy is biased low by (occupied cells - 1) / 2n nats,
+    I = H(x) + H(y) - H(x, y) is corrected by the sum of the three terms.
+    """
+    n = len(x_bins)
+    p = np.bincount(y_bins * bins + x_bins, minlength=bins * bins).reshape(bins, bins) / float(n)
+    p_y, p_x = p.sum(axis=1), p.sum(axis=0)
+    outer = p_y[:, None] * p_x[None, :]
+    nonzero = p > 0
+    plug_in = np.sum(p[nonzero] * np.log2(p[nonzero] / outer[nonzero]))
+    cells = np.count_nonzero(p_x) + np.count_nonzero(p_y) - np.count_nonzero(nonzero) - 1
+    return plug_in + cells / (2.0 * n * np.log(2))
+
+
+def rank_statistics(X, y, bins=None, x_order=None, y_order=None):
+    """Spearman correlation and mutual information of every column of X with y.
+
+    The mutual information in bits is that of the ranks binned into
+    equal-frequency bins (ties share a bin), see binned_mutual_info. Both
+    use the ranks of the rows where the column and y have a value.
+
+    Args:
+        bins (int): bins per axis, default mutual_info_bins of the row count
+    Returns:
+        spearman (np.ndarray), mutual_info (np.ndarray): one value per column
+    """
+    spearman = np.full(X.shape[1], np.nan)
+    mutual_info = np.full(X.shape[1], np.nan)
+    for idx, (x_ranks, y_ranks) in enumerate(rank_pairs(X, y, x_order, y_order)):
+        n = len(x_ranks)
+        if n < 3:
+            continue
+        spearman[idx] = pearson(x_ranks[:, None], y_ranks)[0][0]
+        n_bins = bins or mutual_info_bins(n)
+        x_bins = np.minimum(((x_ranks - 1) * n_bins / n).astype(np.int64), n_bins - 1)
+        y_bins = np.minimum(((y_ranks - 1) * n_bins / n).astype(np.int64), n_bins - 1)
+        mutual_info[idx] = binned_mutual_info(x_bins, y_bins, n_bins)
+    return spearman, mutual_info
+
+
+def standardize(values):
+    # z-scores over the values of every column, 0 and mask 0 for NaN
+    valid = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = (values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0)
+    return np.where(valid, np.nan_to_num(z), 0.0), valid.astype(np.float64)
+
+
+def lagged_correlation(X, Y, max_lag):
+    """Cross-correlation of every column of X with every column of Y for lags -max_lag..max_lag rows.
+
+    Lag L pairs X[t] with Y[t + L]. The columns are standardized once over
+    their values and NaN rows count as missing in every lag. All lags come
+    from one FFT cross-correlation per column; the spectra of X are shared
+    by the columns of Y.
+
+    Returns:
+        lags (np.ndarray): 2 * max_lag + 1 lags
+        corr (np.ndarray): len(lags) x X columns x Y columns
+    """
+    n = len(X)
+    lags = np.arange(-max_lag, max_lag + 1)
+    corr = np.full((len(lags), X.shape[1], Y.shape[1]), np.nan)
+    if n == 0:
+        return lags, corr
+    n_fft = 1 << int(np.ceil(np.log2(n + max_lag)))
+    zx, mx = standardize(X)
+    zx, mx = np.fft.rfft(zx, n_fft, axis=0).conj(), np.fft.rfft(mx, n_fft, axis=0).conj()
+    rows = lags % n_fft
+    # Lags beyond the table hold no pairs
+    rows[np.abs(lags) >= n] = rows[lags == 0][0]
+    for idx in range(Y.shape[1]):
+        zy, my = standardize(Y[:, idx:idx + 1])
+        products = np.fft.irfft(zx * np.fft.rfft(zy, n_fft, axis=0), n_fft, axis=0)[rows]
+        count = np.rint(np.fft.irfft(mx * np.fft.rfft(my, n_fft, axis=0), n_fft, axis=0)[rows])
+        count[np.abs(lags) >= n] = 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corr[:, :, idx] = np.where(count >= 3, products / count, np.nan)
+    return lags, corr
+
+
+def correlate_table(df, features, errors, smooth_window=5, bins=None, max_lag=30):
+    """All STATS of the features against the error columns of one merged table.
+
+    Returns:
+        stats (dict): stat name -> len(features) x len(errors) array
+    """
+    X = df[features].to_numpy(dtype=np.float64, na_value=np.nan)
+    abs_ids = [idx for idx, col in enumerate(features) if col in ABS_COLUMNS]
+    X[:, abs_ids] = np.abs(X[:, abs_ids])
+    X = smooth(X, smooth_window)
+    timestamps = df["TimeStamp"].to_numpy(dtype=np.float64) if "TimeStamp" in df else np.arange(len(df), dtype=float)
+    step = np.median(np.diff(timestamps)) if len(timestamps) > 1 else np.nan
+
+    Y = df[errors].to_numpy(dtype=np.float64, na_value=np.nan)
+    stats = {name: np.full((len(features), len(errors)), np.nan) for name in STATS}
+    x_order = np.argsort(X, axis=0, kind="stable")
+    for idx in range(len(errors)):
+        y = Y[:, idx]
+        stats["pearson"][:, idx], stats["n"][:, idx] = pearson(X, y)
+        stats["spearman"][:, idx], stats["mutual_info"][:, idx] = rank_statistics(
+            X, y, bins, x_order, np.argsort(y, kind="stable"))
+
+    lags, corr = lagged_correlation(X, Y, max_lag)
+    best = np.argmax(np.where(np.isnan(corr), -1.0, np.abs(corr)), axis=0)
+    searchable = ~np.all(np.isnan(corr), axis=0)
+    stats["best_lag"] = np.where(searchable, lags[best], np.nan)
+    stats["lag_corr"] = np.where(searchable, np.take_along_axis(corr, best[None], axis=0)[0], np.nan)
+    stats["best_lag_s"] = stats["best_lag"] * step
+    return stats
+
+
+def column_digest(values):
+    return hashlib.sha1(np.ascontiguousarray(values, dtype=np.float64).tobytes()).hexdigest()
+
+
+def trial_correlations(table_path, cache_dir=None, smooth_window=5, bins=None, max_lag=30):
+    """STATS of one merged table, reusing the cached results of unchanged features.
+
+    The cache entry of a table keeps a digest of every feature column and
+    of the error columns. On a rerun only new or changed features are
+    computed, so adding a feature to the tables costs one feature per trial.
+    Runs inside a worker process.
+
+    Returns:
+        features (list), errors (list), stats (dict) as in correlate_table
+    """
+    df = datasetStore.read_csv(table_path)
+    errors = list(error_columns(df.columns))
+    features = feature_columns(df, errors)
+    if cache_dir is None:
+        return features, errors, correlate_table(df, features, errors, smooth_window, bins, max_lag)
+
+    cache = ResultCache(cache_dir)
+    params = {"table": os.path.abspath(table_path), "smooth_window": smooth_window, "bins": bins,
+              "max_lag": max_lag, "mutual_info": "miller_madow", "kind": "correlation"}
+    key = cache.make_key([], params)
+    error_digest = column_digest(df[errors].to_numpy(dtype=np.float64, na_value=np.nan)) + str(errors)
+    digests = [column_digest(df[col].to_numpy(dtype=np.float64, na_value=np.nan)) for col in features]
+
+    cached = {}
+    entry = cache.load(key)
+    if entry is not None and str(entry["error_digest"]) == error_digest:
+        for idx, digest in enumerate(entry["digests"]):
+            cached[str(digest)] = {name: entry[name][idx] for name in STATS}
+    todo = [col for col, digest in zip(features, digests) if digest not in cached]
+    computed = correlate_table(df, todo, errors, smooth_window, bins, max_lag) if todo else None
+
+    stats = {name: np.full((len(features), len(errors)), np.nan) for name in STATS}
+    todo_ids = {col: idx for idx, col in enumerate(todo)}
+    for idx, (col, digest) in enumerate(zip(features, digests)):
+        for name in STATS:
+            stats[name][idx] = computed[name][todo_ids[col]] if col in todo_ids else cached[digest][name]
+    if todo or entry is None:
+        cache.save(key, dict(stats, digests=np.array(digests), error_digest=np.array(error_digest)),
+                   files=[table_path], params=params)
+    return features, errors, stats
+
+
+def correlation_study(root_dir, trajectories=None, workers=None, cache_dir=None, table_file=TABLE_FILE, **kwargs):
+    """Correlate the features with the device errors of all trials over a process pool.
+
+    Args:
+        root_dir (str): dataset root holding the Datasets folder
+        trajectories (list): only these trajectories, default all
+        workers (int): number of worker processes, default is the cpu count
+        cache_dir (str): optional resultCache folder
+        kwargs: forwarded to trial_correlations (smooth_window, bins, max_lag)
+    Returns:
+        results (pd.DataFrame): one row per trial, error column and feature
+                                with the GROUP_COLUMNS and STATS
+    """
+    trials = find_trials(root_dir, trajectories, table_file)
+    tables = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(trial_correlations, table_path, cache_dir, **kwargs): (trajectory, trial)
+                   for trajectory, trial, table_path in trials}
+        for done, future in enumerate(as_completed(futures)):
+            trajectory, trial = futures[future]
+            try:
+                features, errors, stats = future.result()
+            except Exception as e:
+                print("[{}/{}] {}-{} failed: {}: {}".format(done + 1, len(trials), trajectory, trial,
+                                                          type(e).__name__, e))
+                continue
+            print("[{}/{}] {}-{}: {} features x {} errors".format(done + 1, len(trials), trajectory, trial,
+                                                                len(features), len(errors)))
+            devices = error_columns(errors)
+            table = pd.DataFrame({
+                "trajectory": trajectory, "trial": trial,
+                "device": np.tile([devices[col][0] for col in errors], len(features)),
+                "error": np.tile([devices[col][1] for col in errors], len(features)),
+                "feature": np.repeat(features, len(errors)),
+            })
+            for name, value in parse_trajectory(trajectory).items():
+                table[name] = value
+            for name in STATS:
+                table[name] = stats[name].ravel()
+            tables.append(table)
+
+    columns = ["trajectory", "trial"] + GROUP_COLUMNS + ["device", "error", "feature"] + STATS
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(tables, ignore_index=True)[columns].sort_values(
+        ["trajectory", "trial", "device", "error", "feature"], ignore_index=True)
+
+
+def group_summary(results, by=("motion",), stats=("pearson", "spearman", "mutual_info", "lag_corr")):
+    """Mean, std and trial count of the stats per group, device, error and feature.
+
+    Args:
+        results (pd.DataFrame): output of correlation_study
+        by (list): grouping columns out of GROUP_COLUMNS, empty for all trials
+    """
+    keys = list(by) + ["device", "error", "feature"]
+    summary = results.groupby(keys)[list(stats)].agg(["mean", "std", "count"])
+    summary.columns = ["{}_{}".format(stat, agg) for stat, agg in summary.columns]
+    return summary.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlate the sensor features with the device errors of all trials")
+    parser.add_argument("--root", default="..", help="Dataset root holding the Datasets folder")
+    parser.add_argument("--trajectory", nargs="+", default=None, help="Only these trajectories")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--cache", default=None, help="Result cache folder, unchanged features are not recomputed")
+    parser.add_argument("--smooth", type=int, default=5, help="Trailing mean window of the features in rows")
+    parser.add_argument("--bins", type=int, default=None,
+                        help="Bins per axis of the mutual information, default about n^(1/3)")
+    parser.add_argument("--max-lag", type=int, default=30, help="Max. lag of the cross-correlation in rows")
+    parser.add_argument("--group-by", nargs="*", default=["motion"], choices=GROUP_COLUMNS,
+                        help="Grouping of the summary, none for all trials")
+    parser.add_argument("--output", default=None, help="Optional csv path for the per trial results")
+    parser.add_argument("--summary", default=None, help="Optional csv path for the grouped summary")
+    args = parser.parse_args()
+
+    results = correlation_study(args.root, args.trajectory, args.workers, args.cache,
+                                smooth_window=args.smooth, bins=args.bins, max_lag=args.max_lag)
+    summary = group_summary(results, args.group_by)
+    print(summary.to_string(index=False))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+    if args.summary is not None:
+        summary.to_csv(args.summary, index=False)
@@ -0,0 +1,261 @@
+import os
+import json
+import glob
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from evo.tools import file_interface
+from evo.core.trajectory import PoseTrajectory3D
+
+
+# Columnar copy of a dataset csv file, stored next to it:
+#   xr/ORB_traj.csv -> xr/ORB_traj.cols/
+#       meta.json                 kind, column names and dtypes, csv size/mtime
+#       c000.npy, c001.npy, ...   one typed array per column (trajectory:
+#                                 timestamps, positions_xyz, orientations_quat_wxyz)
+# Plain .npy files load memory-mapped, so reading a trial is an mmap instead
+# of parsing text. The csv stays the source of truth: a bundle older than
+# its csv is ignored and the csv is parsed as before.
+BUNDLE_SUFFIX = ".cols"
+TRAJECTORY_ARRAYS = ["timestamps", "positions_xyz", "orientations_quat_wxyz"]
+
+
+def bundle_path(file_path):
+    return os.path.splitext(file_path)[0] + BUNDLE_SUFFIX
+
+
+def source_stamp(file_path):
+    stat = os.stat(file_path)
+    return {"file": os.path.basename(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_meta(bundle):
+    try:
+        with open(os.path.join(bundle, "meta.json"), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def current_bundle(file_path, kind):
+    # Meta of an up to date bundle of the given kind, None otherwise
+    meta = read_meta(bundle_path(file_path))
+    if meta is None or meta["kind"] != kind:
+        return None
+    if os.path.exists(file_path):
+        stamp = source_stamp(file_path)
+        if (meta["source"]["size"], meta["source"]["mtime_ns"]) != (stamp["size"], stamp["mtime_ns"]):
+            return None
+    return meta
+
+
+def write_bundle(file_path, kind, arrays, extra_meta=None):
+    bundle = bundle_path(file_path)
+    tmp_bundle = "{}.{}.tmp".format(bundle, os.getpid())
+    shutil.rmtree(tmp_bundle, ignore_errors=True)
+    os.makedirs(tmp_bundle)
+    for idx, array in enumerate(arrays):
+        np.save(os.path.join(tmp_bundle, "c{:03d}.npy".format(idx)), np.ascontiguousarray(array),
+                allow_pickle=False)
+    meta = {"kind": kind, "source": source_stamp(file_path) if os.path.exists(file_path) else None}
+    meta.update(extra_meta or {})
+    with open(os.path.join(tmp_bundle, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(bundle, ignore_errors=True)
+    os.rename(tmp_bundle, bundle)
+    return bundle
+
+
+def load_arrays(bundle, count, mmap=True):
+    # Copy-on-write maps: callers may edit the arrays, the files stay untouched
+    mmap_mode = "c" if mmap else None
+    return [np.load(os.path.join(bundle, "c{:03d}.npy".format(idx)), mmap_mode=mmap_mode, allow_pickle=False)
+            for idx in range(count)]
+
+
+def write_trajectory_bundle(file_path, traj):
+    arrays = [traj.timestamps, traj.positions_xyz, traj.orientations_quat_wxyz]
+    return write_bundle(file_path, "trajectory", [np.asarray(a, dtype=np.float64) for a in arrays],
+                        {"columns": TRAJECTORY_ARRAYS, "num_poses": int(len(traj.timestamps))})
+
+
+def trajectory_from_arrays(timestamps, positions_xyz, orientations_quat_wxyz):
+    """PoseTrajectory3D on the given arrays, without the copies of its constructor."""
+    traj = PoseTrajectory3D.__new__(PoseTrajectory3D)
+    traj._positions_xyz = positions_xyz
+    traj._orientations_quat_wxyz = orientations_quat_wxyz
+    traj.timestamps = timestamps
+    traj.meta = {}
+    traj._projected = False
+    return traj
+
+
+def write_table_bundle(file_path, df):
+    arrays, dtypes = [], []
+    for name in df.columns:
+        column = df[name]
+        if is_numeric_dtype(column.dtype):
+            arrays.append(column.to_numpy())
+        else:
+            # Strings as fixed width unicode plus a null mask, no pickles
+            arrays.append(column.fillna("").astype(str).to_numpy(dtype=str))
+            arrays.append(column.isnull().to_numpy())
+        dtypes.append(str(column.dtype))
+    return write_bundle(file_path, "table", arrays,
+                        {"columns": [str(name) for name in df.columns], "dtypes": dtypes, "rows": int(len(df))})
+
+
+def is_numeric_dtype(dtype):
+    try:
+        return np.dtype(dtype).kind in "biufcmM"
+    except TypeError:
+        return False
+
+
+def read_table_bundle(file_path, meta, mmap=True):
+    numeric = [is_numeric_dtype(dtype) for dtype in meta["dtypes"]]
+    arrays = load_arrays(bundle_path(file_path), sum(1 if is_numeric else 2 for is_numeric in numeric), mmap)
+    columns = {}
+    idx = 0
+    for name, dtype, is_numeric in zip(meta["columns"], meta["dtypes"], numeric):
+        if is_numeric:
+            columns[name] = arrays[idx]
+            idx += 1
+        else:
+            values = pd.Series(arrays[idx], dtype=object)
+            values[arrays[idx + 1]] = np.nan
+            columns[name] = values.astype(dtype)
+            idx += 2
+    return pd.DataFrame(columns)
+
+
+def read_tum_trajectory(file_path, mmap=True):
+    """file_interface.read_tum_trajectory_file with the columnar bundle first.
+
+    Returns:
+        traj (PoseTrajectory3D): backed by the memory-mapped bundle arrays
+                                 when an up to date bundle exists
+    """
+    meta = current_bundle(file_path, "trajectory")
+    if meta is None:
+        return file_interface.read_tum_trajectory_file(file_path)
+    timestamps, positions_xyz, quats = load_arrays(bundle_path(file_path), 3, mmap)
+    return trajectory_from_arrays(timestamps, positions_xyz, quats)
+
+
+def read_csv(file_path, mmap=True):
+    # pd.read_csv(file_path) with the columnar bundle first
+    meta = current_bundle(file_path, "table")
+    if meta is None:
+        return pd.read_csv(file_path, index_col=False)
+    return read_table_bundle(file_path, meta, mmap)
+
+
+def write_csv(df, file_path, **kwargs):
+    # df.to_csv that keeps an existing table bundle of the file up to date,
+    # other bundles of the file become stale with the new csv
+    df.to_csv(file_path, **kwargs)
+    meta = read_meta(bundle_path(file_path))
+    if meta is not None and meta["kind"] == "table" and kwargs.get("sep", ",") == ",":
+        write_table_bundle(file_path, df.reset_index() if kwargs.get("index", True) else df)
+
+
+def write_tum_trajectory(file_path, traj):
+    file_interface.write_tum_trajectory_file(file_path=file_path, traj=traj)
+    if os.path.exists(bundle_path(file_path)):
+        write_trajectory_bundle(file_path, traj)
+
+
+def is_tum_file(file_path):
+    # TUM: 8 space separated numbers per row and no header
+    with open(file_path, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.split(" ")
+            if len(fields) != 8:
+                return False
+            try:
+                [float(field) for field in fields]
+            except ValueError:
+                return False
+            return True
+    return False
+
+
+def convert_file(file_path):
+    """Write the columnar bundle of one csv file, skipped if up to date.
+
+    Returns:
+        kind (str): "trajectory", "table" or None if already converted
+    """
+    if is_tum_file(file_path):
+        if current_bundle(file_path, "trajectory") is not None:
+            return None
+        write_trajectory_bundle(file_path, file_interface.read_tum_trajectory_file(file_path))
+        return "trajectory"
+    if current_bundle(file_path, "table") is not None:
+        return None
+    write_table_bundle(file_path, pd.read_csv(file_path, index_col=False))
+    return "table"
+
+
+def convert_trial(trial_dir):
+    """Convert the gt, xr and error/merge csv files of one trial folder.
+
+    The bundles are listed with their kind and length in columnar.json of
+    the trial folder.
+
+    Returns:
+        converted (dict): file path -> kind of the newly written bundles
+    """
+    converted = {}
+    file_paths = (glob.glob(os.path.join(trial_dir, "*.csv"))
+                  + glob.glob(os.path.join(trial_dir, "gt", "*.csv"))
+                  + glob.glob(os.path.join(trial_dir, "xr", "*.csv")))
+    for file_path in sorted(file_paths):
+        try:
+            kind = convert_file(file_path)
+        except Exception as e:
+            print("Failed to convert {}: {}".format(file_path, e))
+            continue
+        if kind is not None:
+            converted[file_path] = kind
+
+    # Per-trial metadata: every bundle with its kind and length
+    trial_meta = {}
+    for file_path in sorted(file_paths):
+        meta = read_meta(bundle_path(file_path))
+        if meta is not None:
+            trial_meta[os.path.relpath(file_path, trial_dir)] = {
+                "kind": meta["kind"], "columns": meta["columns"],
+                "length": meta.get("num_poses", meta.get("rows"))}
+    with open(os.path.join(trial_dir, "columnar.json"), "w") as f:
+        json.dump(trial_meta, f, indent=2)
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert dataset csv files to memory-mappable columnar bundles")
+    parser.add_argument("command", choices=["convert", "info"])
+    parser.add_argument("--root", default="..", help="Dataset root holding the Datasets folder")
+    parser.add_argument("--trajectory", nargs="+", default=None, help="Only these trajectories")
+    args = parser.parse_args()
+
+    trajectories = args.trajectory or sorted(os.listdir("{}/Datasets".format(args.root)))
+    for trajectory in trajectories:
+        for trial_dir in sorted(glob.glob("{}/Datasets/{}/*/".format(args.root, trajectory))):
+            if args.command == "convert":
+                converted = convert_trial(trial_dir)
+                print("{}: converted {} files".format(trial_dir, len(converted)))
+            else:
+                bundles = glob.glob(os.path.join(trial_dir, "**", "*" + BUNDLE_SUFFIX), recursive=True)
+                csv_files = glob.glob(os.path.join(trial_dir, "**", "*.csv"), recursive=True)
+                stale = [csv_file for csv_file in csv_files
+                         if os.path.exists(bundle_path(csv_file))
+                         and current_bundle(csv_file, (read_meta(bundle_path(csv_file)) or {}).get("kind")) is None]
+                print("{}: {} csv files, {} bundles, {} stale".format(trial_dir, len(csv_files), len(bundles),
+                                                                     len(stale)))
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+
+import numpy as np
+
+from evo.core import transformations as tr
+from evo.core.trajectory import PoseTrajectory3D
+
+# Registry shipped with the repo, holds the extrinsics of the XREVA sessions
+DEFAULT_CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        "..", "calibration", "extrinsics.json")
+
+# Calibration file layout (json or yaml):
+# {
+#   "current": <session>,
+#   "sessions": {
+#     <session>: {
+#       "gt": {<device>: {"transform": 4x4 list, ...}},     # w.r.t. the Vicon ground truth
+#       "avpgt": {<device>: {"transform": 4x4 list, ...}}   # w.r.t. the AppleVisionPro ground truth
+#     }
+#   }
+# }
+# The transforms are applied to the reference poses with right_mul=True.
+
+
+def read_calibration_file(calibration_file):
+    with open(calibration_file, "r") as f:
+        if calibration_file.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading {} needs PyYAML, pip install pyyaml".format(calibration_file))
+            calibration = yaml.safe_load(f)
+        else:
+            calibration = json.load(f)
+    if "sessions" not in calibration:
+        # Single session file: {"session": ..., "devices": {...}}
+        session = calibration.get("session") or "default"
+        calibration = {"current": session, "sessions": {session: {"gt": calibration.get("devices", {})}}}
+    return calibration
+
+
+def write_calibration_file(calibration_file, calibration):
+    tmp_file = "{}.{}.tmp".format(calibration_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        if calibration_file.endswith((".yaml", ".yml")):
+            import yaml
+            yaml.safe_dump(calibration, f, sort_keys=False)
+        else:
+            json.dump(calibration, f, indent=2)
+    os.replace(tmp_file, calibration_file)
+
+
+def quaternion_right_matrix(quat_wxyz):
+    # 4x4 matrix M with q (x) quat_wxyz = q @ M for row quaternions q
+    w, x, y, z = quat_wxyz
+    return np.array([[w, x, y, z],
+                     [-x, w, -z, y],
+                     [-y, z, w, -x],
+                     [-z, -y, x, w]])
+
+
+class CompiledTransform:
+    """A device extrinsic prepared for batched application.
+
+    Right-multiplying the reference poses by the transform becomes
+        positions' = positions + rotate(quats, t)
+        quats'     = quats @ M
+    on the position and quaternion arrays, without 4x4 pose matrices.
+    """
+
+    def __init__(self, transform):
+        self.matrix = np.array(transform, dtype=float)
+        self.translation = self.matrix[:3, 3].copy()
+        # w >= 0, as evo's transform would give
+        self.quat_wxyz = tr.quaternion_from_matrix(self.matrix)
+        self.quat_matrix = quaternion_right_matrix(self.quat_wxyz)
+
+    def apply(self, positions_xyz, orientations_quat_wxyz):
+        """New position and quaternion arrays of the transformed poses."""
+        w = orientations_quat_wxyz[:, :1]
+        u = orientations_quat_wxyz[:, 1:]
+        # v + 2w (u x v) + 2 u x (u x v), for unit quaternions
+        uv = np.cross(u, self.translation)
+        positions = positions_xyz + self.translation + 2 * (w * uv + np.cross(u, uv))
+        quats = np.dot(orientations_quat_wxyz, self.quat_matrix)
+        quats *= np.where(quats[:, :1] < 0, -1.0, 1.0)
+        return positions, quats
+
+    def transform_trajectory(self, traj):
+        positions, quats = self.apply(traj.positions_xyz, traj.orientations_quat_wxyz)
+        return PoseTrajectory3D(positions_xyz=positions, orientations_quat_wxyz=quats,
+                                timestamps=traj.timestamps)
+
+
+class ExtrinsicsRegistry:
+    """Device extrinsics of one calibration session.
+
+    Args:
+        calibration_file (str): json or yaml file, see the layout above
+        session (str): session to use, default is the "current" one
+    """
+
+    def __init__(self, calibration_file=DEFAULT_CALIBRATION_FILE, session=None):
+        self.calibration_file = calibration_file
+        calibration = read_calibration_file(calibration_file)
+        self.session = session if session is not None else calibration.get("current")
+        if self.session not in calibration["sessions"]:
+            raise KeyError("Session '{}' not in {}, available: {}".format(
+                self.session, calibration_file, list(calibration["sessions"].keys())))
+        self.sessions = list(calibration["sessions"].keys())
+        self.entries = calibration["sessions"][self.session]
+        # (reference, device) -> CompiledTransform
+        self.compiled = {}
+        for reference, devices in self.entries.items():
+            for device_name, entry in devices.items():
+                self.compiled[(reference, device_name)] = CompiledTransform(entry["transform"])
+
+    def devices(self, reference="gt"):
+        return [device_name for ref, device_name in self.compiled if ref == reference]
+
+    def get(self, device_name, reference="gt"):
+        compiled = self.compiled.get((reference, device_name))
+        if compiled is None:
+            raise KeyError("Device '{}' has no '{}' extrinsic in session '{}' of {}, available: {}".format(
+                device_name, reference, self.session, self.calibration_file, self.devices(reference)))
+        return compiled
+
+    def transform(self, device_name, reference="gt"):
+        return self.get(device_name, reference).matrix
+
+    def transform_trajectory(self, device_name, traj, reference="gt"):
+        """Reference trajectory moved to the device frame, as a new trajectory.
+
+        Same poses as traj.transform(t=transform, right_mul=True) on a deep
+        copy. The timestamps array is shared with traj.
+        """
+        return self.get(device_name, reference).transform_trajectory(traj)
+
+
+# (calibration file, session) -> (file mtime, ExtrinsicsRegistry)
+registries = {}
+
+
+def get_registry(calibration_file=None, session=None):
+    # Registry of a calibration file, loaded once per process and file version
+    if calibration_file is None:
+        calibration_file = DEFAULT_CALIBRATION_FILE
+    mtime = os.stat(calibration_file).st_mtime_ns
+    key = (os.path.abspath(calibration_file), session)
+    cached = registries.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, ExtrinsicsRegistry(calibration_file, session))
+        registries[key] = cached
+    return cached[1]
+
+
+def load_calibration(calibration_file, session=None, reference="gt"):
+    """Read the device extrinsics of a calibration file.
+
+    Returns:
+        transforms (dict): device name -> 4x4 np.ndarray
+    """
+    registry = get_registry(calibration_file, session)
+    return {device_name: registry.transform(device_name, reference)
+            for device_name in registry.devices(reference)}
+
+
+def save_calibration(calibration_file, device_name, transform, session=None, reference="gt", **info):
+    """Add or replace the extrinsic of one device in a calibration file.
+
+    Entries of other devices and sessions already in the file are kept.
+
+    Args:
+        calibration_file (str): json or yaml file path
+        device_name (str): e.g. "MetaQuest3"
+        transform (np.ndarray): 4x4 transform, applied to the reference
+                                poses with right_mul=True
+        session (str): calibration session, default is the current one or
+                       a new "default" session. It becomes the current one.
+        reference (str): "gt" (Vicon) or "avpgt" (AppleVisionPro)
+        info: extra json-serializable values stored with the device entry
+    """
+    calibration = {"current": None, "sessions": {}}
+    if os.path.exists(calibration_file):
+        calibration = read_calibration_file(calibration_file)
+    if session is None:
+        session = calibration.get("current") or "default"
+    calibration["current"] = session
+
+    entry = {"transform": np.asarray(transform, dtype=float).tolist(),
+             "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    entry.update(info)
+    references = calibration["sessions"].setdefault(session, {})
+    references.setdefault(reference, {})[device_name] = entry
+    write_calibration_file(calibration_file, calibration)
@@ -0,0 +1,139 @@
+import numpy as np
+
+from evo.core import filters
+from evo.core import metrics
+from evo.core.metrics import PoseRelation, Unit
+
+
+def quaternion_to_rotation(quat_wxyz):
+    # nx4 (w,x,y,z) quaternions to nx3x3 rotation matrices
+    q = quat_wxyz / np.linalg.norm(quat_wxyz, axis=1, keepdims=True)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=1)
+
+
+def pairs_by_path(positions_xyz, delta, tol):
+    """All pairs (i, j) with a travelled path of delta meters from i to j.
+
+    Same result as evo's filter_pairs_by_path with all_pairs=True: for every
+    i the j > i closest to delta (first one on ties) is taken if it is
+    within tol. The closest j is found with a binary search on the
+    accumulated path length instead of a scan per pose.
+
+    Args:
+        positions_xyz (np.ndarray): nx3 positions
+        delta (float): path distance in meters
+        tol (float): absolute tolerance in meters
+    Returns:
+        first_ids, second_ids (np.ndarray): indices of the pairs
+    """
+    n = len(positions_xyz)
+    if n < 2:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    distances = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(positions_xyz, axis=0), axis=1))))
+    first_ids = np.arange(n - 1)
+    d_i = distances[first_ids]
+    # First index reaching the target and the last one before it
+    upper = np.searchsorted(distances, d_i + delta, side="left")
+    lower = upper - 1
+
+    has_upper = upper < n
+    has_lower = lower >= first_ids + 1
+    upper = np.minimum(upper, n - 1)
+    # On a plateau (no motion) evo picks the first pose of the plateau
+    lower = np.searchsorted(distances, distances[np.maximum(lower, 0)], side="left")
+    lower = np.maximum(lower, first_ids + 1)
+    lower = np.minimum(lower, n - 1)
+
+    upper_diff = np.where(has_upper, np.abs((distances[upper] - d_i) - delta), np.inf)
+    lower_diff = np.where(has_lower, np.abs((distances[lower] - d_i) - delta), np.inf)
+    use_lower = lower_diff <= upper_diff
+    second_ids = np.where(use_lower, lower, upper)
+    best_diff = np.where(use_lower, lower_diff, upper_diff)
+
+    valid = best_diff <= tol
+    return first_ids[valid], second_ids[valid]
+
+
+def pairs_by_index(n, delta):
+    first_ids = np.arange(max(n - delta, 0))
+    return first_ids, first_ids + delta
+
+
+class FastRPE(metrics.RPE):
+    """Drop-in replacement of evo's RPE for all-pairs frame and meter deltas.
+
+    Pairs are found with np.searchsorted and the relative SE(3) errors are
+    computed in batch on the position and quaternion arrays, without
+    building 4x4 pose matrices. Other delta units and consecutive pairs
+    fall back to evo.
+    """
+
+    def process_data(self, data):
+        if not self.all_pairs or self.delta_unit not in (Unit.frames, Unit.meters):
+            return super(FastRPE, self).process_data(data)
+        if len(data) != 2:
+            raise metrics.MetricsException("please provide data tuple as: (traj_ref, traj_est)")
+        traj_ref, traj_est = data
+        if traj_ref.num_poses != traj_est.num_poses:
+            raise metrics.MetricsException("trajectories must have same number of poses")
+
+        ref_xyz, est_xyz = traj_ref.positions_xyz, traj_est.positions_xyz
+        # 1. Find the pairs
+        if self.delta_unit == Unit.frames:
+            first_ids, second_ids = pairs_by_index(traj_est.num_poses, int(self.delta))
+        else:
+            pair_xyz = ref_xyz if self.pairs_from_reference else est_xyz
+            first_ids, second_ids = pairs_by_path(pair_xyz, self.delta, self.delta * self.rel_delta_tol)
+        if len(first_ids) == 0:
+            raise filters.FilterException(
+                "delta = {} ({}) produced an empty index list - try lower values "
+                "or a less strict tolerance".format(self.delta, self.delta_unit.value))
+        self.delta_ids = second_ids.tolist()
+        self.E = []
+
+        # 2. Compute the errors of all pairs at once
+        if self.pose_relation in (PoseRelation.point_distance, PoseRelation.point_distance_error_ratio):
+            ref_distances = np.linalg.norm(ref_xyz[first_ids] - ref_xyz[second_ids], axis=1)
+            est_distances = np.linalg.norm(est_xyz[first_ids] - est_xyz[second_ids], axis=1)
+            self.error = np.abs(ref_distances - est_distances)
+            if self.pose_relation == PoseRelation.point_distance_error_ratio:
+                nonzero = ref_distances.nonzero()[0]
+                self.delta_ids = [self.delta_ids[i] for i in nonzero]
+                self.error = np.divide(self.error[nonzero], ref_distances[nonzero]) * 100
+            return
+
+        ref_rot = quaternion_to_rotation(traj_ref.orientations_quat_wxyz)
+        est_rot = quaternion_to_rotation(traj_est.orientations_quat_wxyz)
+        # Relative motions Q_rel = Q_i^-1 Q_j, P_rel = P_i^-1 P_j
+        ref_rot_i = ref_rot[first_ids]
+        est_rot_i = est_rot[first_ids]
+        ref_rel_rot = np.matmul(ref_rot_i.transpose(0, 2, 1), ref_rot[second_ids])
+        est_rel_rot = np.matmul(est_rot_i.transpose(0, 2, 1), est_rot[second_ids])
+        ref_rel_t = np.einsum("nji,nj->ni", ref_rot_i, ref_xyz[second_ids] - ref_xyz[first_ids])
+        est_rel_t = np.einsum("nji,nj->ni", est_rot_i, est_xyz[second_ids] - est_xyz[first_ids])
+        # E = Q_rel^-1 P_rel
+        error_rot = np.matmul(ref_rel_rot.transpose(0, 2, 1), est_rel_rot)
+        error_t = np.einsum("nji,nj->ni", ref_rel_rot, est_rel_t - ref_rel_t)
+
+        if self.pose_relation == PoseRelation.translation_part:
+            self.error = np.linalg.norm(error_t, axis=1)
+        elif self.pose_relation == PoseRelation.rotation_part:
+            self.error = np.linalg.norm(error_rot - np.eye(3), axis=(1, 2))
+        elif self.pose_relation == PoseRelation.full_transformation:
+            self.error = np.sqrt(np.linalg.norm(error_rot - np.eye(3), axis=(1, 2))**2
+                                 + np.linalg.norm(error_t, axis=1)**2)
+        elif self.pose_relation in (PoseRelation.rotation_angle_rad, PoseRelation.rotation_angle_deg):
+            # Angle of the rotation from its trace and skew part
+            cos_angle = (np.trace(error_rot, axis1=1, axis2=2) - 1) / 2
+            skew = np.stack([error_rot[:, 2, 1] - error_rot[:, 1, 2],
+                             error_rot[:, 0, 2] - error_rot[:, 2, 0],
+                             error_rot[:, 1, 0] - error_rot[:, 0, 1]], axis=1)
+            angle = np.arctan2(np.linalg.norm(skew, axis=1) / 2, cos_angle)
+            self.error = np.rad2deg(angle) if self.pose_relation == PoseRelation.rotation_angle_deg else angle
+        else:
+            raise metrics.MetricsException("unsupported pose_relation: {}".format(self.pose_relation))
@@ -0,0 +1,76 @@
+import numpy as np
+
+from evo.core.sync import SyncException
+from evo.core.trajectory import PoseTrajectory3D
+
+
+def matching_time_indices(stamps_1, stamps_2, max_diff=0.01, offset_2=0.0):
+    """Vectorized evo.core.sync.matching_time_indices.
+
+    For every stamp of stamps_1 the closest stamp of stamps_2 (first one on
+    ties) is found by binary search instead of a full scan, and kept if it
+    is within max_diff.
+
+    Args:
+        stamps_1 (np.ndarray): first vector of timestamps
+        stamps_2 (np.ndarray): second vector of timestamps
+        max_diff (float): max. allowed absolute time difference
+        offset_2 (float): time offset applied to stamps_2
+    Returns:
+        ids_1, ids_2 (np.ndarray): indices of the matching timestamps
+    """
+    stamps_1 = np.asarray(stamps_1)
+    stamps_2 = np.asarray(stamps_2) + offset_2
+    if len(stamps_1) == 0 or len(stamps_2) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    order = np.argsort(stamps_2, kind="stable")
+    sorted_2 = stamps_2[order]
+    n = len(sorted_2)
+
+    upper = np.searchsorted(sorted_2, stamps_1, side="left")
+    has_upper = upper < n
+    has_lower = upper > 0
+    # First stamp of a run of equal stamps below the target
+    lower = np.searchsorted(sorted_2, sorted_2[np.maximum(upper - 1, 0)], side="left")
+    upper = np.minimum(upper, n - 1)
+
+    upper_diff = np.where(has_upper, np.abs(sorted_2[upper] - stamps_1), np.inf)
+    lower_diff = np.where(has_lower, np.abs(sorted_2[lower] - stamps_1), np.inf)
+    upper_ids, lower_ids = order[upper], order[lower]
+    # Equal distances: evo's argmin returns the smaller original index
+    use_lower = (lower_diff < upper_diff) | ((lower_diff == upper_diff) & (lower_ids < upper_ids))
+    ids_2 = np.where(use_lower, lower_ids, upper_ids)
+    diffs = np.where(use_lower, lower_diff, upper_diff)
+
+    valid = diffs <= max_diff
+    return np.flatnonzero(valid), ids_2[valid]
+
+
+def associate_indices(stamps_1, stamps_2, max_diff=0.01, offset_2=0.0):
+    # Same matching direction as evo's associate_trajectories: the shorter
+    # trajectory is matched against the longer one
+    if len(stamps_2) > len(stamps_1):
+        ids_1, ids_2 = matching_time_indices(stamps_1, stamps_2, max_diff, offset_2)
+    else:
+        ids_2, ids_1 = matching_time_indices(stamps_2, stamps_1, max_diff, -offset_2)
+    return ids_1, ids_2
+
+
+def reduce_trajectory(traj, ids):
+    # New trajectory from index slices of the arrays, no deep copy
+    return PoseTrajectory3D(positions_xyz=traj.positions_xyz[ids],
+                            orientations_quat_wxyz=traj.orientations_quat_wxyz[ids],
+                            timestamps=traj.timestamps[ids])
+
+
+def associate_trajectories(traj_1, traj_2, max_diff=0.01, offset_2=0.0):
+    """Vectorized evo.core.sync.associate_trajectories.
+
+    Returns:
+        traj_1, traj_2 (PoseTrajectory3D): synchronized copies
+    """
+    ids_1, ids_2 = associate_indices(traj_1.timestamps, traj_2.timestamps, max_diff, offset_2)
+    if len(ids_1) == 0:
+        raise SyncException("found no matching timestamps with max. time diff {} (s) "
+                            "and time offset {} (s)".format(max_diff, offset_2))
+    return reduce_trajectory(traj_1, ids_1), reduce_trajectory(traj_2, ids_2)
@@ -0,0 +1,97 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import datasetStore
+from alignRegions import true_runs
+
+
+def fill_gaps(values, max_null_length=10):
+    """Linear interpolation of the NaN runs shorter than max_null_length.
+
+    A run is filled from its two neighbours, runs at the start or the end
+    of the column have only one and are kept. The runs come from run-length
+    encoding of the NaN mask and all of them are filled with one np.interp
+    call, with the same values as np.linspace per gap.
+
+    Args:
+        values (np.ndarray): column values
+        max_null_length (int): runs of this length or longer are kept
+    Returns:
+        filled (np.ndarray): float copy of the values
+        runs (np.ndarray): kx2 [start, end] (inclusive) NaN runs
+        filled_runs (np.ndarray): k, True for the interpolated runs
+    """
+    filled = np.array(values, dtype=np.float64)
+    runs = true_runs(np.isnan(filled))
+    lengths = runs[:, 1] - runs[:, 0] + 1
+    filled_runs = (lengths < max_null_length) & (runs[:, 0] > 0) & (runs[:, 1] < len(filled) - 1)
+    if np.any(filled_runs):
+        known = np.flatnonzero(~np.isnan(filled))
+        starts, counts = runs[filled_runs, 0], lengths[filled_runs]
+        targets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        filled[targets] = np.interp(targets.astype(np.float64), known.astype(np.float64), filled[known])
+    return filled, runs, filled_runs
+
+
+def fill_series(column, max_null_length=10):
+    # Same index and name, NaN runs filled
+    filled, _, _ = fill_gaps(column.to_numpy(dtype=np.float64, na_value=np.nan), max_null_length)
+    return pd.Series(filled, index=column.index, name=column.name)
+
+
+def gap_stats(name, values, runs, filled_runs):
+    lengths = runs[:, 1] - runs[:, 0] + 1
+    return {"column": name, "rows": len(values), "nulls": int(lengths.sum()), "gaps": len(runs),
+            "filled_gaps": int(np.count_nonzero(filled_runs)), "filled_values": int(lengths[filled_runs].sum()),
+            "remaining_nulls": int(lengths[~filled_runs].sum()),
+            "max_gap": int(lengths.max()) if len(lengths) > 0 else 0}
+
+
+def fill_dataframe(df, columns=None, max_null_length=10):
+    """Fill the short NaN runs of every numeric column of a DataFrame.
+
+    Args:
+        df (pd.DataFrame): e.g. merge_result.csv of a trial
+        columns (list): columns to fill, default all numeric columns
+        max_null_length (int): runs of this length or longer are kept
+    Returns:
+        df_filled (pd.DataFrame): copy with the filled columns
+        stats (pd.DataFrame): gap statistics per column
+    """
+    if columns is None:
+        columns = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    df_filled = df.copy()
+    stats = []
+    for col in columns:
+        values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        filled, runs, filled_runs = fill_gaps(values, max_null_length)
+        if len(runs) > 0:
+            df_filled[col] = filled
+        stats.append(gap_stats(col, values, runs, filled_runs))
+    return df_filled, pd.DataFrame(stats)
+
+
+def fill_file(input_file, output_file=None, max_null_length=10, verbose=False):
+    # merge_result.csv -> merge_result_filled.csv
+    if output_file is None:
+        output_file = input_file.replace(".csv", "_filled.csv")
+    df_filled, stats = fill_dataframe(datasetStore.read_csv(input_file), max_null_length=max_null_length)
+    datasetStore.write_csv(df_filled, output_file, index=False)
+    if verbose:
+        print(stats.to_string(index=False))
+    print("{}: filled {} of {} null values in {} gaps -> {}".format(
+        input_file, stats["filled_values"].sum(), stats["nulls"].sum(), stats["gaps"].sum(), output_file))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interpolate short gaps of merged result files")
+    parser.add_argument("files", nargs="+", help="merge_result.csv files")
+    parser.add_argument("--max-null-length", type=int, default=10, help="Gaps of this length or longer are kept")
+    parser.add_argument("--verbose", action="store_true", help="Print the gap statistics per column")
+    args = parser.parse_args()
+
+    for file in args.files:
+        fill_file(file, max_null_length=args.max_null_length, verbose=args.verbose)
@@ -0,0 +1,221 @@
+import os
+import glob
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import cv2
+
+import datasetStore
+import fastSync
+import slamLog
+
+# Per-frame features of the RealSense stereo IR images (sensor/cam0, sensor/cam1)
+#   Brightness, Contrast       mean and std of the cam0 intensity
+#   Entropy                    Shannon entropy of the cam0 histogram in bits
+#   Laplacian                  variance of the Laplacian, low for blurred frames
+#   NumberKeyPoints            ORB keypoints of cam0
+#   KeyPointCoverage           fraction of the GRID cells holding a keypoint
+#   KeyPointSpread             rms of the keypoint coordinates around their
+#                              mean, relative to the image size
+#   StereoMatches              cross-checked ORB matches cam0/cam1 on the same
+#                              row (rectified IR pair) with positive disparity
+#   StereoOverlap              StereoMatches / NumberKeyPoints
+# Names shared with ORB_log.csv are computed the same way so both tables
+# can be compared in the correlation study. image_features.csv keeps the
+# RealSense clock of the images, image_features returns the TimeStamp on
+# the ORB_log clock (slamLog.read_time_offset).
+FEATURE_COLUMNS = ["TimeStamp", "Brightness", "Contrast", "Entropy", "Laplacian", "NumberKeyPoints",
+                   "KeyPointCoverage", "KeyPointSpread", "StereoMatches", "StereoOverlap"]
+GRID = (8, 6)
+OUTPUT_FILE = "image_features.csv"
+PARTS_SUFFIX = ".parts"
+
+
+def read_image_index(sensor_dir, cam):
+    """cam0.csv / cam1.csv of the collector: "<timestamp> <path>" per frame.
+
+    The paths are relative to the collector folder, the images are looked
+    up by name in sensor_dir/<cam>/.
+    """
+    index = pd.read_csv(os.path.join(sensor_dir, "{}.csv".format(cam)), sep=" ", header=None,
+                        names=["TimeStamp", "path"])
+    index["path"] = [os.path.join(sensor_dir, cam, os.path.basename(path)) for path in index["path"]]
+    return index
+
+
+def stereo_frames(sensor_dir, max_diff=0.005):
+    # cam0 frames with the cam1 frame of the same time, None without one
+    cam0 = read_image_index(sensor_dir, "cam0")
+    cam1 = read_image_index(sensor_dir, "cam1")
+    ids0, ids1 = fastSync.matching_time_indices(cam0["TimeStamp"].to_numpy(), cam1["TimeStamp"].to_numpy(),
+                                                max_diff)
+    paths1 = np.full(len(cam0), None, dtype=object)
+    paths1[ids0] = cam1["path"].to_numpy()[ids1]
+    return list(zip(cam0["TimeStamp"].to_numpy(), cam0["path"].to_numpy(), paths1))
+
+
+def intensity_features(image):
+    histogram = np.bincount(image.ravel(), minlength=256).astype(np.float64)
+    p = histogram[histogram > 0] / image.size
+    return [float(image.mean()), float(image.std()), float(-np.sum(p * np.log2(p))),
+            float(cv2.Laplacian(image, cv2.CV_64F).var())]
+
+
+def keypoint_features(points, shape):
+    if len(points) == 0:
+        return [0, 0.0, np.nan]
+    height, width = shape
+    cells = (np.minimum((points[:, 0] * GRID[0] / width).astype(np.int64), GRID[0] - 1) * GRID[1]
+             + np.minimum((points[:, 1] * GRID[1] / height).astype(np.int64), GRID[1] - 1))
+    coverage = len(np.unique(cells)) / float(GRID[0] * GRID[1])
+    spread = np.sqrt(np.mean(np.var(points / np.array([width, height]), axis=0)))
+    return [len(points), coverage, float(spread)]
+
+
+def stereo_features(keypoints0, descriptors0, keypoints1, descriptors1, matcher, max_row_diff=2.0):
+    if descriptors0 is None or descriptors1 is None:
+        return [0, 0.0]
+    matches = matcher.match(descriptors0, descriptors1)
+    if len(matches) == 0:
+        return [0, 0.0]
+    points0 = np.array([keypoints0[m.queryIdx].pt for m in matches])
+    points1 = np.array([keypoints1[m.trainIdx].pt for m in matches])
+    # Rectified pair: same row, the left (cam0) point is right of the cam1 point
+    valid = (np.abs(points0[:, 1] - points1[:, 1]) <= max_row_diff) & (points0[:, 0] >= points1[:, 0])
+    count = int(np.count_nonzero(valid))
+    return [count, count / float(len(keypoints0))]
+
+
+def extract_chunk(frames, part_path, n_features=1000):
+    """Features of a list of (timestamp, cam0 path, cam1 path) frames.
+
+    Runs in a worker process. The rows are saved to part_path (rename
+    after the write, a part file is always complete) so an interrupted
+    run resumes with the missing chunks only.
+    """
+    cv2.setNumThreads(1)
+    orb = cv2.ORB_create(nfeatures=n_features)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    rows = np.full((len(frames), len(FEATURE_COLUMNS)), np.nan)
+    for idx, (timestamp, path0, path1) in enumerate(frames):
+        rows[idx, 0] = timestamp
+        image0 = cv2.imread(path0, cv2.IMREAD_GRAYSCALE)
+        if image0 is None:
+            print("Cannot read {}".format(path0))
+            continue
+        keypoints0, descriptors0 = orb.detectAndCompute(image0, None)
+        points0 = np.array([kp.pt for kp in keypoints0]).reshape(-1, 2)
+        rows[idx, 1:8] = intensity_features(image0) + keypoint_features(points0, image0.shape)
+        image1 = cv2.imread(path1, cv2.IMREAD_GRAYSCALE) if path1 is not None else None
+        if image1 is not None:
+            keypoints1, descriptors1 = orb.detectAndCompute(image1, None)
+            rows[idx, 8:10] = stereo_features(keypoints0, descriptors0, keypoints1, descriptors1, matcher)
+
+    tmp_path = "{}.{}.tmp.npy".format(part_path[:-len(".npy")], os.getpid())
+    np.save(tmp_path, rows, allow_pickle=False)
+    os.replace(tmp_path, part_path)
+    return len(frames)
+
+
+def shift_timestamps(features_df, time_offset):
+    # RealSense clock of the images -> ORB_log clock
+    features_df = features_df.copy()
+    features_df["TimeStamp"] = features_df["TimeStamp"].to_numpy(dtype=np.float64) + time_offset
+    return features_df
+
+
+def read_params(parts_dir):
+    try:
+        with open(os.path.join(parts_dir, "params.json"), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def image_features(trial_dir, workers=None, chunk_size=256, n_features=1000, overwrite=False):
+    """Per-frame image features of a trial, cached in sensor/image_features.csv.
+
+    The frames are split in chunks of chunk_size and extracted over a
+    process pool. Finished chunks are kept in sensor/image_features.parts/
+    until the table is written, a rerun after an interruption only
+    extracts the missing ones. The table keeps the RealSense clock of the
+    images, the returned TimeStamp is shifted to the ORB_log clock so a
+    new offset of process_raw_SLAM_data does not invalidate the table.
+
+    Args:
+        trial_dir (str): Datasets/<trajectory>/<trial> folder
+        workers (int): number of worker processes, default is the cpu count
+        chunk_size (int): frames per task
+        n_features (int): ORB features per image
+        overwrite (bool): extract again even if the table exists
+    Returns:
+        features_df (pd.DataFrame): FEATURE_COLUMNS, one row per cam0 frame
+    Raises:
+        FileNotFoundError: the trial has no time offset (see slamLog.read_time_offset)
+    """
+    sensor_dir = os.path.join(trial_dir, "sensor")
+    output_file = os.path.join(sensor_dir, OUTPUT_FILE)
+    parts_dir = os.path.splitext(output_file)[0] + PARTS_SUFFIX
+    # Before the extraction, a trial without offset fails fast
+    time_offset = slamLog.read_time_offset(trial_dir)
+    if os.path.exists(output_file) and not os.path.exists(parts_dir) and not overwrite:
+        return shift_timestamps(datasetStore.read_csv(output_file), time_offset)
+
+    frames = stereo_frames(sensor_dir)
+    params = {"frames": len(frames), "chunk_size": chunk_size, "n_features": n_features}
+    # Parts of another frame list or setting are useless
+    if overwrite or read_params(parts_dir) != params:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+        with open(os.path.join(parts_dir, "params.json"), "w") as f:
+            json.dump(params, f)
+
+    starts = range(0, len(frames), chunk_size)
+    part_paths = [os.path.join(parts_dir, "chunk_{:06d}.npy".format(idx)) for idx in range(len(starts))]
+    todo = [idx for idx, path in enumerate(part_paths) if not os.path.exists(path)]
+    print("{}: {} frames, {} of {} chunks to extract".format(trial_dir, len(frames), len(todo), len(part_paths)))
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(extract_chunk, frames[starts[idx]:starts[idx] + chunk_size], part_paths[idx],
+                                   n_features): idx for idx in todo}
+            for done, future in enumerate(as_completed(futures)):
+                future.result()
+                print("[{}/{}] chunk {} done".format(done + 1, len(todo), futures[future]))
+
+    rows = np.concatenate([np.load(path) for path in part_paths]) if part_paths else \
+        np.zeros((0, len(FEATURE_COLUMNS)))
+    features_df = pd.DataFrame(rows, columns=FEATURE_COLUMNS)
+    features_df.to_csv(output_file, index=False)
+    datasetStore.write_table_bundle(output_file, features_df)
+    shutil.rmtree(parts_dir)
+    return shift_timestamps(features_df, time_offset)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract per-frame stereo IR image features of trials")
+    parser.add_argument("--root", default="..", help="Dataset root holding the Datasets folder")
+    parser.add_argument("--trajectory", nargs="+", default=None, help="Only these trajectories")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Frames per task")
+    parser.add_argument("--features", type=int, default=1000, help="ORB features per image")
+    parser.add_argument("--overwrite", action="store_true", help="Extract again even if the table exists")
+    args = parser.parse_args()
+
+    trajectories = args.trajectory or sorted(os.listdir("{}/Datasets".format(args.root)))
+    for trajectory in trajectories:
+        for trial_dir in sorted(glob.glob("{}/Datasets/{}/*/".format(args.root, trajectory))):
+            if not os.path.exists(os.path.join(trial_dir, "sensor", "cam0.csv")):
+                continue
+            try:
+                features_df = image_features(trial_dir, args.workers, args.chunk_size, args.features,
+                                             args.overwrite)
+            except FileNotFoundError as e:
+                print("Skipping {}: {}".format(trial_dir, e))
+                continue
+            print("{}: {} frames, mean keypoints {:.1f}, mean stereo overlap {:.3f}".format(
+                trial_dir, len(features_df), features_df["NumberKeyPoints"].mean(),
+                features_df["StereoOverlap"].mean()))
@@ -0,0 +1,186 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import datasetStore
+import slamLog
+
+# sensor/imu/data.csv of the collector, no header:
+#   timestamp, gyro x/y/z (rad/s), accel x/y/z (m/s^2) at 200 Hz
+# The timestamps are on the RealSense clock, the error tables on the shifted
+# clock of ORB_log.csv: time_offset (slamLog.read_time_offset) maps them.
+IMU_COLUMNS = ["TimeStamp", "GyroX", "GyroY", "GyroZ", "AccX", "AccY", "AccZ"]
+IMU_RATE = 200.0
+DEFAULT_WINDOWS = (0.5, 2.0)
+# Spectral energy bands in Hz
+DEFAULT_BANDS = ((0.5, 2.0), (2.0, 5.0), (5.0, 15.0), (15.0, 50.0))
+
+
+def load_imu(imu_file, time_offset=0.0):
+    """Timestamps (n, plus time_offset), gyro (nx3) and accel (nx3) of an IMU log, sorted by time"""
+    imu = pd.read_csv(imu_file, header=None, names=IMU_COLUMNS).to_numpy(dtype=np.float64)
+    if np.any(np.diff(imu[:, 0]) < 0):
+        imu = imu[np.argsort(imu[:, 0], kind="stable")]
+    return imu[:, 0] + time_offset, imu[:, 1:4], imu[:, 4:7]
+
+
+def window_bounds(timestamps, query_times, window):
+    # [start, end) sample range of the trailing window (t - window, t] of every query
+    starts = np.searchsorted(timestamps, query_times - window, side="right")
+    ends = np.searchsorted(timestamps, query_times, side="right")
+    return starts, ends
+
+
+def prefix(values):
+    # Row k holds the sum of the first k rows
+    sums = np.zeros((len(values) + 1,) + values.shape[1:])
+    np.cumsum(values, axis=0, out=sums[1:])
+    return sums
+
+
+def band_power_sums(signal, timestamps, bands, rate):
+    """Prefix sums of the squared band signals on a uniform grid.
+
+    The signal is resampled on a uniform grid at rate and split into its
+    bands by zeroing the other bins of one FFT of the whole session.
+
+    Returns:
+        grid (np.ndarray): uniform timestamps
+        sums (np.ndarray): (len(grid) + 1) x len(bands) prefix sums
+    """
+    # Relative to the first sample, np.arange drifts at absolute clock values
+    elapsed = timestamps - timestamps[0]
+    grid_elapsed = np.arange(int(np.floor(elapsed[-1] * rate + 0.5)) + 1) / rate
+    grid = timestamps[0] + grid_elapsed
+    spectrum = np.fft.rfft(np.interp(grid_elapsed, elapsed, signal))
+    frequencies = np.fft.rfftfreq(len(grid), 1.0 / rate)
+    sums = np.zeros((len(grid) + 1, len(bands)))
+    for idx, (low, high) in enumerate(bands):
+        band = np.fft.irfft(np.where((frequencies >= low) & (frequencies < high), spectrum, 0), len(grid))
+        np.cumsum(band * band, out=sums[1:, idx])
+    return grid, sums
+
+
+def band_energies(grid, sums, query_times, window):
+    # Mean band power in the trailing window of every query, one subtraction
+    # per window whatever its length
+    starts, ends = window_bounds(grid, query_times, window)
+    count = (ends - starts).astype(np.float64)
+    count[count < 2] = np.nan
+    return (sums[ends] - sums[starts]) / count[:, None]
+
+
+def window_features(timestamps, gyro, acc, query_times, window, bands=DEFAULT_BANDS, rate=IMU_RATE, min_samples=3,
+                    band_sums=None):
+    """IMU features of the trailing window of every query timestamp.
+
+    AngSpeedRMS   rms of the angular speed |gyro|
+    AccRMS        rms of the acceleration around its window mean, gravity
+                  and bias drop out as long as the orientation changes little
+    JerkRMS       rms of the time derivative of the acceleration
+    GyroBand/AccBand_<low>_<high>Hz   mean power of |gyro| and of the
+                  acceleration magnitude in the frequency bands
+    All features come from prefix sums, one subtraction per window.
+    band_sums holds the band_power_sums of |gyro| and |acc| of an earlier
+    call, they do not depend on the window.
+
+    Returns:
+        features (dict): column name -> array, NaN for windows with fewer
+                         than min_samples samples
+    """
+    query_times = np.asarray(query_times, dtype=np.float64)
+    starts, ends = window_bounds(timestamps, query_times, window)
+    count = (ends - starts).astype(np.float64)
+    valid = count >= min_samples
+    count[~valid] = np.nan
+    features = {}
+
+    gyro_sums = prefix(np.sum(gyro * gyro, axis=1))
+    features["AngSpeedRMS"] = np.sqrt((gyro_sums[ends] - gyro_sums[starts]) / count)
+
+    # Centered on the global mean against cancellation in the sums
+    centered = acc - acc.mean(axis=0)
+    acc_sums = prefix(centered)
+    acc_sq_sums = prefix(np.sum(centered * centered, axis=1))
+    mean = (acc_sums[ends] - acc_sums[starts]) / count[:, None]
+    variance = (acc_sq_sums[ends] - acc_sq_sums[starts]) / count - np.sum(mean * mean, axis=1)
+    features["AccRMS"] = np.sqrt(np.maximum(variance, 0.0))
+
+    # Jerk sample k lies between the samples k and k + 1
+    dt = np.diff(timestamps)
+    jerk = np.diff(acc, axis=0) / np.where(dt > 0, dt, np.nan)[:, None]
+    jerk_sq = np.nan_to_num(np.sum(jerk * jerk, axis=1))
+    jerk_sums = prefix(jerk_sq)
+    jerk_counts = prefix((dt > 0).astype(np.float64))
+    # A window past the last sample has no jerk sample, 0 / 0 gives NaN
+    last = len(jerk_sums) - 1
+    jerk_starts = np.minimum(starts, last)
+    jerk_ends = np.clip(ends - 1, jerk_starts, last)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features["JerkRMS"] = np.sqrt((jerk_sums[jerk_ends] - jerk_sums[jerk_starts])
+                                      / (jerk_counts[jerk_ends] - jerk_counts[jerk_starts]))
+    features["JerkRMS"][~valid] = np.nan
+
+    if len(bands) > 0 and len(timestamps) > 1:
+        if band_sums is None:
+            band_sums = imu_band_sums(timestamps, gyro, acc, bands, rate)
+        for name, (grid, sums) in band_sums.items():
+            energies = band_energies(grid, sums, query_times, window)
+            for idx, (low, high) in enumerate(bands):
+                features["{}_{:g}_{:g}Hz".format(name, low, high)] = energies[:, idx]
+    return features
+
+
+def imu_band_sums(timestamps, gyro, acc, bands=DEFAULT_BANDS, rate=IMU_RATE):
+    return {"GyroBand": band_power_sums(np.linalg.norm(gyro, axis=1), timestamps, bands, rate),
+            "AccBand": band_power_sums(np.linalg.norm(acc, axis=1), timestamps, bands, rate)}
+
+
+def imu_features(imu_file, query_times, time_offset, windows=DEFAULT_WINDOWS, bands=DEFAULT_BANDS, rate=IMU_RATE):
+    """IMU feature table at the query timestamps, one column set per window.
+
+    Args:
+        imu_file (str): sensor/imu/data.csv
+        query_times (np.ndarray): e.g. the TimeStamp column of <device>_error.csv
+        time_offset (float): added to the IMU timestamps to reach the clock of
+                             the query times, slamLog.read_time_offset
+        windows (list): window lengths in seconds
+        bands (list): (low, high) frequency bands in Hz
+        rate (float): IMU rate of the spectral resampling
+    Returns:
+        features_df (pd.DataFrame): TimeStamp and <feature>_<window>s columns
+    """
+    timestamps, gyro, acc = load_imu(imu_file, time_offset)
+    band_sums = imu_band_sums(timestamps, gyro, acc, bands, rate) if len(bands) > 0 and len(timestamps) > 1 else None
+    columns = {"TimeStamp": np.asarray(query_times, dtype=np.float64)}
+    for window in windows:
+        for name, values in window_features(timestamps, gyro, acc, query_times, window, bands, rate,
+                                            band_sums=band_sums).items():
+            columns["{}_{:g}s".format(name, window)] = values
+    return pd.DataFrame(columns)
+
+
+def error_imu_features(trial_dir, device="ORBSLAM", windows=DEFAULT_WINDOWS, bands=DEFAULT_BANDS, rate=IMU_RATE):
+    # IMU features of every row of <device>_error.csv, written to <device>_imu.csv
+    time_offset = slamLog.read_time_offset(trial_dir)
+    error_df = datasetStore.read_csv(os.path.join(trial_dir, "{}_error.csv".format(device)))
+    features_df = imu_features(os.path.join(trial_dir, "sensor", "imu", "data.csv"),
+                               error_df["TimeStamp"].to_numpy(), time_offset, windows, bands, rate)
+    datasetStore.write_csv(features_df, os.path.join(trial_dir, "{}_imu.csv".format(device)), index=False,
+                           float_format="%.9g")
+    return features_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Windowed IMU features at the error timestamps of trials")
+    parser.add_argument("trial_dirs", nargs="+", help="Datasets/<trajectory>/<trial> folders")
+    parser.add_argument("--device", default="ORBSLAM", help="Device of the <device>_error.csv timestamps")
+    parser.add_argument("--windows", nargs="+", type=float, default=list(DEFAULT_WINDOWS),
+                        help="Window lengths in seconds")
+    args = parser.parse_args()
+
+    for trial_dir in args.trial_dirs:
+        features_df = error_imu_features(trial_dir, args.device, args.windows)
+        print("{}: {} rows, {} features".format(trial_dir, len(features_df), len(features_df.columns) - 1))
@@ -0,0 +1,154 @@
+import os
+import glob
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import datasetStore
+import imuFeatures
+import slamLog
+
+# The ORB-SLAM3 error columns keep their names (RPE, APE), the device
+# columns are prefixed with the device name (AppleVisionPro_RPE, ...)
+ORB_STREAM = "ORBSLAM"
+LABEL_COLUMNS = ["RPE", "APE"]
+
+
+def stream_column(name, column):
+    return column if name == ORB_STREAM else "{}_{}".format(name, column)
+
+
+def asof_indices(base_times, stream_times, tolerance):
+    """Row of the stream matched to every base timestamp, -1 if none.
+
+    Same matching as pd.merge_asof(direction='backward'): the last stream
+    row at or before the base timestamp, kept if at most tolerance older.
+    The stream timestamps must be sorted.
+    """
+    ids = np.searchsorted(stream_times, base_times, side='right') - 1
+    if len(stream_times) == 0:
+        return ids
+    age = base_times - stream_times[np.maximum(ids, 0)]
+    return np.where((ids >= 0) & (age <= tolerance), ids, -1)
+
+
+def merge_streams(base_df, streams, on="TimeStamp", tolerance=0.05, tolerances=None):
+    """Merge N error streams onto the rows of a base table in one pass.
+
+    Every stream is matched to the base timestamps with one searchsorted
+    call and its columns are gathered with the matched rows, instead of
+    chaining pd.merge_asof per stream.
+
+    Args:
+        base_df (pd.DataFrame): e.g. the ORB_log.csv features, one output row per base row
+        streams (dict): stream name -> DataFrame with the on column, in column order
+        on (str): timestamp column
+        tolerance (float): max. age of a matched stream row in seconds
+        tolerances (dict): optional stream name -> tolerance
+    Returns:
+        merged_df (pd.DataFrame): stream columns (see stream_column) first,
+                                  then the base columns
+    """
+    tolerances = tolerances or {}
+    base_times = base_df[on].to_numpy(dtype=np.float64)
+    merged = {}
+    for name, stream_df in streams.items():
+        stream_times = stream_df[on].to_numpy(dtype=np.float64)
+        order = None
+        if np.any(stream_times[1:] < stream_times[:-1]):
+            order = np.argsort(stream_times, kind="stable")
+            stream_times = stream_times[order]
+        ids = asof_indices(base_times, stream_times, tolerances.get(name, tolerance))
+        unmatched = ids < 0
+        rows = ids if order is None else order[ids]
+        for col in stream_df.columns:
+            if col == on:
+                continue
+            values = stream_df[col].to_numpy(dtype=np.float64).take(rows)
+            values[unmatched] = np.nan
+            merged[stream_column(name, col)] = values
+    stream_df = pd.DataFrame(merged, index=base_df.index)
+    return pd.concat([stream_df, base_df], axis=1)
+
+
+def coverage(df, columns=None):
+    """Leading and trailing rows where some column has no value yet / anymore.
+
+    Args:
+        df (pd.DataFrame): merged table
+        columns (list): columns to check, default all
+    Returns:
+        coverage (dict): "first_valid" and "last_valid" row of every column
+                         (len(df) and -1 for empty columns), "leading" and
+                         "trailing" boolean row masks and "covered", the
+                         rows between them
+    """
+    columns = list(df.columns) if columns is None else columns
+    valid = df[columns].notna().to_numpy()
+    n = len(df)
+    any_valid = valid.any(axis=0)
+    first_valid = np.where(any_valid, valid.argmax(axis=0), n)
+    last_valid = np.where(any_valid, n - 1 - valid[::-1].argmax(axis=0), -1)
+    rows = np.arange(n)
+    leading = rows < (first_valid.max() if len(columns) > 0 else 0)
+    trailing = rows > (last_valid.min() if len(columns) > 0 else n - 1)
+    return {"first_valid": pd.Series(first_valid, index=columns),
+            "last_valid": pd.Series(last_valid, index=columns),
+            "leading": leading, "trailing": trailing, "covered": ~leading & ~trailing}
+
+
+def trim_leading(df, columns=None):
+    # Drop the rows before every column has a value, like max_empty_rows in the notebook
+    leading = coverage(df, columns)["leading"]
+    return df.iloc[np.count_nonzero(leading):].reset_index(drop=True)
+
+
+def merge_trial(trial_dir, devices=None, tolerance=0.05, output_file="merge_result.csv", imu_windows=None):
+    """Merge the <device>_error.csv files of a trial with the ORB_log.csv features.
+
+    Args:
+        trial_dir (str): Datasets/<trajectory>/<trial> folder
+        devices (list): device names, default all error files of the trial
+        imu_windows (list): window lengths in seconds of the IMU features
+                            (see imuFeatures) appended as IMU_<feature>
+                            columns, default none
+    Returns:
+        merged_df (pd.DataFrame): also written to output_file in the trial folder
+    """
+    feature_df = datasetStore.read_csv(os.path.join(trial_dir, "xr", "ORB_log.csv"))
+    if devices is None:
+        devices = sorted(os.path.basename(path)[:-len("_error.csv")]
+                         for path in glob.glob(os.path.join(trial_dir, "*_error.csv")))
+    # ORB-SLAM3 first, its labels lead the table as in orb_combined.csv
+    devices = sorted(devices, key=lambda device: device != ORB_STREAM)
+    streams = {}
+    for device in devices:
+        error_df = datasetStore.read_csv(os.path.join(trial_dir, "{}_error.csv".format(device)))
+        streams[device] = error_df[["TimeStamp"] + LABEL_COLUMNS]
+    merged_df = merge_streams(feature_df, streams, tolerance=tolerance)
+    if imu_windows:
+        imu_df = imuFeatures.imu_features(os.path.join(trial_dir, "sensor", "imu", "data.csv"),
+                                          feature_df["TimeStamp"].to_numpy(dtype=np.float64),
+                                          slamLog.read_time_offset(trial_dir), imu_windows)
+        imu_df = imu_df.drop(columns="TimeStamp").add_prefix("IMU_").set_index(merged_df.index)
+        merged_df = pd.concat([merged_df, imu_df], axis=1)
+    if output_file is not None:
+        datasetStore.write_csv(merged_df, os.path.join(trial_dir, output_file), index=False)
+    return merged_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the device error streams of trials into merge_result.csv")
+    parser.add_argument("trial_dirs", nargs="+", help="Datasets/<trajectory>/<trial> folders")
+    parser.add_argument("--devices", nargs="+", default=None, help="Devices to merge, default all error files")
+    parser.add_argument("--max-diff", type=float, default=0.05, help="Max. age of a matched error row in seconds")
+    parser.add_argument("--imu-windows", nargs="+", type=float, default=None,
+                        help="Append IMU features over these window lengths in seconds")
+    args = parser.parse_args()
+
+    for trial_dir in args.trial_dirs:
+        merged_df = merge_trial(trial_dir, args.devices, args.max_diff, imu_windows=args.imu_windows)
+        cov = coverage(merged_df)
+        print("{}: {} rows, {} leading and {} trailing rows without all columns".format(
+            trial_dir, len(merged_df), np.count_nonzero(cov["leading"]), np.count_nonzero(cov["trailing"])))
@@ -0,0 +1,241 @@
+import numpy as np
+
+
+# Umeyama alignment y ~ c * R @ x + t (x: estimated, y: reference positions)
+# only needs the sums of x, y, |x|^2, |y|^2 and x y^T over the point pairs.
+# Keeping these sums makes adding and removing pairs O(1) and one alignment
+# a 3x3 SVD, whatever the number of pairs. The residual sum of squares
+# follows from the same sums:
+#   sum |c R x + t - y|^2 = c^2 Sxx + Syy + n |t|^2 + 2 c t.R Sx - 2 t.Sy - 2 c tr(R Sxy)
+
+
+def umeyama_from_sums(n, sx, sy, sxx, sxy, with_scale=False):
+    """Batched Umeyama alignment from the pair sums.
+
+    Same solution as evo's umeyama_alignment on the pairs.
+
+    Args:
+        n (np.ndarray): m numbers of pairs
+        sx, sy (np.ndarray): mx3 sums of x and y
+        sxx (np.ndarray): m sums of |x|^2
+        sxy (np.ndarray): mx3x3 sums of x y^T
+        with_scale (bool): also estimate the scale c
+    Returns:
+        rotation (np.ndarray): mx3x3
+        translation (np.ndarray): mx3
+        scale (np.ndarray): m, ones without with_scale
+    """
+    n = np.asarray(n, dtype=np.float64)[:, None]
+    mx, my = sx / n, sy / n
+    # Cross-covariance 1/n sum (y - my)(x - mx)^T
+    cov = np.swapaxes(sxy / n[:, :, None] - mx[:, :, None] * my[:, None, :], 1, 2)
+    var_x = sxx / n[:, 0] - np.sum(mx * mx, axis=1)
+    rotation, translation, scale, _ = umeyama_from_moments(mx, my, cov, var_x, with_scale)
+    return rotation, translation, scale
+
+
+def umeyama_from_moments(mx, my, cov, var_x, with_scale=False):
+    """Batched Umeyama alignment from the means, cross-covariance and variance.
+
+    Returns:
+        rotation (mx3x3), translation (mx3), scale (m) and the singular
+        values of the cross-covariances (mx3)
+    """
+    u, d, vt = np.linalg.svd(cov)
+    s = np.ones_like(d)
+    s[:, 2] = np.where(np.linalg.det(u) * np.linalg.det(vt) < 0, -1.0, 1.0)
+    rotation = np.matmul(u * s[:, None, :], vt)
+    scale = np.ones(len(mx))
+    if with_scale:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.sum(d * s, axis=1) / var_x
+    translation = my - scale[:, None] * np.einsum('mij,mj->mi', rotation, mx)
+    return rotation, translation, scale, d
+
+
+def residual_from_sums(n, sx, sy, sxx, syy, sxy, rotation, translation, scale):
+    """RMSE of the aligned pairs (m windows), from the pair sums"""
+    total = (scale ** 2 * sxx + syy + np.sum(translation * translation, axis=1)
+             * np.asarray(n, dtype=np.float64)
+             + 2 * scale * np.einsum('mi,mij,mj->m', translation, rotation, sx)
+             - 2 * np.sum(translation * sy, axis=1)
+             - 2 * scale * np.einsum('mij,mji->m', rotation, sxy))
+    return np.sqrt(np.maximum(total, 0.0) / n)
+
+
+class AlignmentStats:
+    """Running pair sums for incremental Umeyama alignment.
+
+    Pairs are added and removed in O(1) (per pair) and solve() is a 3x3 SVD,
+    e.g. for a sliding window: add the new pairs, remove the expired ones.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sx = np.zeros(3)
+        self.sy = np.zeros(3)
+        self.sxx = 0.0
+        self.syy = 0.0
+        self.sxy = np.zeros((3, 3))
+
+    def update(self, x, y, sign=1.0):
+        x = np.atleast_2d(x)
+        y = np.atleast_2d(y)
+        self.n += int(sign) * len(x)
+        self.sx += sign * x.sum(axis=0)
+        self.sy += sign * y.sum(axis=0)
+        self.sxx += sign * np.einsum('ij,ij->', x, x)
+        self.syy += sign * np.einsum('ij,ij->', y, y)
+        self.sxy += sign * np.dot(x.T, y)
+
+    def add(self, x, y):
+        """Add pairs, x: estimated and y: reference positions (nx3 or 3)"""
+        self.update(x, y, 1.0)
+
+    def remove(self, x, y):
+        # Pairs must have been added before
+        self.update(x, y, -1.0)
+
+    def solve(self, with_scale=False):
+        """(rotation, translation, scale) with y ~ scale * rotation @ x + translation"""
+        if self.n < 3:
+            raise ValueError("Alignment needs at least 3 pairs, got {}".format(self.n))
+        rotation, translation, scale = umeyama_from_sums(
+            [self.n], self.sx[None], self.sy[None], np.array([self.sxx]), self.sxy[None], with_scale)
+        return rotation[0], translation[0], float(scale[0])
+
+    def rmse(self, alignment=None, with_scale=False):
+        rotation, translation, scale = alignment if alignment is not None else self.solve(with_scale)
+        return float(residual_from_sums(
+            [self.n], self.sx[None], self.sy[None], np.array([self.sxx]), np.array([self.syy]),
+            self.sxy[None], rotation[None], translation[None], np.array([scale]))[0])
+
+
+def prefix_sums(est_xyz, ref_xyz):
+    """Cumulative pair sums, row k holds the sums over the first k pairs.
+
+    The positions are centered on the reference mean first, which keeps the
+    differences of the sums accurate on long traces.
+    """
+    center = ref_xyz.mean(axis=0) if len(ref_xyz) else np.zeros(3)
+    x = est_xyz - center
+    y = ref_xyz - center
+    columns = [x, y, np.sum(x * x, axis=1)[:, None], np.sum(y * y, axis=1)[:, None],
+               (x[:, :, None] * y[:, None, :]).reshape(-1, 9)]
+    sums = np.zeros((len(x) + 1, 17))
+    np.cumsum(np.hstack(columns), axis=0, out=sums[1:])
+    return sums, center
+
+
+def range_alignments(sums, starts, ends, with_scale=False):
+    """Umeyama alignment and RMSE of the pair ranges [starts, ends) of prefix_sums.
+
+    Returns:
+        rotation (mx3x3), translation (mx3, centered frame), scale (m),
+        rmse (m), n (m)
+    """
+    window = sums[ends] - sums[starts]
+    n = ends - starts
+    sx, sy, sxx, syy = window[:, 0:3], window[:, 3:6], window[:, 6], window[:, 7]
+    sxy = window[:, 8:17].reshape(-1, 3, 3)
+    rotation, translation, scale = umeyama_from_sums(n, sx, sy, sxx, sxy, with_scale)
+    rmse = residual_from_sums(n, sx, sy, sxx, syy, sxy, rotation, translation, scale)
+    return rotation, translation, scale, rmse, n
+
+
+def uncenter(rotation, translation, scale, center):
+    # Translation of the alignment in the original frame
+    return translation + center - scale[:, None] * np.einsum('mij,j->mi', rotation, center)
+
+
+def windowed_ape(timestamps, est_xyz, ref_xyz, window, step=None, with_scale=False, min_pairs=3):
+    """APE (translation RMSE) of every time window, each window aligned on its own.
+
+    The window ending at a pose holds the pairs of the last window seconds.
+    All windows are evaluated from prefix sums in one batched pass, so the
+    cost is linear in the number of poses whatever the window length.
+
+    Args:
+        timestamps (np.ndarray): n sorted timestamps of the associated pairs
+        est_xyz, ref_xyz (np.ndarray): nx3 associated positions
+        window (float): window length in seconds
+        step (float): seconds between evaluated window ends, default every pose
+        with_scale (bool): Sim(3) instead of SE(3) alignment per window
+        min_pairs (int): windows with fewer pairs are NaN
+    Returns:
+        end_times (np.ndarray): timestamp of the last pose of every window
+        ape (np.ndarray): RMSE of every window, NaN if too few pairs
+        n (np.ndarray): pairs in every window
+    """
+    timestamps = np.asarray(timestamps)
+    sums, _ = prefix_sums(np.asarray(est_xyz, dtype=np.float64), np.asarray(ref_xyz, dtype=np.float64))
+    ends = np.arange(1, len(timestamps) + 1)
+    if step is not None and len(timestamps) > 0:
+        grid = np.arange(timestamps[0] + window, timestamps[-1] + step, step)
+        ends = np.unique(np.searchsorted(timestamps, grid, side='right'))
+        ends = ends[ends > 0]
+    starts = np.searchsorted(timestamps, timestamps[ends - 1] - window, side='right')
+    ape = np.full(len(ends), np.nan)
+    valid = ends - starts >= min_pairs
+    if np.any(valid):
+        ape[valid] = range_alignments(sums, starts[valid], ends[valid], with_scale)[3]
+    return timestamps[ends - 1], ape, ends - starts
+
+
+def region_alignments(est_xyz, ref_xyz, regions, with_scale=False):
+    """Alignment of every index region of associated pairs in one batched pass.
+
+    Args:
+        est_xyz, ref_xyz (np.ndarray): nx3 associated positions
+        regions (np.ndarray): mx2 [start, end) pair index ranges
+        with_scale (bool): Sim(3) instead of SE(3) alignment
+    Returns:
+        result (dict): "rotation" mx3x3, "translation" mx3, "scale" m,
+                       "rmse" m and "n" m, with est ~ aligned by
+                       scale * rotation @ x + translation
+    """
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+    sums, center = prefix_sums(np.asarray(est_xyz, dtype=np.float64), np.asarray(ref_xyz, dtype=np.float64))
+    rotation, translation, scale, rmse, n = range_alignments(sums, regions[:, 0], regions[:, 1], with_scale)
+    return {"rotation": rotation, "translation": uncenter(rotation, translation, scale, center),
+            "scale": scale, "rmse": rmse, "n": n}
+
+
+def segment_alignments(est_xyz, ref_xyz, offsets, with_scale=False):
+    """Alignment of consecutive segments of associated pairs in one batched pass.
+
+    Segment k holds the pairs offsets[k]:offsets[k + 1]. Unlike the prefix
+    sums the covariances are computed on the centered pairs of every
+    segment, like evo's umeyama_alignment, so degenerate segments (e.g. a
+    lost tracking region with constant positions) are found the same way.
+
+    Args:
+        est_xyz, ref_xyz (np.ndarray): nx3 associated positions
+        offsets (np.ndarray): m+1 increasing segment boundaries, no empty segment
+        with_scale (bool): Sim(3) instead of SE(3) alignment
+    Returns:
+        result (dict): "rotation" mx3x3, "translation" mx3, "scale" m,
+                       "rmse" m, "n" m and "degenerate" m, True where evo
+                       would raise "Degenerate covariance rank"
+    """
+    x = np.asarray(est_xyz, dtype=np.float64)
+    y = np.asarray(ref_xyz, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, n = offsets[:-1], np.diff(offsets)
+    if len(n) == 0:
+        return {"rotation": np.zeros((0, 3, 3)), "translation": np.zeros((0, 3)), "scale": np.zeros(0),
+                "rmse": np.zeros(0), "n": n, "degenerate": np.zeros(0, dtype=bool)}
+    mx = np.add.reduceat(x, starts) / n[:, None]
+    my = np.add.reduceat(y, starts) / n[:, None]
+    xc = x - np.repeat(mx, n, axis=0)
+    yc = y - np.repeat(my, n, axis=0)
+    cov = np.add.reduceat(yc[:, :, None] * xc[:, None, :], starts) / n[:, None, None]
+    var_x = np.add.reduceat(np.sum(xc * xc, axis=1), starts) / n
+    rotation, translation, scale, d = umeyama_from_moments(mx, my, cov, var_x, with_scale)
+    degenerate = np.count_nonzero(d > np.finfo(d.dtype).eps, axis=1) < 2
+
+    segment = np.repeat(np.arange(len(n)), n)
+    aligned = scale[segment, None] * np.einsum('nij,nj->ni', rotation[segment], x) + translation[segment]
+    rmse = np.sqrt(np.add.reduceat(np.sum((aligned - y) ** 2, axis=1), starts) / n)
+    return {"rotation": rotation, "translation": translation, "scale": scale,
+            "rmse": rmse, "n": n, "degenerate": degenerate}
@@ -0,0 +1,100 @@
+import numpy as np
+
+from evo.core import transformations
+from evo.core.sync import SyncException
+from evo.core.trajectory import PoseTrajectory3D
+
+import fastSync
+import onlineAlign
+
+
+def quaternion_multiply(q1, q2):
+    # Hamilton products of wxyz quaternions, nx4 each
+    w1, x1, y1, z1 = q1[:, 0], q1[:, 1], q1[:, 2], q1[:, 3]
+    w2, x2, y2, z2 = q2[:, 0], q2[:, 1], q2[:, 2], q2[:, 3]
+    return np.column_stack((w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                            w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                            w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                            w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2))
+
+
+def piecewise_align(traj_est, traj_ref, regions, max_diff=0.05, with_scale=True):
+    """Align every region of the estimated trajectory on its own and merge them.
+
+    Same result as aligning the sub-trajectories one by one: the first and
+    last pose of a region [start, end) are replaced by their neighbours,
+    the poses are associated with the reference (max_diff), aligned with
+    Umeyama and merged in time order. A region that cannot be aligned
+    (degenerate covariance) contributes its associated reference poses.
+    The reference is associated once for the whole trajectory and all
+    regions are aligned in one batched pass on index slices.
+
+    Args:
+        traj_est (PoseTrajectory3D): estimated trajectory, not modified
+        traj_ref (PoseTrajectory3D): reference trajectory
+        regions (list or np.ndarray): [start, end] pose index regions,
+                                      sorted and not overlapping
+        max_diff (float): max. time difference of associated poses
+        with_scale (bool): Sim(3) instead of SE(3) alignment
+    Returns:
+        traj_aligned (PoseTrajectory3D): merged aligned trajectory
+        info (dict): per region arrays "regions", "rotation", "translation",
+                     "scale", "rmse", "pairs" and "failed"
+    """
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+    lengths = regions[:, 1] - regions[:, 0]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    ids = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - regions[:, 0], lengths)
+
+    # Copies of the region poses, first and last pose replaced by their neighbours
+    xyz = traj_est.positions_xyz[ids]
+    quat = traj_est.orientations_quat_wxyz[ids]
+    first, last = offsets[:-1], offsets[1:] - 1
+    for array in (xyz, quat):
+        array[first] = array[first + 1]
+        array[last] = array[last - 1]
+    timestamps = traj_est.timestamps[ids]
+
+    # One association for all regions: the closest reference pose of every estimated pose
+    est_ids, ref_ids = fastSync.matching_time_indices(timestamps, traj_ref.timestamps, max_diff)
+    region_of_pair = np.searchsorted(offsets, est_ids, side='right') - 1
+    pairs = np.bincount(region_of_pair, minlength=len(regions))
+    empty = pairs == 0
+    if np.any(empty):
+        print("No matching timestamps in regions {}, skipped".format(regions[empty].tolist()))
+    if len(est_ids) == 0:
+        raise SyncException("found no matching timestamps with max. time diff {} (s)".format(max_diff))
+    pair_offsets = np.concatenate(([0], np.cumsum(pairs[~empty])))
+
+    result = onlineAlign.segment_alignments(xyz[est_ids], traj_ref.positions_xyz[ref_ids], pair_offsets,
+                                            with_scale)
+    failed = result["degenerate"]
+    if np.any(failed):
+        print("Subtrajectory alignment failed (degenerate covariance) for regions {}, "
+              "using the reference poses".format(regions[~empty][failed].tolist()))
+
+    # Apply the alignment of its region to every pair
+    segment = np.repeat(np.arange(len(failed)), pairs[~empty])
+    rotation, scale = result["rotation"][segment], result["scale"][segment]
+    aligned_xyz = scale[:, None] * np.einsum('nij,nj->ni', rotation, xyz[est_ids]) + result["translation"][segment]
+    rotation_quat = np.array([transformations.quaternion_from_matrix(r) for r in result["rotation"]])
+    aligned_quat = quaternion_multiply(rotation_quat.reshape(-1, 4)[segment], quat[est_ids])
+    aligned_quat[aligned_quat[:, 0] < 0] *= -1
+    aligned_time = timestamps[est_ids]
+
+    use_ref = failed[segment]
+    aligned_xyz[use_ref] = traj_ref.positions_xyz[ref_ids[use_ref]]
+    aligned_quat[use_ref] = traj_ref.orientations_quat_wxyz[ref_ids[use_ref]]
+    aligned_time[use_ref] = traj_ref.timestamps[ref_ids[use_ref]]
+
+    order = aligned_time.argsort()
+    traj_aligned = PoseTrajectory3D(aligned_xyz[order], aligned_quat[order], aligned_time[order])
+
+    info = {"regions": regions, "pairs": pairs,
+            "rotation": np.full((len(regions), 3, 3), np.nan), "translation": np.full((len(regions), 3), np.nan),
+            "scale": np.full(len(regions), np.nan), "rmse": np.full(len(regions), np.nan),
+            "failed": empty.copy()}
+    for key in ("rotation", "translation", "scale", "rmse"):
+        info[key][~empty] = result[key]
+    info["failed"][~empty] = failed
+    return traj_aligned, info
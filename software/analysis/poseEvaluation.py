@@ -13,22 +13,31 @@ import matplotlib.pyplot as plt
 from evo.tools.settings import SETTINGS
 SETTINGS.plot_usetex = False
 
-from evo.tools import file_interface
 from evo.core import sync
 from evo.core import metrics
 
 # Import for plotting trajectory with error magnitude
 from evo.core.metrics import PoseRelation, Unit
 
+import os
 import copy
+import glob
 import pandas as pd
 
 # Import for regional alignment
-from evo import core
 from evo.core.trajectory import PosePath3D, PoseTrajectory3D
 
+from fastRPE import FastRPE
+import datasetStore
+import onlineAlign
+import alignRegions
+import piecewiseAlign
+import gapFill
+import mergeStreams
+
 class PoseErrorEvaluator:
-    def __init__(self, root_dir, metric_unit=metrics.Unit.frames, delta=60, max_diff=0.05, max_null_length=10):
+    def __init__(self, root_dir, metric_unit=metrics.Unit.frames, delta=60, max_diff=0.05, max_null_length=10,
+                 cache=None):
         self.root_dir = root_dir
         self.delta = delta
         self.max_diff = max_diff
@@ -39,120 +48,77 @@ class PoseErrorEvaluator:
         self.ape_metric = None
         self.rpe_metric = None
         self.delta_unit =  metric_unit
+        # Optional resultCache.ResultCache, skips unchanged trials
+        self.cache = cache
+        self.trajectory_files = []
+        self.cache_key = None
+        # Per region transforms and residuals of the last piecewise alignment
+        self.align_info = None
 
     @staticmethod
-    def find_align_regions(traj_est, speed_threshold=3, rescale_threshold=5000000): 
-        # 1. Find out regions that is lost tracking
-        zero_indices = np.where(traj_est.speeds == 0.0)[0]
-        lost_regions = []
-        if len(zero_indices) > 0:
-            start = zero_indices[0]
-            end = zero_indices[0]
-
-            for num in zero_indices[1:]:
-                if num == end + 1 :
-                    end = num
-                else:
-                    if(end - start > 1):
-                        lost_regions.append([start,end])
-                    end = num
-                    start = num
-        # 2. Find out moments that has map merge/relocalization
-        shift_checkpoints = np.where(traj_est.speeds>speed_threshold)[0]
-        # 3. Merge the first two regions
-        checkpoints = []
-        checkpoints.append(0)
-        checkpoints.append(traj_est.num_poses-1)
-        lost_checkpoints = []
-        for lost_region in lost_regions:
-            lost_checkpoints.append(lost_region[0])
-            lost_checkpoints.append(lost_region[1])
-        checkpoints = checkpoints + lost_checkpoints
-        checkpoints = checkpoints + list(shift_checkpoints)
-        checkpoints = list(set(checkpoints))
-        checkpoints = sorted(checkpoints)
-        # 4. Add auxilary checkpoints for scale problem
-        aux_checkpoints = []
-        aux_checkpoint = checkpoints[0]
-        for checkpoint in checkpoints[1:]:
-            while(checkpoint - aux_checkpoint > rescale_threshold):
-                aux_checkpoint += rescale_threshold
-                aux_checkpoints.append(aux_checkpoint)
-            aux_checkpoint = checkpoint
-        checkpoints = checkpoints + aux_checkpoints
-        checkpoints = list(set(checkpoints))
-        checkpoints = sorted(checkpoints)
-        # 5. Generate align regions
-        align_regions = []
-        start = checkpoints[0]
-        for idx, checkpoint in enumerate(checkpoints[1:]):
-            if(checkpoint - start <= 1):
-                ## when there are consecutive checkpoints
-                # When start in lost and end in shift, 
-                # they need to be in seperate region
-                if (start in lost_checkpoints and checkpoint in shift_checkpoints):
-                    start = checkpoint
-                # When start in shift and end in shift, 
-                # they need to be in the same region
-                if (start in shift_checkpoints and checkpoint in shift_checkpoints):
-                    pass
-                
-            else:
-                align_regions.append([start, checkpoint])
-                start = checkpoint
-        align_regions_dict = {}
-        align_regions_dict['align_regions'] = align_regions
-        align_regions_dict['lost_regions'] = lost_regions
-        align_regions_dict['shift_checkpoints'] = shift_checkpoints
-        align_regions_dict['aux_checkpoints'] = aux_checkpoints
-        return align_regions_dict
-
-
-
-    def load_trajectory(self, benchmark,trajectory,trial):
-        ref_file = "{}/Datasets/{}/{}/gt/gt_ORB.csv".format(self.root_dir, trajectory, trial)
-        est_file = "{}/Datasets/{}/{}/xr/ORB_traj.csv".format(self.root_dir, trajectory, trial)
-
-        traj_est = file_interface.read_tum_trajectory_file(est_file)
-        traj_ref = file_interface.read_tum_trajectory_file(ref_file)
-
-        align_regions_dict = PoseErrorEvaluator.find_align_regions(traj_est)
-        print("Potential subtrajectories for alignment: {}".format(align_regions_dict['align_regions']))
+    def find_align_regions(traj_est, speed_threshold=3, rescale_threshold=5000000):
+        # Lost tracking, map merge/relocalization and auxiliary rescale
+        # checkpoints, see alignRegions.find_align_regions
+        return alignRegions.find_align_regions(traj_est, speed_threshold, rescale_threshold)
+
+
+
+    def get_trajectory_files(self, trajectory, trial, device="ORBSLAM"):
+        trial_dir = "{}/Datasets/{}/{}".format(self.root_dir, trajectory, trial)
+        if device == "ORBSLAM":
+            return trial_dir + "/gt/gt_ORB.csv", trial_dir + "/xr/ORB_traj.csv"
+        # XR devices: xr/<device>_<timestamp>_updated.csv (post-processed log of
+        # xr/<device>_<timestamp>.csv) with the ground truth gt/<device>_<timestamp>.csv
+        # of the same recording
+        suffix = "_updated.csv"
+        for est_file in sorted(glob.glob("{}/xr/{}_*{}".format(trial_dir, device, suffix))):
+            timestamp = os.path.basename(est_file)[len(device) + 1:-len(suffix)]
+            ref_file = "{}/gt/{}_{}.csv".format(trial_dir, device, timestamp)
+            if os.path.exists(ref_file):
+                return ref_file, est_file
+        raise FileNotFoundError("No {}_<timestamp>{} with its ground truth in {}".format(device, suffix, trial_dir))
+
+    def alignment_params(self):
+        # Everything besides the input files that changes the aligned trajectories
+        return {"stage": "aligned", "max_diff": self.max_diff,
+                "speed_threshold": 3, "rescale_threshold": 5000000}
+
+    def load_trajectory(self, benchmark,trajectory,trial, device="ORBSLAM", traj_est=None, traj_ref=None):
+        # traj_est / traj_ref: the trajectories of the files if already in memory,
+        # e.g. XREVA.traj_est and traj_gt right after process_raw_SLAM_data
+        ref_file, est_file = self.get_trajectory_files(trajectory, trial, device)
+        self.trajectory_files = [ref_file, est_file]
+
+        if self.cache is not None:
+            self.cache_key = self.cache.make_key(self.trajectory_files, self.alignment_params())
+            cached = self.cache.load(self.cache_key)
+            if cached is not None:
+                self.traj_ref = PoseTrajectory3D(cached["ref_xyz"], cached["ref_quat"], cached["ref_time"])
+                self.traj_est = PoseTrajectory3D(cached["est_xyz"], cached["est_quat"], cached["est_time"])
+                print("Loaded cached trajectory ({} poses)  with ground truth {} poses".format(self.traj_est.num_poses,
+                                                                                               self.traj_ref.num_poses))
+                print("="*50)
+                return
+
+        if traj_est is None:
+            traj_est = datasetStore.read_tum_trajectory(est_file)
+        if traj_ref is None:
+            traj_ref = datasetStore.read_tum_trajectory(ref_file)
+
+        if device == "ORBSLAM":
+            align_regions_dict = PoseErrorEvaluator.find_align_regions(traj_est)
+            print("Potential subtrajectories for alignment: {}".format(align_regions_dict['align_regions']))
+        else:
+            # ORB-SLAM3 only: lost tracking and map merges split its trajectory,
+            # the XR device logs are continuous
+            align_regions_dict = {'align_regions': []}
 
         if len(align_regions_dict['align_regions']) > 0:
-            # print("Actual subtrajectories for alignment: {}".format(align_regions))
-            xyz = traj_est._positions_xyz
-            quat = traj_est._orientations_quat_wxyz
-            time = traj_est.timestamps
-            # split trajectory to subtrajectories
-            subtrajectories = []
-            for idx, region in enumerate(align_regions_dict['align_regions']):
-                xyz_sub = xyz[region[0]:region[1], :]
-                xyz_sub[0,:] = xyz_sub[1,:]
-                xyz_sub[-1,:] = xyz_sub[-2,:]
-                
-                quat_sub = quat[region[0]:region[1], :]
-                quat_sub[0,:] = quat_sub[1,:]
-                quat_sub[-1,:] = quat_sub[-2,:]
-
-                # Perform subtrajectory alignment
-                time_sub = time[region[0]:region[1]]
-                traj_sub = PoseTrajectory3D(xyz_sub, quat_sub, time_sub)
-                print("Original estimated subtrajectory length: {}".format(traj_sub.num_poses))
-                try:
-                    traj_ref_copy = file_interface.read_tum_trajectory_file(ref_file) #copy.deepcopy(traj_ref)
-                    traj_ref_copy, traj_sub = sync.associate_trajectories(traj_ref_copy, traj_sub, max_diff=0.05)
-                    
-                    traj_sub.align(traj_ref_copy, correct_scale=True, correct_only_scale=False)
-                    
-                    subtrajectories.append(traj_sub)
-                except Exception as e:
-                    print("subtrajectory alignment failed: {}".format(e))
-                    traj_ref_copy = file_interface.read_tum_trajectory_file(ref_file) #copy.deepcopy(traj_ref)
-                    traj_ref_sub, traj_sub = sync.associate_trajectories(traj_ref_copy, traj_sub, self.max_diff)
-                    subtrajectories.append(traj_ref_sub)
-
-            traj_est_aligned = core.trajectory.merge(subtrajectories)
+            # Every region aligned on its own (Sim(3)), one association for all regions
+            traj_est_aligned, self.align_info = piecewiseAlign.piecewise_align(
+                traj_est, traj_ref, align_regions_dict['regions'], max_diff=0.05, with_scale=True)
+            print("Aligned {} subtrajectories, pairs per region: {}".format(len(self.align_info['regions']),
+                                                                           self.align_info['pairs'].tolist()))
             traj_ref, traj_est_aligned = sync.associate_trajectories(traj_ref, traj_est_aligned, self.max_diff)
 
         else:
@@ -166,6 +132,34 @@ class PoseErrorEvaluator:
         print("Loaded trajectory ({} poses)  with ground truth {} poses".format(traj_est_aligned.num_poses, traj_ref.num_poses))
         print("="*50)
 
+        if self.cache is not None:
+            arrays = {"ref_xyz": traj_ref.positions_xyz, "ref_quat": traj_ref.orientations_quat_wxyz,
+                      "ref_time": traj_ref.timestamps,
+                      "est_xyz": traj_est_aligned.positions_xyz, "est_quat": traj_est_aligned.orientations_quat_wxyz,
+                      "est_time": traj_est_aligned.timestamps}
+            self.cache.save(self.cache_key, arrays, files=self.trajectory_files, params=self.alignment_params())
+
+    def load_cached_metric(self, metric, params):
+        # Restore the error arrays of a metric computed on the same aligned trajectories
+        if self.cache is None or self.cache_key is None:
+            return None, None
+        params = dict(params, aligned=self.cache_key)
+        key = self.cache.make_key([], params)
+        cached = self.cache.load(key)
+        if cached is not None:
+            metric.error = cached["error"]
+            if "delta_ids" in cached:
+                metric.delta_ids = cached["delta_ids"].tolist()
+        return key, cached
+
+    def save_cached_metric(self, key, metric, params):
+        if key is None:
+            return
+        arrays = {"error": np.asarray(metric.error)}
+        if hasattr(metric, "delta_ids"):
+            arrays["delta_ids"] = np.asarray(metric.delta_ids, dtype=np.int64)
+        self.cache.save(key, arrays, files=self.trajectory_files, params=dict(params, aligned=self.cache_key))
+
     def calculate_RE(self, pose_relation = metrics.PoseRelation.translation_part):
         # error metric settings
         #pose_relation = metrics.PoseRelation.translation_part
@@ -177,10 +171,15 @@ class PoseErrorEvaluator:
         # form the (reference, estimation) pair
         data = (self.traj_ref, self.traj_est)
         # load error metric setting
-        rpe_metric = metrics.RPE(pose_relation=pose_relation, delta=self.delta,
-                                delta_unit=self.delta_unit, all_pairs=all_pairs)
-        # calculate the error
-        rpe_metric.process_data(data)
+        rpe_metric = FastRPE(pose_relation=pose_relation, delta=self.delta,
+                             delta_unit=self.delta_unit, all_pairs=all_pairs)
+        params = {"stage": "RPE", "pose_relation": pose_relation.value, "delta": self.delta,
+                  "delta_unit": self.delta_unit.value, "all_pairs": all_pairs}
+        key, cached = self.load_cached_metric(rpe_metric, params)
+        if cached is None:
+            # calculate the error
+            rpe_metric.process_data(data)
+            self.save_cached_metric(key, rpe_metric, params)
         
         self.rpe_metric = rpe_metric
         return rpe_metric
@@ -192,13 +191,32 @@ class PoseErrorEvaluator:
         
         # load error metric setting
         ape_metric = metrics.APE(pose_relation)
-        # calculate the error
-        ape_metric.process_data(data)
+        params = {"stage": "APE", "pose_relation": pose_relation.value}
+        key, cached = self.load_cached_metric(ape_metric, params)
+        if cached is None:
+            # calculate the error
+            ape_metric.process_data(data)
+            self.save_cached_metric(key, ape_metric, params)
 
         self.ape_metric = ape_metric
         return ape_metric
     
-    def save_error_csv(self, trajectory, trial):
+    def calculate_windowed_APE(self, window=10.0, step=None, with_scale=False):
+        """APE of the last window seconds at every pose, every window aligned on its own.
+
+        Args:
+            window (float): window length in seconds
+            step (float): seconds between the windows, default every pose
+            with_scale (bool): Sim(3) instead of SE(3) alignment per window
+        Returns:
+            windowed_ape_df (pd.DataFrame): TimeStamp, APE_window, Pairs
+        """
+        end_times, ape, pairs = onlineAlign.windowed_ape(self.traj_ref.timestamps, self.traj_est.positions_xyz,
+                                                         self.traj_ref.positions_xyz, window, step, with_scale)
+        self.windowed_ape_df = pd.DataFrame({'TimeStamp': end_times, 'APE_window': ape, 'Pairs': pairs})
+        return self.windowed_ape_df
+
+    def save_error_csv(self, trajectory, trial, device="ORBSLAM"):
         # save both the APE and RPE with timestamp to csv
         # Save the error values with time stamps
         timestamps = self.traj_ref.timestamps
@@ -214,42 +232,24 @@ class PoseErrorEvaluator:
 
         # Creating the pandas DataFrame
         self.error_df = pd.DataFrame({name: array for name, array in zip(column_names, arrays)})
-        self.error_df.to_csv('{}/Datasets/{}/{}/ORBSLAM_error.csv'.format(self.root_dir,trajectory, trial), index=False)
+        datasetStore.write_csv(self.error_df, '{}/Datasets/{}/{}/{}_error.csv'.format(self.root_dir,trajectory, trial, device), index=False)
 
         
     # Interpolate consecutive null values up to max_null_length
     @staticmethod
     def interpolate_consecutive_nulls(column_df, max_null_length=10):
-        column = copy.deepcopy(column_df)
-        is_null = column.isnull()
-        consecutive_nulls = 0
-        for i in range(len(column)):
-            if is_null[i]:
-                consecutive_nulls += 1
-            else:
-                # igonre long null sequence
-                if consecutive_nulls >= max_null_length:
-                    consecutive_nulls = 0
-                elif consecutive_nulls > 0:
-                    # Interpolate using linear method for consecutive null values
-                    column[i - consecutive_nulls:i] = np.linspace(column[i - consecutive_nulls - 1], column[i], consecutive_nulls + 2)[1:-1]
-                consecutive_nulls = 0
-        return column
-
-
-    def merge_feature_with_label(self, benchmark, trajectory, trial):
-        # load feature
-        feature_df = pd.read_csv("{}/Datasets/{}/{}/xr/ORB_log.csv".format(self.root_dir, trajectory, trial))
+        return gapFill.fill_series(column_df, max_null_length)
+
+
+    def merge_feature_with_label(self, benchmark, trajectory, trial, feature_df=None):
+        # load feature, unless given (the ORB_log.csv rows of process_raw_SLAM_data)
+        if feature_df is None:
+            feature_df = datasetStore.read_csv("{}/Datasets/{}/{}/xr/ORB_log.csv".format(self.root_dir, trajectory, trial))
 
         error_df = self.error_df
-        # merge feature
-        merged_df = pd.merge_asof(feature_df, error_df , on='TimeStamp', tolerance=self.max_diff)
-        # move label to the front
-        # Column to move to the first position
-        columns_to_move = ['RPE', 'APE']
-        # Reorder the columns
-        new_columns = columns_to_move + [col for col in merged_df.columns if col not in columns_to_move]
-        merged_df = merged_df[new_columns]
+        # merge feature, labels first
+        merged_df = mergeStreams.merge_streams(feature_df, {mergeStreams.ORB_STREAM: error_df[['TimeStamp', 'RPE', 'APE']]},
+                                               tolerance=self.max_diff)
         # merged_df["RelativeError"] = PoseErrorEvaluator.interpolate_consecutive_nulls(merged_df["RelativeError"], 
         #                                                                               self.max_null_length)
         self.merged_df = merged_df
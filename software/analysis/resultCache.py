@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+
+class ResultCache:
+    """On-disk cache for aligned trajectories and error arrays.
+
+    Entries are content addressed: the key is a hash over the content of the
+    input files plus the evaluation parameters, so an entry is reused as long
+    as neither changed. Every entry is a single .npz file, written atomically
+    so that parallel workers can share one cache folder. The folder is kept
+    below max_bytes by evicting the least recently used entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # file path -> (size, mtime, digest) of files hashed by this process
+        self.file_digests = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_digest(self, file_path):
+        stat = os.stat(file_path)
+        memo = self.file_digests.get(file_path)
+        if memo is not None and memo[:2] == (stat.st_size, stat.st_mtime_ns):
+            return memo[2]
+        sha = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self.file_digests[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def make_key(self, files, params):
+        """Key of the given input files (by content) and parameters.
+
+        Args:
+            files (list): input file paths, order matters
+            params (dict): json-serializable evaluation parameters
+        Returns:
+            key (str): hex digest
+        """
+        sha = hashlib.sha1()
+        for file_path in files:
+            sha.update(self.file_digest(file_path).encode())
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def contains(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    def load(self, key):
+        """Return the cached arrays of key as a dict, None on a miss."""
+        entry_path = self.entry_path(key)
+        try:
+            with np.load(entry_path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files if name != "_meta"}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        # Touch the entry for the LRU eviction
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return arrays
+
+    def save(self, key, arrays, files=(), params=None):
+        """Store a dict of arrays under key and evict old entries if needed."""
+        meta = {"files": list(files), "params": params}
+        tmp_path = "{}.{}.tmp".format(self.entry_path(key), os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, _meta=np.array(json.dumps(meta, default=str)), **arrays)
+        os.replace(tmp_path, self.entry_path(key))
+        self.evict()
+
+    def entries(self):
+        # (last access, size, path) of all entries, oldest first
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".npz"):
+                continue
+            entry_path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def invalidate(self, key=None, match=None):
+        """Remove cache entries.
+
+        Args:
+            key (str): remove this entry only
+            match (str): remove entries with an input file path containing match
+            With neither given, the whole cache is cleared.
+        Returns:
+            removed (int): number of removed entries
+        """
+        if key is not None:
+            entry_paths = [self.entry_path(key)]
+        else:
+            entry_paths = [entry_path for _, _, entry_path in self.entries()]
+        removed = 0
+        for entry_path in entry_paths:
+            if match is not None:
+                try:
+                    with np.load(entry_path, allow_pickle=False) as data:
+                        meta = json.loads(str(data["_meta"]))
+                except (FileNotFoundError, OSError, ValueError, KeyError):
+                    continue
+                if not any(match in file_path for file_path in meta["files"]):
+                    continue
+            try:
+                os.remove(entry_path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the evaluation result cache")
+    parser.add_argument("command", choices=["info", "invalidate"])
+    parser.add_argument("--dir", default="../cache", help="Cache folder")
+    parser.add_argument("--key", default=None, help="Invalidate a single entry")
+    parser.add_argument("--match", default=None, help="Invalidate entries whose input path contains this string")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.dir)
+    if args.command == "info":
+        entries = cache.entries()
+        print("{} entries, {:.1f} MB in {}".format(len(entries),
+                                                   sum(size for _, size, _ in entries) / 1024**2,
+                                                   args.dir))
+    else:
+        removed = cache.invalidate(key=args.key, match=args.match)
+        print("Removed {} entries from {}".format(removed, args.dir))
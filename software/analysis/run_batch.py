@@ -0,0 +1,173 @@
+import os
+import io
+import time
+import argparse
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from evo.core import metrics
+
+import benchmarks as bm
+import datasetStore
+import gapFill
+import mergeStreams
+
+
+def build_tasks(root_dir, benchmark="XREVA", Set="S1", devices=("ORBSLAM",)):
+    # One task per trajectory x trial x device, in generate_script order
+    sets = ["S1", "S2"] if Set == "all" else [Set]
+    benchmarkObject = bm.benchmark_factory[benchmark](root_dir)
+    tasks = []
+    for deviceSet in sets:
+        benchmarkObject.generate_script(Set=deviceSet)
+        for scriptDict in benchmarkObject.get_script():
+            for device in devices:
+                tasks.append({
+                    "benchmark": scriptDict["benchmark"],
+                    "trajectory": scriptDict["trajectory"],
+                    "trial": scriptDict["trial"],
+                    "device": device,
+                })
+    return tasks
+
+
+def evaluate_task(task, root_dir, delta=0.1, metric_unit=metrics.Unit.meters,
+                  max_diff=0.05, max_null_length=10, cache_dir=None, verbose=False):
+    """Load, align and evaluate a single trajectory/trial/device.
+
+    Runs inside a worker process, every failure is caught and reported in
+    the returned result so that one bad trial does not stop the batch.
+
+    Args:
+        task (dict): benchmark, trajectory, trial and device names
+        root_dir (str): dataset root holding the Datasets folder
+        cache_dir (str): optional resultCache folder shared by all workers
+    Returns:
+        result (dict): task fields plus status, pose count, APE/RPE rmse,
+                       wall time and the error message of failed tasks
+    """
+    # Imported here so that the evo logging setup happens per worker
+    from poseEvaluation import PoseErrorEvaluator
+    from resultCache import ResultCache
+
+    result = dict(task)
+    result.update({"status": "done", "poses": 0, "APE_rmse": np.nan,
+                   "RPE_rmse": np.nan, "seconds": 0.0, "error": ""})
+    start_time = time.time()
+
+    benchmark, trajectory = task["benchmark"], task["trajectory"]
+    trial, device = task["trial"], task["device"]
+    trial_dir = "{}/Datasets/{}/{}".format(root_dir, trajectory, trial)
+    if not os.path.exists(trial_dir):
+        result["status"] = "skipped"
+        result["error"] = "Folder not exists"
+        return result
+
+    output = io.StringIO()
+    try:
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(output):
+            cache = ResultCache(cache_dir) if cache_dir is not None else None
+            poseErrorEvaluator = PoseErrorEvaluator(root_dir, metric_unit=metric_unit, delta=delta,
+                                                    max_diff=max_diff, max_null_length=max_null_length,
+                                                    cache=cache)
+            poseErrorEvaluator.load_trajectory(benchmark, trajectory, trial, device=device)
+            rpe_metric = poseErrorEvaluator.calculate_RE(pose_relation=metrics.PoseRelation.point_distance)
+            ape_metric = poseErrorEvaluator.calculate_APE(pose_relation=metrics.PoseRelation.point_distance)
+            poseErrorEvaluator.save_error_csv(trajectory=trajectory, trial=trial, device=device)
+
+            # The XR device errors join the ORB_log.csv features in merge_results only
+            if device == "ORBSLAM":
+                poseErrorEvaluator.merge_feature_with_label(benchmark, trajectory, trial)
+                merged_df = poseErrorEvaluator.get_feature_w_label()
+                datasetStore.write_csv(merged_df, "{}/orb_combined.csv".format(trial_dir), sep=',', index=False,
+                                       header=True)
+
+        result["poses"] = poseErrorEvaluator.traj_est.num_poses
+        result["APE_rmse"] = ape_metric.get_statistic(metrics.StatisticsType.rmse)
+        result["RPE_rmse"] = rpe_metric.get_statistic(metrics.StatisticsType.rmse)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        if verbose:
+            traceback.print_exc()
+    result["seconds"] = time.time() - start_time
+    return result
+
+
+def run_batch(root_dir, benchmark="XREVA", Set="S1", devices=("ORBSLAM",), workers=None, **kwargs):
+    """Evaluate all tasks of a set over a process pool.
+
+    Args:
+        root_dir (str): dataset root holding the Datasets folder
+        benchmark (str): key of benchmarks.benchmark_factory
+        Set (str): "S1", "S2" or "all"
+        devices (list): devices to evaluate for every trial
+        workers (int): number of worker processes, default is the cpu count
+        kwargs: forwarded to evaluate_task (delta, max_diff, ...)
+    Returns:
+        summary (pd.DataFrame): one row per task in task order
+    """
+    tasks = build_tasks(root_dir, benchmark, Set, devices)
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(evaluate_task, task, root_dir, **kwargs): idx
+                   for idx, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                # The worker process itself died
+                results[idx] = dict(tasks[idx], status="failed", error="{}: {}".format(type(e).__name__, e))
+            print("[{}/{}] {}-{}-{} {}".format(sum(r is not None for r in results), len(tasks),
+                                              tasks[idx]["trajectory"], tasks[idx]["trial"],
+                                              tasks[idx]["device"], results[idx]["status"]))
+
+    columns = ["benchmark", "trajectory", "trial", "device", "status",
+               "poses", "APE_rmse", "RPE_rmse", "seconds", "error"]
+    return pd.DataFrame(results, columns=columns)
+
+
+def merge_results(root_dir, summary, max_diff=0.05, max_null_length=10):
+    # merge_result.csv and merge_result_filled.csv of every trial with an evaluated device
+    done = summary[summary["status"] == "done"]
+    for (trajectory, trial), group in done.groupby(["trajectory", "trial"], sort=False):
+        trial_dir = "{}/Datasets/{}/{}".format(root_dir, trajectory, trial)
+        try:
+            mergeStreams.merge_trial(trial_dir, devices=list(group["device"]), tolerance=max_diff)
+            gapFill.fill_file("{}/merge_result.csv".format(trial_dir), max_null_length=max_null_length)
+        except Exception as e:
+            print("Merging {}-{} failed: {}: {}".format(trajectory, trial, type(e).__name__, e))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate all trajectories, trials and devices in parallel")
+    parser.add_argument("--root", default="..", help="Dataset root holding the Datasets folder")
+    parser.add_argument("--benchmark", default="XREVA", choices=list(bm.benchmark_factory.keys()))
+    parser.add_argument("--set", default="S1", choices=["S1", "S2", "all"], help="Trajectory set")
+    parser.add_argument("--devices", nargs="+", default=["ORBSLAM"], help="Devices to evaluate")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--delta", type=float, default=0.1, help="RPE delta in meters")
+    parser.add_argument("--max-diff", type=float, default=0.05, help="Max timestamp difference for association")
+    parser.add_argument("--cache", default=None, help="Result cache folder, unchanged trials are not recomputed")
+    parser.add_argument("--merge", action="store_true",
+                        help="Write merge_result.csv and merge_result_filled.csv of the evaluated trials")
+    parser.add_argument("--summary", default=None, help="Optional csv path for the summary table")
+    parser.add_argument("--verbose", action="store_true", help="Print the evaluator output of every task")
+    args = parser.parse_args()
+
+    summary = run_batch(args.root, args.benchmark, args.set, args.devices, args.workers,
+                        delta=args.delta, max_diff=args.max_diff, cache_dir=args.cache, verbose=args.verbose)
+
+    print("=" * 50)
+    print(summary.drop(columns=["benchmark"]).to_string(index=False))
+    print("=" * 50)
+    print(summary["status"].value_counts().to_string())
+    if args.merge:
+        merge_results(args.root, summary, args.max_diff)
+    if args.summary is not None:
+        summary.to_csv(args.summary, index=False)
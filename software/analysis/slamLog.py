@@ -0,0 +1,144 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from evo.core.trajectory import PoseTrajectory3D
+
+import datasetStore
+
+# logs/log.csv of the customized ORB-SLAM3 examples: one row per frame with
+# the pose (TUM order), the tracking state and the per-frame features
+POSE_COLUMNS = ["TimeStamp", "PX", "PY", "PZ", "QX", "QY", "QZ", "QW"]
+TRACK_COLUMN = "TrackMode"
+# Frames with TrackMode 2 are tracked, the others are initialization
+TRACKING_OK = 2
+LOG_FILE = "ORB_log.csv"
+TRAJ_FILE = "ORB_traj.csv"
+# The raw log runs on the RealSense clock of the sensor folder (images, imu),
+# ORB_log.csv and ORB_traj.csv on the ground truth clock. The shift between
+# them is saved next to them so the other sensor streams can follow.
+OFFSET_FILE = "ORB_offset.json"
+
+
+def read_header(log_file):
+    with open(log_file, "r") as f:
+        return f.readline().rstrip("\r\n").split(",")
+
+
+def last_timestamp(log_file, column="TimeStamp", tail_bytes=65536):
+    """TimeStamp of the last row of a log, read from the end of the file.
+
+    Falls back to a pass over the TimeStamp column only when the last line
+    cannot be parsed.
+    """
+    index = read_header(log_file).index(column)
+    with open(log_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - tail_bytes, 0))
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    try:
+        return float(lines[-1].decode().split(",")[index])
+    except (IndexError, ValueError):
+        return pd.read_csv(log_file, usecols=[column], dtype={column: np.float64})[column].iloc[-1]
+
+
+def write_time_offset(output_dir, offset, log_file):
+    tmp_path = os.path.join(output_dir, "{}.{}.tmp".format(OFFSET_FILE, os.getpid()))
+    with open(tmp_path, "w") as f:
+        json.dump({"offset": float(offset), "log_file": os.path.abspath(log_file)}, f, indent=2)
+    os.replace(tmp_path, os.path.join(output_dir, OFFSET_FILE))
+
+
+def read_time_offset(trial_dir):
+    """Offset in seconds from the RealSense clock of sensor/ to the clock of ORB_log.csv.
+
+    Raises:
+        FileNotFoundError: the trial was not processed by process_slam_log
+    """
+    offset_file = os.path.join(trial_dir, "xr", OFFSET_FILE)
+    try:
+        with open(offset_file, "r") as f:
+            return float(json.load(f)["offset"])
+    except FileNotFoundError:
+        raise FileNotFoundError("No time offset {}, run process_raw_SLAM_data for the trial first".format(
+            offset_file))
+
+
+def process_slam_log(log_file, output_dir, gt_first_timestamp, gt_last_timestamp, columns=None, chunksize=100000):
+    """Write ORB_log.csv and ORB_traj.csv of a raw ORB-SLAM3 log in one streaming pass.
+
+    The timestamps are shifted so that the last row of the log meets the
+    last ground truth timestamp, the offset comes from the end of the file.
+    The log is then read in chunks with typed pose columns, the tracked
+    rows at or after the first ground truth timestamp are selected with
+    one mask per chunk and appended to both files. The files are written
+    under a temporary name and renamed at the end, existing table and
+    trajectory bundles (datasetStore) are refreshed. The offset is saved
+    to ORB_offset.json (see read_time_offset).
+
+    Args:
+        log_file (str): logs/log.csv of the run
+        output_dir (str): xr folder of the trial
+        gt_first_timestamp, gt_last_timestamp (float): ground truth time range
+        columns (list): feature columns kept in ORB_log.csv, default all
+        chunksize (int): rows per chunk
+    Returns:
+        log_df (pd.DataFrame): rows of ORB_log.csv
+        traj (PoseTrajectory3D): ORB_traj.csv
+    """
+    header = read_header(log_file)
+    if columns is not None:
+        keep = set(POSE_COLUMNS) | {TRACK_COLUMN} | set(columns)
+        header = [col for col in header if col in keep]
+    offset = gt_last_timestamp - last_timestamp(log_file)
+
+    log_path = os.path.join(output_dir, LOG_FILE)
+    traj_path = os.path.join(output_dir, TRAJ_FILE)
+    tmp_log_path = "{}.{}.tmp".format(log_path, os.getpid())
+    tmp_traj_path = "{}.{}.tmp".format(traj_path, os.getpid())
+    chunks = []
+    reader = pd.read_csv(log_file, index_col=False, usecols=header, chunksize=chunksize,
+                         dtype={col: np.float64 for col in POSE_COLUMNS})
+    with open(tmp_log_path, "w") as log_out, open(tmp_traj_path, "w") as traj_out:
+        for idx, chunk in enumerate(reader):
+            chunk["TimeStamp"] += offset
+            chunk = chunk[(chunk[TRACK_COLUMN] == TRACKING_OK) & (chunk["TimeStamp"] >= gt_first_timestamp)]
+            chunk.to_csv(log_out, index=False, header=(idx == 0))
+            chunk[POSE_COLUMNS].to_csv(traj_out, sep=" ", index=False, header=False)
+            chunks.append(chunk)
+        if len(chunks) == 0:
+            # Header only log
+            pd.DataFrame(columns=header).to_csv(log_out, index=False)
+    os.replace(tmp_log_path, log_path)
+    os.replace(tmp_traj_path, traj_path)
+    write_time_offset(output_dir, offset, log_file)
+
+    log_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=header)
+    poses = log_df[POSE_COLUMNS].to_numpy(dtype=np.float64)
+    # TUM qx qy qz qw -> wxyz as in file_interface.read_tum_trajectory_file
+    traj = PoseTrajectory3D(poses[:, 1:4], np.roll(poses[:, 4:8], 1, axis=1), poses[:, 0])
+
+    meta = datasetStore.read_meta(datasetStore.bundle_path(log_path))
+    if meta is not None and meta["kind"] == "table":
+        datasetStore.write_table_bundle(log_path, log_df)
+    if os.path.exists(datasetStore.bundle_path(traj_path)):
+        datasetStore.write_trajectory_bundle(traj_path, traj)
+    return log_df, traj
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write ORB_log.csv and ORB_traj.csv of a raw ORB-SLAM3 log")
+    parser.add_argument("log_file", help="logs/log.csv of the run")
+    parser.add_argument("trial_dir", help="Datasets/<trajectory>/<trial> folder with gt/gt_ORB.csv")
+    parser.add_argument("--columns", nargs="+", default=None, help="Feature columns to keep, default all")
+    parser.add_argument("--chunksize", type=int, default=100000, help="Rows per chunk")
+    args = parser.parse_args()
+
+    traj_gt = datasetStore.read_tum_trajectory(os.path.join(args.trial_dir, "gt", "gt_ORB.csv"))
+    log_df, traj = process_slam_log(args.log_file, os.path.join(args.trial_dir, "xr"), traj_gt.timestamps[0],
+                                    traj_gt.timestamps[-1], args.columns, args.chunksize)
+    print("{}: {} tracked rows, {:.1f} s".format(args.log_file, len(log_df),
+                                                traj.timestamps[-1] - traj.timestamps[0] if len(log_df) else 0.0))
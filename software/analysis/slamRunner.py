@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import queue
+import shlex
+import signal
+import resource
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import benchmarks as bm
+
+# The customized ORB-SLAM3 examples write logs/log.csv (and logs/distribution/)
+# below their working directory. Every job runs in its own folder
+# {root}/runs/<trajectory>/<trial>/run<repeat>/ so that runs can overlap.
+LOG_FILE = os.path.join("logs", "log.csv")
+RUNS_DIR = "runs"
+MANIFEST_FILE = "manifest.json"
+# ulimit -s 64000 of the notebook, in bytes
+STACK_LIMIT = 64000 * 1024
+
+
+def build_jobs(root_dir, benchmark="XREVA", Set="S1", repeats=1):
+    # One job per trajectory x trial x repeat, in generate_script order
+    root_dir = os.path.abspath(root_dir)
+    sets = ["S1", "S2"] if Set == "all" else [Set]
+    benchmarkObject = bm.benchmark_factory[benchmark](root_dir)
+    jobs = []
+    for deviceSet in sets:
+        benchmarkObject.generate_script(Set=deviceSet)
+        for scriptDict in benchmarkObject.get_script():
+            for repeat in range(repeats):
+                job_id = "{}/{}/run{}".format(scriptDict["trajectory"], scriptDict["trial"], repeat)
+                jobs.append({
+                    "id": job_id,
+                    "benchmark": scriptDict["benchmark"],
+                    "trajectory": scriptDict["trajectory"],
+                    "trial": scriptDict["trial"],
+                    "repeat": repeat,
+                    "command": shlex.split(scriptDict["script"]),
+                    "work_dir": os.path.join(root_dir, RUNS_DIR, job_id),
+                    "status": "pending", "attempts": 0, "exit_code": None, "seconds": 0.0,
+                    "peak_rss_mb": 0.0, "cpus": [], "processed": False, "error": "",
+                })
+    return jobs
+
+
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)["jobs"]
+    except FileNotFoundError:
+        return []
+
+
+def write_manifest(manifest_path, jobs):
+    # Written atomically, an interrupted scheduler leaves the last complete manifest
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"jobs": jobs}, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def resume_jobs(jobs, previous):
+    # Keep the state of the jobs of an earlier run, done jobs whose log is gone run again
+    state = ["status", "attempts", "exit_code", "seconds", "peak_rss_mb", "cpus", "processed", "error"]
+    known = {job["id"]: job for job in previous}
+    for job in jobs:
+        if job["id"] in known:
+            job.update({key: known[job["id"]][key] for key in state if key in known[job["id"]]})
+        if job["status"] == "done" and not os.path.exists(os.path.join(job["work_dir"], LOG_FILE)):
+            job.update(status="pending", processed=False)
+    return jobs
+
+
+def cpu_slots(workers, cpus_per_job=None):
+    # CPU set of every worker slot, None without pinning
+    if not cpus_per_job:
+        return [None] * workers
+    available = sorted(os.sched_getaffinity(0))
+    count = min(workers, max(len(available) // cpus_per_job, 1))
+    return [available[idx * cpus_per_job:(idx + 1) * cpus_per_job] or available for idx in range(count)]
+
+
+def limited_command(command, cpus=None):
+    """command prefixed with prlimit (stack limit) and taskset (CPU pinning).
+
+    Both are set by util-linux tools that exec the job, run_job starts jobs
+    from worker threads where a preexec_fn is not safe. The stack limit
+    must be in place before the exec of ORB-SLAM3, its threads take their
+    stack size from it.
+    """
+    hard = resource.getrlimit(resource.RLIMIT_STACK)[1]
+    soft = STACK_LIMIT if hard == resource.RLIM_INFINITY else min(STACK_LIMIT, hard)
+    prefix = ["prlimit", "--stack={}:".format(soft)]
+    if cpus:
+        prefix += ["taskset", "--cpu-list", ",".join(str(cpu) for cpu in cpus)]
+    return prefix + list(command)
+
+
+def wait_process(process, timeout=None):
+    """Wait for a process, killing its process group after timeout seconds.
+
+    os.wait4 reaps the process together with its resource usage, the peak
+    RSS is ru_maxrss.
+
+    Returns:
+        exit_code (int): negative signal number for killed processes
+        rusage (resource.struct_rusage)
+        timed_out (bool)
+    """
+    deadline = time.time() + timeout if timeout else None
+    timed_out = False
+    while True:
+        pid, status, rusage = os.wait4(process.pid, 0 if timed_out else os.WNOHANG)
+        if pid != 0:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, rusage, timed_out
+        if deadline is not None and time.time() > deadline:
+            os.killpg(process.pid, signal.SIGKILL)
+            timed_out = True
+            continue
+        time.sleep(0.1)
+
+
+def run_job(job, cpus=None, timeout=240):
+    """Run one ORB-SLAM3 job in its work_dir, stdout/stderr go to files there.
+
+    As with tools.runCommand, a non-zero exit status (ORB-SLAM3 often
+    crashes at shutdown) is recorded but the run counts as done as long as
+    it wrote its log. Timeouts and runs without a log fail.
+
+    Args:
+        job (dict): entry of build_jobs
+        cpus (list): CPU ids the job is pinned to, default no pinning
+        timeout (float): seconds before the job is killed
+    Returns:
+        result (dict): status, exit_code, seconds, peak_rss_mb, cpus and error
+    """
+    work_dir = job["work_dir"]
+    os.makedirs(os.path.join(work_dir, "logs", "distribution"), exist_ok=True)
+    log_file = os.path.join(work_dir, LOG_FILE)
+    # A log of an earlier attempt must not pass for this one
+    if os.path.exists(log_file):
+        os.remove(log_file)
+
+    start_time = time.time()
+    with open(os.path.join(work_dir, "stdout.txt"), "wb") as stdout, \
+            open(os.path.join(work_dir, "stderr.txt"), "wb") as stderr:
+        process = subprocess.Popen(limited_command(job["command"], cpus), cwd=work_dir, stdout=stdout,
+                                   stderr=stderr, start_new_session=True)
+        exit_code, rusage, timed_out = wait_process(process, timeout)
+
+    result = {"status": "done", "exit_code": exit_code, "seconds": time.time() - start_time,
+              "peak_rss_mb": rusage.ru_maxrss / 1024.0, "cpus": list(cpus or []), "error": ""}
+    if timed_out:
+        result.update(status="failed", error="timeout after {} s".format(timeout))
+    elif not os.path.exists(log_file) or os.path.getsize(log_file) == 0:
+        result.update(status="failed", error="exit code {}, no {}".format(exit_code, LOG_FILE))
+    elif exit_code != 0:
+        result["error"] = "exit code {}".format(exit_code)
+    return result
+
+
+def process_job(benchmarkObject, job):
+    # ORB_log.csv and ORB_traj.csv of a finished job: the first repeat goes to the
+    # xr folder of the trial, the other repeats to the xr folder of their run
+    output_dir = None if job["repeat"] == 0 else os.path.join(job["work_dir"], "xr")
+    benchmarkObject.copy_ground_truth_traj(job["trajectory"], job["trial"])
+    benchmarkObject.process_raw_SLAM_data(job["benchmark"], job["trajectory"], job["trial"],
+                                          log_file=os.path.join(job["work_dir"], LOG_FILE),
+                                          output_dir=output_dir)
+
+
+def run_jobs(jobs, manifest_path, workers=None, cpus_per_job=None, timeout=240, retries=1, benchmarkObject=None):
+    """Run the pending and failed jobs concurrently and record them in the manifest.
+
+    The jobs are external processes, the worker threads only start and
+    wait for them. Every worker slot owns a fixed CPU set with
+    cpus_per_job. A failed job is retried up to retries times, the
+    manifest is rewritten after every job so that an interrupted schedule
+    resumes with the unfinished jobs.
+
+    Args:
+        jobs (list): build_jobs entries, updated in place
+        manifest_path (str): json manifest
+        workers (int): concurrent jobs, default is the cpu count
+        cpus_per_job (int): pin every job to this many CPUs, default no pinning
+        timeout (float): seconds before a job is killed
+        retries (int): extra attempts of a failed job
+        benchmarkObject: if given, process_job is run for every done job
+    Returns:
+        jobs (list)
+    """
+    slots = cpu_slots(workers or os.cpu_count(), cpus_per_job)
+    free_slots = queue.Queue()
+    for slot in slots:
+        free_slots.put(slot)
+
+    def attempt(job):
+        cpus = free_slots.get()
+        try:
+            for _ in range(retries + 1):
+                job["attempts"] += 1
+                job.update(run_job(job, cpus, timeout))
+                if job["status"] == "done":
+                    break
+        finally:
+            free_slots.put(cpus)
+        return job
+
+    todo = []
+    for job in jobs:
+        if job["status"] == "done":
+            continue
+        # The dataset folder of the trial must exist, as in the notebook
+        if not os.path.exists(job["command"][-1]):
+            job.update(status="skipped", error="{} not found".format(job["command"][-1]))
+            continue
+        todo.append(job)
+    print("{} jobs, {} to run on {} slots".format(len(jobs), len(todo), len(slots)))
+
+    with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+        futures = {pool.submit(attempt, job): job for job in todo}
+        for done, future in enumerate(as_completed(futures)):
+            job = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                job.update(status="failed", error="{}: {}".format(type(e).__name__, e))
+            print("[{}/{}] {} {} {:.1f} s {:.0f} MB attempt {} {}".format(
+                done + 1, len(todo), job["id"], job["status"], job["seconds"], job["peak_rss_mb"],
+                job["attempts"], job["error"]))
+            write_manifest(manifest_path, jobs)
+
+    # Post-processing reads small logs, done here in order
+    if benchmarkObject is not None:
+        for job in jobs:
+            if job["status"] != "done" or job["processed"]:
+                continue
+            try:
+                process_job(benchmarkObject, job)
+                job["processed"] = True
+            except Exception as e:
+                print("Processing {} failed: {}: {}".format(job["id"], type(e).__name__, e))
+        write_manifest(manifest_path, jobs)
+    return jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ORB-SLAM3 on all trajectories and trials in parallel")
+    parser.add_argument("--root", default="..", help="Root holding the ORB-SLAM3 build and the Datasets folder")
+    parser.add_argument("--benchmark", default="XREVA", choices=list(bm.benchmark_factory.keys()))
+    parser.add_argument("--set", default="S1", choices=["S1", "S2", "all"], help="Trajectory set")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per trial")
+    parser.add_argument("--workers", type=int, default=None, help="Concurrent jobs, default the cpu count")
+    parser.add_argument("--cpus-per-job", type=int, default=None, help="Pin every job to this many CPUs")
+    parser.add_argument("--timeout", type=float, default=240, help="Seconds before a job is killed")
+    parser.add_argument("--retries", type=int, default=1, help="Extra attempts of a failed job")
+    parser.add_argument("--manifest", default=None, help="Job manifest, default {root}/runs/manifest.json")
+    parser.add_argument("--restart", action="store_true", help="Ignore the manifest of an earlier run")
+    parser.add_argument("--process", action="store_true",
+                        help="Write ORB_log.csv and ORB_traj.csv of the done jobs")
+    args = parser.parse_args()
+
+    manifest_path = args.manifest or os.path.join(args.root, RUNS_DIR, MANIFEST_FILE)
+    jobs = build_jobs(args.root, args.benchmark, args.set, args.repeats)
+    if not args.restart:
+        jobs = resume_jobs(jobs, read_manifest(manifest_path))
+    benchmarkObject = bm.benchmark_factory[args.benchmark](os.path.abspath(args.root)) if args.process else None
+    jobs = run_jobs(jobs, manifest_path, args.workers, args.cpus_per_job, args.timeout, args.retries,
+                    benchmarkObject)
+
+    statuses = [job["status"] for job in jobs]
+    print("=" * 50)
+    for status in sorted(set(statuses)):
+        print("{}: {}".format(status, statuses.count(status)))
@@ -0,0 +1,73 @@
+import os
+import json
+
+# Sync report written by server.py in the probe sync mode:
+# {"syncs": [{"device": ..., "time": ROS time, "offset": device clock minus
+#             ROS time, "drift": s/s, "uncertainty": s, "est_offset": ...}, ...]}
+# est_offset is the offset to add to the timestamps the device app logged
+# (already corrected with its own average) to get ROS time.
+SYNC_REPORT_FILE = "sync_report.json"
+
+
+def load_sync_report(report_file):
+    with open(report_file, "r") as f:
+        return json.load(f)
+
+
+def find_sync_report(start_dir, levels=3):
+    """Path of the closest sync_report.json in start_dir or its parents, None if there is none"""
+    folder = os.path.abspath(start_dir)
+    for _ in range(levels + 1):
+        report_file = os.path.join(folder, SYNC_REPORT_FILE)
+        if os.path.exists(report_file):
+            return report_file
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            break
+        folder = parent
+    return None
+
+
+def device_sync(report, device_name, timestamp=None):
+    """Sync entry of a device for a trajectory starting at timestamp.
+
+    Args:
+        report (dict or str): loaded report, report file or a folder to
+                              search with find_sync_report
+        device_name (str): e.g. "MagicLeap2"
+        timestamp (float): ROS time, the latest sync before it is used.
+                           Default is the latest sync of the device.
+    Returns:
+        entry (dict): None if the device was not synced
+    """
+    if isinstance(report, str):
+        report_file = find_sync_report(report) if os.path.isdir(report) else report
+        if report_file is None or not os.path.exists(report_file):
+            return None
+        report = load_sync_report(report_file)
+    entries = [entry for entry in report.get("syncs", []) if entry["device"] == device_name]
+    if timestamp is not None:
+        before = [entry for entry in entries if entry["time"] <= timestamp]
+        # A trajectory logged before any sync can only use the first one
+        entries = before or entries[:1]
+    if not entries:
+        return None
+    return max(entries, key=lambda entry: entry["time"])
+
+
+def expected_offset(entry, timestamp=None):
+    """Offset to add to the device timestamps at timestamp, from a sync entry.
+
+    The device apps apply a constant correction, so the drift since the sync
+    remains in the logged timestamps.
+    """
+    if timestamp is None:
+        return entry["est_offset"]
+    return entry["est_offset"] - entry["drift"] * (timestamp - entry["time"])
+
+
+def offset_search_range(entry, timestamp=None, sigmas=3.0, min_half_width=0.05):
+    """(lower, upper) offset search range around the expected offset"""
+    center = expected_offset(entry, timestamp)
+    half_width = max(sigmas * entry["uncertainty"], min_half_width)
+    return center - half_width, center + half_width
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import imuFeatures  # noqa: E402
+
+
+def imu_log(n=1000, rate=imuFeatures.IMU_RATE):
+    rng = np.random.default_rng(0)
+    return np.arange(n) / rate, rng.normal(size=(n, 3)), rng.normal(size=(n, 3))
+
+
+def test_window_features_past_end_of_log():
+    timestamps, gyro, acc = imu_log()
+    query_times = np.array([timestamps[-1] - 1.0, timestamps[-1] + 0.4, timestamps[-1] + 0.6, timestamps[-1] + 5.0])
+    features = imuFeatures.window_features(timestamps, gyro, acc, query_times, 0.5)
+    for name, values in features.items():
+        assert len(values) == len(query_times)
+        assert np.isfinite(values[0]), name
+        # No sample in the window
+        assert np.all(np.isnan(values[2:])), name
+    assert np.isfinite(features["JerkRMS"][1])
+
+
+def test_window_features_before_start_of_log():
+    timestamps, gyro, acc = imu_log()
+    features = imuFeatures.window_features(timestamps, gyro, acc, np.array([timestamps[0] - 1.0]), 0.5)
+    assert np.isnan(features["JerkRMS"][0]) and np.isnan(features["AngSpeedRMS"][0])
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import benchmarks as bm  # noqa: E402
+from poseEvaluation import PoseErrorEvaluator  # noqa: E402
+from resultCache import ResultCache  # noqa: E402
+
+
+def make_trial(root_dir, trajectory="S1_Petrol_Featurerich_50", trial="set1"):
+    trial_dir = os.path.join(str(root_dir), "Datasets", trajectory, trial)
+    for folder, name in [("gt", "gt_ORB.csv"), ("xr", "ORB_traj.csv")]:
+        os.makedirs(os.path.join(trial_dir, folder))
+        with open(os.path.join(trial_dir, folder, name), "w") as f:
+            f.write("0.0 0 0 0 0 0 0 1\n0.1 {} 0 0 0 0 0 1\n".format(name))
+    return trial_dir
+
+
+def test_is_cached_trial_finds_evaluator_entry(tmp_path):
+    # The key of load_trajectory must be the one find_todo_trajectories looks up
+    root_dir = str(tmp_path)
+    trial_dir = make_trial(root_dir)
+    cache = ResultCache(os.path.join(root_dir, "cache"))
+    evaluator = PoseErrorEvaluator(root_dir, cache=cache)
+    benchmarkObject = bm.XREVA(root_dir)
+    assert not benchmarkObject.is_cached_trial(trial_dir, cache, evaluator.alignment_params())
+
+    files = list(evaluator.get_trajectory_files("S1_Petrol_Featurerich_50", "set1"))
+    cache.save(cache.make_key(files, evaluator.alignment_params()), {"est_time": np.zeros(2)}, files=files,
+               params=evaluator.alignment_params())
+    assert benchmarkObject.is_cached_trial(trial_dir, cache, evaluator.alignment_params())
+
+    # Changed input files are a miss
+    with open(files[1], "a") as f:
+        f.write("0.2 0 0 0 0 0 0 1\n")
+    assert not benchmarkObject.is_cached_trial(trial_dir, cache, evaluator.alignment_params())
@@ -0,0 +1,345 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from scipy.optimize import least_squares
+from scipy import sparse
+from scipy.spatial.transform import Rotation
+
+from evo.tools import file_interface
+
+import trajectory_cleaning
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis"))
+import fastSync
+import extrinsics
+import syncReport
+from fastRPE import quaternion_to_rotation
+
+
+# The extrinsic X maps the ground truth rigid body to the device frame,
+# traj_gt.transform(t=X, right_mul=True), and W is the world alignment of
+# the device trajectory (evo's align). For every matched pose:
+#   T_gt @ X = W @ T_xr
+
+
+def to_matrix(rotation, translation):
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3] = translation
+    return transform
+
+
+def rotation_log(rotations):
+    # nx3x3 rotation matrices to rotation vectors and angles
+    cos_angle = (np.trace(rotations, axis1=1, axis2=2) - 1) / 2
+    skew = np.stack([rotations[:, 2, 1] - rotations[:, 1, 2],
+                     rotations[:, 0, 2] - rotations[:, 2, 0],
+                     rotations[:, 1, 0] - rotations[:, 0, 1]], axis=1)
+    sin_angle = np.linalg.norm(skew, axis=1) / 2
+    angle = np.arctan2(sin_angle, cos_angle)
+    scale = np.divide(angle, 2 * sin_angle, out=np.full(len(angle), 0.5), where=sin_angle > 1e-12)
+    return skew * scale[:, None], angle
+
+
+def skew(vectors):
+    # nx3 vectors to nx3x3 cross product matrices
+    x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    zero = np.zeros(len(vectors))
+    return np.stack([np.stack([zero, -z, y], axis=-1),
+                     np.stack([z, zero, -x], axis=-1),
+                     np.stack([-y, x, zero], axis=-1)], axis=1)
+
+
+def left_jacobian(rotvecs, inverse=False):
+    # SO(3) left Jacobian (or its inverse) of nx3 rotation vectors, with the
+    # series expansion for small angles
+    angle = np.linalg.norm(rotvecs, axis=1)
+    small = angle < 1e-6
+    safe = np.where(small, 1.0, angle)
+    if inverse:
+        coeff_1 = np.full(len(angle), -0.5)
+        coeff_2 = np.where(small, 1 / 12 + angle**2 / 720,
+                           1 / safe**2 - (1 + np.cos(safe)) / (2 * safe * np.sin(safe)))
+    else:
+        coeff_1 = np.where(small, 0.5 - angle**2 / 24, (1 - np.cos(safe)) / safe**2)
+        coeff_2 = np.where(small, 1 / 6 - angle**2 / 120, (safe - np.sin(safe)) / safe**3)
+    cross = skew(rotvecs)
+    return np.eye(3) + coeff_1[:, None, None] * cross + coeff_2[:, None, None] * np.matmul(cross, cross)
+
+
+def rotation_errors(pair, rotation_x, rotation_w):
+    # (R_gt R_X)^-1 R_W R_xr of all matched poses
+    return np.matmul(rotation_x.T, np.matmul(pair["gt_rot"].transpose(0, 2, 1), np.matmul(rotation_w, pair["xr_rot"])))
+
+
+def position_errors(pair, lever_arm, rotation_w, translation_w):
+    return (pair["gt_xyz"] + np.matmul(pair["gt_rot"], lever_arm)
+            - np.dot(pair["xr_xyz"], rotation_w.T) - translation_w)
+
+
+def associate_pair(traj_gt, traj_xr, max_diff=0.05, offset=0.0):
+    """Match a ground truth and a device trajectory once, by timestamp.
+
+    Returns:
+        pair (dict): matched positions and rotation matrices of both
+                     trajectories
+    """
+    ids_gt, ids_xr = fastSync.associate_indices(traj_gt.timestamps, traj_xr.timestamps, max_diff, offset)
+    if len(ids_gt) < 3:
+        raise ValueError("Found only {} matching timestamps with max. time diff {} (s)".format(len(ids_gt), max_diff))
+    return {
+        "gt_xyz": traj_gt.positions_xyz[ids_gt],
+        "gt_rot": quaternion_to_rotation(traj_gt.orientations_quat_wxyz[ids_gt]),
+        "xr_xyz": traj_xr.positions_xyz[ids_xr],
+        "xr_rot": quaternion_to_rotation(traj_xr.orientations_quat_wxyz[ids_xr]),
+    }
+
+
+def align_positions(pair, lever_arm):
+    # Closed-form (Umeyama, no scale) alignment of the device positions to
+    # the ground truth positions moved by the lever arm
+    target = pair["gt_xyz"] + np.matmul(pair["gt_rot"], lever_arm)
+    source = pair["xr_xyz"]
+    target_mean, source_mean = target.mean(axis=0), source.mean(axis=0)
+    u, _, vt = np.linalg.svd(np.dot((target - target_mean).T, source - source_mean))
+    s = np.eye(3)
+    s[2, 2] = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+    rotation = u @ s @ vt
+    return rotation, target_mean - rotation @ source_mean
+
+
+def grid_search_lever_arm(pairs, center, span=0.2, steps=5, levels=6):
+    """Coarse-to-fine grid search of the extrinsic translation.
+
+    Same objective as the brute-force grid of ExtrincsCalibration.ipynb (APE
+    after Umeyama alignment), but every grid point is evaluated in closed
+    form: the cross-covariance and the spread of the moved ground truth are
+    linear and quadratic in the translation, so one batched SVD scores all
+    points of a level. Each level shrinks the grid around the best point.
+
+    Args:
+        pairs (list): associated pairs from associate_pair
+        center (np.ndarray): initial translation
+        span (float): half width of the first grid in meters
+        steps (int): grid points per axis
+        levels (int): number of refinements
+    Returns:
+        lever_arm (np.ndarray): best translation
+        rmse (float): position rmse at the best translation
+    """
+    # 1. Sufficient statistics of every pair
+    stats = []
+    for pair in pairs:
+        rot = pair["gt_rot"]
+        gt_c = pair["gt_xyz"] - pair["gt_xyz"].mean(axis=0)
+        xr_c = pair["xr_xyz"] - pair["xr_xyz"].mean(axis=0)
+        rot_c = rot - rot.mean(axis=0)
+        stats.append({
+            "n": len(gt_c),
+            "cov0": np.dot(gt_c.T, xr_c),
+            "cov1": np.einsum("iaj,ib->jab", rot_c, xr_c),
+            "sq0": np.sum(gt_c**2) + np.sum(xr_c**2),
+            "sq1": 2 * np.einsum("iaj,ia->j", rot_c, gt_c),
+            "sq2": np.einsum("iaj,iak->jk", rot_c, rot_c),
+        })
+    total = sum(stat["n"] for stat in stats)
+
+    # 2. Refine the grid around the best point
+    center = np.asarray(center, dtype=float)
+    best_rmse = np.inf
+    for level in range(levels):
+        axis = np.linspace(-span, span, steps)
+        candidates = center + np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape(-1, 3)
+        squared_error = np.zeros(len(candidates))
+        for stat in stats:
+            cov = stat["cov0"] + np.einsum("cj,jab->cab", candidates, stat["cov1"])
+            u, sv, vt = np.linalg.svd(cov)
+            sign = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+            squared_error += (stat["sq0"] + candidates @ stat["sq1"]
+                              + np.einsum("cj,jk,ck->c", candidates, stat["sq2"], candidates)
+                              - 2 * (sv[:, 0] + sv[:, 1] + sign * sv[:, 2]))
+        best = int(np.argmin(squared_error))
+        center = candidates[best]
+        best_rmse = np.sqrt(max(squared_error[best], 0.0) / total)
+        span = 2 * span / (steps - 1)
+    return center, best_rmse
+
+
+def calibrate_extrinsic(pairs, initial_transform=None, rotation_weight=0.1, grid=False, loss="linear"):
+    """Solve the 6-DoF extrinsic of a device w.r.t. the ground truth body.
+
+    All trajectory pairs share the extrinsic X, every pair has its own world
+    alignment W. Position residuals (T_gt X).t - (W T_xr).t and rotation
+    residuals log((R_gt R_X)^-1 R_W R_xr) of all matched poses are
+    minimized with scipy's least_squares. Without rotation residuals the
+    rotation of X is not observable and stays at its initial value.
+
+    Args:
+        pairs (list): associated pairs from associate_pair
+        initial_transform (np.ndarray): 4x4 initial extrinsic, default identity
+        rotation_weight (float): meters per radian of rotation error, 0 solves
+                                 the translation only
+        grid (bool): start from the coarse-to-fine grid search of the
+                     translation, it is also used if the optimizer fails
+        loss (str): least_squares loss, e.g. "soft_l1" for outliers
+    Returns:
+        result (dict): "transform" (4x4 extrinsic), "world_transforms",
+                       "position_rmse" (m), "rotation_rmse" (deg),
+                       "matches", "success", "message" and "seconds"
+    """
+    start_time = time.time()
+    if initial_transform is None:
+        initial_transform = np.eye(4)
+    rotation_x0 = np.array(initial_transform[:3, :3], dtype=float)
+    lever_arm0 = np.array(initial_transform[:3, 3], dtype=float)
+    solve_rotation = rotation_weight > 0
+    if grid:
+        lever_arm0, _ = grid_search_lever_arm(pairs, lever_arm0)
+
+    # 1. Initial world alignments and extrinsic rotation
+    world_init = [align_positions(pair, lever_arm0) for pair in pairs]
+    world0 = [rotation for rotation, _ in world_init]
+    if solve_rotation:
+        rotation_x0 = Rotation.from_matrix(np.concatenate([
+            rotation_errors(pair, np.eye(3), rotation) for pair, rotation in zip(pairs, world0)
+        ])).mean().as_matrix()
+
+    # Parameters: [rotvec_X, t_X, (rotvec_W, t_W) per pair], rotations as
+    # increments on the initial values to stay away from the rotvec singularity
+    def unpack(params):
+        rotation_x = Rotation.from_rotvec(params[:3]).as_matrix() @ rotation_x0 if solve_rotation else rotation_x0
+        worlds = [(Rotation.from_rotvec(params[6 + 6 * k:9 + 6 * k]).as_matrix() @ world0[k],
+                   params[9 + 6 * k:12 + 6 * k]) for k in range(len(pairs))]
+        return rotation_x, params[3:6], worlds
+
+    def residuals(params):
+        rotation_x, lever_arm, worlds = unpack(params)
+        blocks = []
+        for pair, (rotation_w, translation_w) in zip(pairs, worlds):
+            blocks.append(position_errors(pair, lever_arm, rotation_w, translation_w).ravel())
+            if solve_rotation:
+                rotvecs, _ = rotation_log(rotation_errors(pair, rotation_x, rotation_w))
+                blocks.append(rotation_weight * rotvecs.ravel())
+        return np.concatenate(blocks)
+
+    def jacobian(params):
+        # Analytic derivatives w.r.t. left perturbations of the rotations,
+        # chained with the left Jacobian of the rotvec increments
+        rotation_x, lever_arm, worlds = unpack(params)
+        increments = left_jacobian(params.reshape(-1, 6)[:, :3])
+        shared_blocks, own_blocks = [], []
+        for k, (pair, (rotation_w, translation_w)) in enumerate(zip(pairs, worlds)):
+            n = len(pair["gt_xyz"])
+            # Position rows: d/dt_X = R_gt, d/dR_W = [R_W p_xr]x, d/dt_W = -I
+            shared = np.zeros((n, 3, 6))
+            shared[:, :, 3:] = pair["gt_rot"]
+            own = np.zeros((n, 3, 6))
+            own[:, :, :3] = np.matmul(skew(np.dot(pair["xr_xyz"], rotation_w.T)), increments[k + 1])
+            own[:, :, 3:] = -np.eye(3)
+            shared_blocks.append(shared.reshape(-1, 6))
+            own_blocks.append(own.reshape(-1, 6))
+            if solve_rotation:
+                # Rotation rows: log(E) with E = R_X^T R_gt^T R_W R_xr
+                rotvecs, _ = rotation_log(rotation_errors(pair, rotation_x, rotation_w))
+                log_jacobian = rotation_weight * left_jacobian(rotvecs, inverse=True)
+                shared = np.zeros((n, 3, 6))
+                shared[:, :, :3] = -np.matmul(log_jacobian, rotation_x.T @ increments[0])
+                own = np.zeros((n, 3, 6))
+                own[:, :, :3] = np.matmul(np.matmul(log_jacobian, rotation_x.T),
+                                          np.matmul(pair["gt_rot"].transpose(0, 2, 1), increments[k + 1]))
+                shared_blocks.append(shared.reshape(-1, 6))
+                own_blocks.append(own.reshape(-1, 6))
+        # Every world alignment only affects the residuals of its own pair
+        own_blocks = [np.vstack(own_blocks[i:i + (2 if solve_rotation else 1)])
+                      for i in range(0, len(own_blocks), 2 if solve_rotation else 1)]
+        return sparse.hstack([sparse.csr_matrix(np.vstack(shared_blocks)),
+                              sparse.block_diag(own_blocks, format="csr")], format="csr")
+
+    params0 = np.zeros(6 + 6 * len(pairs))
+    params0[3:6] = lever_arm0
+    for k, (_, translation_w) in enumerate(world_init):
+        params0[9 + 6 * k:12 + 6 * k] = translation_w
+
+    solution = least_squares(residuals, params0, jac=jacobian, loss=loss, x_scale="jac")
+    rotation_x, lever_arm, worlds = unpack(solution.x)
+    if not solution.success and not grid:
+        # Fall back to the grid search of the translation
+        lever_arm, _ = grid_search_lever_arm(pairs, lever_arm0)
+        worlds = [align_positions(pair, lever_arm) for pair in pairs]
+
+    # 2. Statistics at the solution
+    distances, angles = [], []
+    for pair, (rotation_w, translation_w) in zip(pairs, worlds):
+        distances.append(np.linalg.norm(position_errors(pair, lever_arm, rotation_w, translation_w), axis=1))
+        angles.append(rotation_log(rotation_errors(pair, rotation_x, rotation_w))[1])
+    distances = np.concatenate(distances)
+    angles = np.rad2deg(np.concatenate(angles))
+
+    return {
+        "transform": to_matrix(rotation_x, lever_arm),
+        "world_transforms": [to_matrix(rotation_w, translation_w) for rotation_w, translation_w in worlds],
+        "position_rmse": float(np.sqrt(np.mean(distances**2))),
+        "rotation_rmse": float(np.sqrt(np.mean(angles**2))),
+        "matches": int(len(distances)),
+        "success": bool(solution.success),
+        "message": solution.message,
+        "seconds": time.time() - start_time,
+    }
+
+
+def save_calibration(calibration_file, device_name, result, session=None):
+    # Calibration file read by analysis/extrinsics.py
+    extrinsics.save_calibration(calibration_file, device_name, result["transform"], session=session,
+                                position_rmse=result["position_rmse"],
+                                rotation_rmse=result["rotation_rmse"],
+                                matches=result["matches"])
+
+
+def prepare_traj_pair(gt_file, xr_file, max_diff=0.05, offset=0.0, gt_speed_threshold=2.75, device_name=None):
+    # Same cleaning as prepare_traj_pair in ExtrincsCalibration.ipynb. With a
+    # device name the offset comes from the closest sync report of xr_file
+    traj_gt = file_interface.read_tum_trajectory_file(gt_file)
+    traj_xr = file_interface.read_tum_trajectory_file(xr_file)
+    if device_name is not None:
+        entry = syncReport.device_sync(os.path.dirname(os.path.abspath(xr_file)), device_name, traj_gt.timestamps[0])
+        if entry is not None:
+            offset = syncReport.expected_offset(entry, traj_gt.timestamps[0])
+            print("{}: sync report offset {:.4f} s".format(xr_file, offset))
+    traj_gt, _ = trajectory_cleaning.clean_trajectory(traj_gt, speed_threshold=gt_speed_threshold)
+    traj_xr, _ = trajectory_cleaning.clean_trajectory(traj_xr)
+    return associate_pair(traj_gt, traj_xr, max_diff=max_diff, offset=offset)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the extrinsic of a device w.r.t. the ground truth body")
+    parser.add_argument("--device", required=True, help="Device name, e.g. MetaQuest3")
+    parser.add_argument("--gt", nargs="+", required=True, help="Ground truth TUM files")
+    parser.add_argument("--xr", nargs="+", required=True, help="Device TUM files, same order as --gt")
+    parser.add_argument("--output", default=extrinsics.DEFAULT_CALIBRATION_FILE, help="Calibration file to add the device to")
+    parser.add_argument("--session", default=None, help="Session name stored in the calibration file")
+    parser.add_argument("--max-diff", type=float, default=0.05, help="Max timestamp difference for association")
+    parser.add_argument("--rotation-weight", type=float, default=0.1,
+                        help="Meters per radian of rotation error, 0 solves the translation only")
+    parser.add_argument("--grid", action="store_true", help="Initialize with the coarse-to-fine grid search")
+    parser.add_argument("--loss", default="linear", help="least_squares loss, e.g. soft_l1")
+    parser.add_argument("--no-sync-report", action="store_true",
+                        help="Ignore sync_report.json next to the device files, use offset 0")
+    args = parser.parse_args()
+    if len(args.gt) != len(args.xr):
+        parser.error("--gt and --xr need the same number of files")
+
+    pairs = [prepare_traj_pair(gt_file, xr_file, max_diff=args.max_diff,
+                               device_name=None if args.no_sync_report else args.device)
+             for gt_file, xr_file in zip(args.gt, args.xr)]
+    result = calibrate_extrinsic(pairs, rotation_weight=args.rotation_weight, grid=args.grid, loss=args.loss)
+    np.set_printoptions(precision=4, suppress=True)
+    print(result["transform"])
+    print("position rmse: {:.4f} m, rotation rmse: {:.3f} deg, {} matches, {:.2f} s".format(
+        result["position_rmse"], result["rotation_rmse"], result["matches"], result["seconds"]))
+    if not result["success"]:
+        print("Warning: optimizer did not converge ({})".format(result["message"]))
+    save_calibration(args.output, args.device, result, session=args.session)
+    print("Saved to {}".format(args.output))
@@ -0,0 +1,144 @@
+import os
+import sys
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis"))
+from fastRPE import pairs_by_path
+
+
+def resample_speeds(timestamps, positions_xyz, grid):
+    # Speed profile on a uniform time grid, nan outside the trajectory
+    xyz = np.stack([np.interp(grid, timestamps, positions_xyz[:, k]) for k in range(3)], axis=1)
+    speeds = np.empty(len(grid))
+    speeds[1:] = np.linalg.norm(np.diff(xyz, axis=0), axis=1) / np.diff(grid)
+    speeds[0] = speeds[1] if len(grid) > 1 else 0.0
+    speeds[(grid < timestamps[0]) | (grid > timestamps[-1])] = np.nan
+    # Tracking jumps would dominate the correlation
+    finite = speeds[np.isfinite(speeds)]
+    if len(finite) > 0:
+        speeds = np.minimum(speeds, np.percentile(finite, 99))
+    return speeds
+
+
+def speed_correlation(traj_est, traj_gt, lower=-3, upper=3, coarse_dt=0.02):
+    """Correlation of the speed profiles for every offset of the coarse grid.
+
+    Speeds are rotation and translation invariant, so the estimate does not
+    need to be aligned to the ground truth first.
+
+    Args:
+        traj_est (PoseTrajectory3D): estimated trajectory
+        traj_gt (PoseTrajectory3D): ground truth trajectory
+        lower, upper (float): offset search range in seconds
+        coarse_dt (float): grid resolution in seconds
+    Returns:
+        offsets (np.ndarray): offsets added to the estimated timestamps
+        correlation (np.ndarray): Pearson correlation of each offset
+    """
+    start = min(traj_est.timestamps[0], traj_gt.timestamps[0])
+    end = max(traj_est.timestamps[-1], traj_gt.timestamps[-1])
+    grid = np.arange(start, end + coarse_dt, coarse_dt)
+    speeds_gt = resample_speeds(traj_gt.timestamps, traj_gt.positions_xyz, grid)
+    speeds_est = resample_speeds(traj_est.timestamps, traj_est.positions_xyz, grid)
+
+    lags = np.arange(int(np.floor(lower / coarse_dt)), int(np.ceil(upper / coarse_dt)) + 1)
+    correlation = np.full(len(lags), np.nan)
+    n = len(grid)
+    for idx, lag in enumerate(lags):
+        # est at t matches gt at t + offset
+        if lag >= 0:
+            g, e = speeds_gt[lag:], speeds_est[:n - lag]
+        else:
+            g, e = speeds_gt[:n + lag], speeds_est[-lag:]
+        valid = np.isfinite(g) & np.isfinite(e)
+        if np.count_nonzero(valid) < 10:
+            continue
+        g, e = g[valid] - g[valid].mean(), e[valid] - e[valid].mean()
+        norm = np.sqrt(np.dot(g, g) * np.dot(e, e))
+        if norm > 0:
+            correlation[idx] = np.dot(g, e) / norm
+    return lags * coarse_dt, correlation
+
+
+def offset_error_function(traj_est, traj_gt, delta=0.1, rel_tol=0.1):
+    """Mean all-pairs point distance RPE as a function of the time offset.
+
+    Pairs are taken from the estimated path once. For every offset the
+    ground truth is linearly interpolated at the shifted estimated
+    timestamps, so the function is continuous in the offset and needs no
+    copies or re-association of the trajectories.
+
+    Returns:
+        error (callable): offset in seconds -> mean error in meters
+    """
+    order = np.argsort(traj_gt.timestamps, kind="stable")
+    gt_stamps = traj_gt.timestamps[order]
+    gt_xyz = traj_gt.positions_xyz[order]
+    est_stamps = traj_est.timestamps
+    first_ids, second_ids = pairs_by_path(traj_est.positions_xyz, delta, delta * rel_tol)
+    est_distances = np.linalg.norm(traj_est.positions_xyz[first_ids] - traj_est.positions_xyz[second_ids], axis=1)
+
+    def error(offset):
+        stamps = est_stamps + offset
+        inside = (stamps >= gt_stamps[0]) & (stamps <= gt_stamps[-1])
+        valid = inside[first_ids] & inside[second_ids]
+        if not np.any(valid):
+            return np.inf
+        ref_xyz = np.stack([np.interp(stamps, gt_stamps, gt_xyz[:, k]) for k in range(3)], axis=1)
+        ref_distances = np.linalg.norm(ref_xyz[first_ids[valid]] - ref_xyz[second_ids[valid]], axis=1)
+        return float(np.mean(np.abs(ref_distances - est_distances[valid])))
+
+    return error
+
+
+def estimate_time_offset(traj_est, traj_gt, lower=-3, upper=3, coarse_dt=0.02, refine_window=None,
+                         delta=0.1, xtol=1e-5, curve_points=41):
+    """Estimate the time offset of an estimated trajectory w.r.t. ground truth.
+
+    1. Coarse scan: cross-correlation of the resampled speed profiles over
+       [lower, upper].
+    2. Refinement: Brent's method on the mean RPE around the coarse peak.
+
+    Args:
+        traj_est (PoseTrajectory3D): estimated trajectory
+        traj_gt (PoseTrajectory3D): ground truth trajectory
+        lower, upper (float): offset search range in seconds
+        coarse_dt (float): resolution of the coarse scan in seconds
+        refine_window (float): half width of the refinement bracket,
+                               default 2 * coarse_dt
+        delta (float): RPE delta in meters
+        xtol (float): offset tolerance of the refinement in seconds
+        curve_points (int): samples of the returned error curve
+    Returns:
+        result (dict): "offset" to add to the estimated timestamps,
+                       "error" at the offset, "confidence" (speed correlation
+                       at the coarse peak, 0 to 1), "coarse_offset",
+                       "coarse_offsets"/"correlation" of the scan and
+                       "curve_offsets"/"curve_errors" around the offset
+    """
+    if refine_window is None:
+        refine_window = 2 * coarse_dt
+    coarse_offsets, correlation = speed_correlation(traj_est, traj_gt, lower, upper, coarse_dt)
+    if np.all(np.isnan(correlation)):
+        raise ValueError("Trajectories do not overlap within the offset range [{}, {}]".format(lower, upper))
+    best = int(np.nanargmax(correlation))
+    coarse_offset = coarse_offsets[best]
+
+    error = offset_error_function(traj_est, traj_gt, delta)
+    bounds = (max(coarse_offset - refine_window, lower), min(coarse_offset + refine_window, upper))
+    refined = minimize_scalar(error, bounds=bounds, method="bounded", options={"xatol": xtol})
+
+    curve_offsets = np.linspace(bounds[0], bounds[1], curve_points)
+    curve_errors = np.array([error(offset) for offset in curve_offsets])
+    return {
+        "offset": float(refined.x),
+        "error": float(refined.fun),
+        "confidence": float(max(correlation[best], 0.0)),
+        "coarse_offset": float(coarse_offset),
+        "coarse_offsets": coarse_offsets,
+        "correlation": correlation,
+        "curve_offsets": curve_offsets,
+        "curve_errors": curve_errors,
+    }
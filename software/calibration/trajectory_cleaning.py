@@ -0,0 +1,105 @@
+import numpy as np
+
+from evo.core.trajectory import PoseTrajectory3D
+
+
+def monotonic_keep_mask(timestamps):
+    """Keep-mask for rows that break a monotonically increasing timestamp.
+
+    Matches repeatedly deleting every row that is not smaller than its
+    successor: a row survives when it is strictly smaller than its direct
+    successor and not larger than any later timestamp.
+
+    Args:
+        timestamps (np.ndarray): n timestamps
+    Returns:
+        keep (np.ndarray): n booleans, True for rows to keep
+    """
+    timestamps = np.asarray(timestamps)
+    keep = np.ones(len(timestamps), dtype=bool)
+    if len(timestamps) < 2:
+        return keep
+    # 1. Rows that are not strictly smaller than the next row
+    keep[:-1] = timestamps[:-1] < timestamps[1:]
+    # 2. Rows larger than any later row (running minimum from the end)
+    suffix_min = np.minimum.accumulate(timestamps[::-1])[::-1]
+    keep[:-1] &= timestamps[:-1] <= suffix_min[1:]
+    return keep
+
+
+def speed_outlier_keep_mask(timestamps, positions_xyz, speed_threshold):
+    """Keep-mask for rows around abnormal position jumps.
+
+    Every step with a speed >= speed_threshold is dilated to its two
+    neighbouring rows and the flagged rows are dropped, except the outermost
+    row on each side of the flagged set. Dropping rows creates new steps, so
+    the check is repeated on the survivors until no abnormal step is left.
+
+    Args:
+        timestamps (np.ndarray): n monotonically increasing timestamps
+        positions_xyz (np.ndarray): nx3 positions
+        speed_threshold (float): speed in m/s above which a step is abnormal
+    Returns:
+        keep (np.ndarray): n booleans, True for rows to keep
+    """
+    timestamps = np.asarray(timestamps)
+    positions_xyz = np.asarray(positions_xyz)
+    kept_ids = np.arange(len(timestamps))
+    while len(kept_ids) > 1:
+        steps = np.linalg.norm(np.diff(positions_xyz[kept_ids], axis=0), axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speeds = steps / np.diff(timestamps[kept_ids])
+        abnormal_steps = np.flatnonzero(speeds >= speed_threshold)
+        if len(abnormal_steps) == 0:
+            break
+        # Step i joins rows i and i+1, flag rows i-1 to i+1
+        # (shifted by one so that row -1 has a slot)
+        flagged = np.zeros(len(kept_ids) + 2, dtype=bool)
+        flagged[abnormal_steps] = True
+        flagged[abnormal_steps + 1] = True
+        flagged[abnormal_steps + 2] = True
+        flagged_rows = np.flatnonzero(flagged)
+        flagged[flagged_rows[0]] = False
+        flagged[flagged_rows[-1]] = False
+        kept_ids = kept_ids[~flagged[1:-1]]
+
+    keep = np.zeros(len(timestamps), dtype=bool)
+    keep[kept_ids] = True
+    return keep
+
+
+def apply_keep_mask(traj, keep):
+    return PoseTrajectory3D(positions_xyz=traj.positions_xyz[keep],
+                            orientations_quat_wxyz=traj.orientations_quat_wxyz[keep],
+                            timestamps=traj.timestamps[keep])
+
+
+def clean_trajectory(traj, monotonic=True, speed_threshold=None):
+    """Drop non-monotonic and abnormal rows from a trajectory in one go.
+
+    Args:
+        traj (PoseTrajectory3D): trajectory to clean, left untouched
+        monotonic (bool): drop rows breaking increasing timestamps
+        speed_threshold (float): drop rows around steps at or above this
+                                 speed in m/s, None to skip the check
+    Returns:
+        traj (PoseTrajectory3D): cleaned trajectory
+        drop_counts (dict): number of dropped rows per rule
+    """
+    timestamps = traj.timestamps
+    keep = np.ones(len(timestamps), dtype=bool)
+    drop_counts = {"non_monotonic": 0, "abnormal_speed": 0}
+
+    if monotonic:
+        keep = monotonic_keep_mask(timestamps)
+        drop_counts["non_monotonic"] = int(np.count_nonzero(~keep))
+
+    if speed_threshold is not None:
+        kept_ids = np.flatnonzero(keep)
+        speed_keep = speed_outlier_keep_mask(timestamps[kept_ids],
+                                             traj.positions_xyz[kept_ids],
+                                             speed_threshold)
+        keep[kept_ids[~speed_keep]] = False
+        drop_counts["abnormal_speed"] = int(np.count_nonzero(~speed_keep))
+
+    return apply_keep_mask(traj, keep), drop_counts
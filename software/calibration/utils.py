@@ -1,5 +1,4 @@
 import os
-import time
 
 from evo.core import metrics
 import pandas as pd
@@ -10,59 +9,41 @@ import matplotlib.pyplot as plt
 #%matplotlib tk
 
 import pprint
-import numpy as np
-
-import numpy as np
 
 from evo.tools.file_interface import read_tum_trajectory_file
 from evo.core import sync
 import evo.core.lie_algebra as lie
 from evo.tools import plot
-from evo import core
-from evo.core.trajectory import PosePath3D, PoseTrajectory3D
 
 from evo.tools import log
 log.configure_logging(verbose=False, debug=False, silent=True)
 
+import trajectory_cleaning
+import time_offset
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis"))
+from fastRPE import FastRPE
+import extrinsics
+import syncReport
+import alignRegions
+import piecewiseAlign
 
-def check_monotionic_increaseing(traj, type="gt"):
-    non_monotonic_rows = np.where((traj.timestamps[:-1] < traj.timestamps[1:]) == False)[0]
-    total_non_monotonic_rows = 0
-    # Remove non-monotonic rows
-    while(len(non_monotonic_rows) > 0):
-        traj.timestamps = np.delete(traj.timestamps, non_monotonic_rows, axis=0)
-        traj._positions_xyz = np.delete(traj._positions_xyz, non_monotonic_rows, axis=0)
-        traj._orientations_quat_wxyz = np.delete(traj._orientations_quat_wxyz, non_monotonic_rows, axis=0)
 
-        total_non_monotonic_rows += len(non_monotonic_rows)
-        # Check it again
-        non_monotonic_rows = np.where((traj.timestamps[:-1] <= traj.timestamps[1:]) == False)[0]
 
-    print(f"{type} - found {total_non_monotonic_rows} non-monotonic increasing rows")
+def check_monotionic_increaseing(traj, type="gt"):
+    # Remove non-monotonic rows
+    traj, drop_counts = trajectory_cleaning.clean_trajectory(traj)
+    print(f"{type} - found {drop_counts['non_monotonic']} non-monotonic increasing rows")
     return traj
 
 
 
 def check_gt_abnormal_traj(traj_gt, speed_threshold=6):
-    abnormal_step_rows = np.where(traj_gt.speeds >= speed_threshold)[0]
-    
-    total_abnormal_step_rows = 0
     # Remove abnormal_step_rows
-    while(len(abnormal_step_rows) > 0):
-        to_delete_rows = np.unique(np.sort(np.concat([abnormal_step_rows, 
-                                                    abnormal_step_rows-1, 
-                                                    abnormal_step_rows+1])))[1:-1]
-
-        traj_gt.timestamps = np.delete(traj_gt.timestamps, to_delete_rows, axis=0)
-        traj_gt._positions_xyz = np.delete(traj_gt._positions_xyz, to_delete_rows, axis=0)
-        traj_gt._orientations_quat_wxyz = np.delete(traj_gt._orientations_quat_wxyz, to_delete_rows, axis=0)
-
-        total_abnormal_step_rows += len(abnormal_step_rows)
-        # Check it again
-        abnormal_step_rows = np.where(traj_gt.speeds >= speed_threshold)[0]
-
-    print(f"gt - found {total_abnormal_step_rows} abnormal_step_rows")
+    traj_gt, drop_counts = trajectory_cleaning.clean_trajectory(traj_gt, monotonic=False,
+                                                                speed_threshold=speed_threshold)
+    print(f"gt - found {drop_counts['abnormal_speed']} abnormal_step_rows")
     return traj_gt
 
 
@@ -131,176 +112,28 @@ def plot_trajectory(traj_est, traj_ref, benchmark=None, trajectory=None, trial=N
 # "Hololens2": 5,
 # "ORBSLAM":6
 
-def get_traj_from_gt(device_name, traj_gt):
-    transform_matrix = np.eye(4, dtype=float)
-    if device_name == "MetaQuest3":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   ,  0.024],
-       [ 0.   ,  1.   ,  0.   ,  0.074],
-       [ 0.   ,  0.   ,  1.   , -0.13 ],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    elif device_name == "AppleVisionPro" or device_name == "AppleVisionPro1":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   ,  0.06 ],
-       [ 0.   ,  1.   ,  0.   ,  0.07 ],
-       [ 0.   ,  0.   ,  1.   , -0.132],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    #     np.array([[ 1.   ,  0.   ,  0.   ,  0.065],
-    #    [ 0.   ,  1.   ,  0.   ,  0.042],
-    #    [ 0.   ,  0.   ,  1.   , -0.128],
-    #    [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    elif device_name == "XReal2Ultra":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   ,  0.054],
-       [ 0.   ,  1.   ,  0.   ,  0.02 ],
-       [ 0.   ,  0.   ,  1.   , -0.12 ],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    #     array([[ 1.   ,  0.   ,  0.   ,  0.056],
-    #    [ 0.   ,  1.   ,  0.   ,  0.02 ],
-    #    [ 0.   ,  0.   ,  1.   , -0.122],
-    #    [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    #     array([[ 1.   ,  0.   ,  0.   ,  0.055],
-    #    [ 0.   ,  1.   ,  0.   ,  0.025],
-    #    [ 0.   ,  0.   ,  1.   , -0.12 ],
-    #    [ 0.   ,  0.   ,  0.   ,  1.   ]])
-
-    elif device_name == "MagicLeap2":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   ,  0.065],
-       [ 0.   ,  1.   ,  0.   ,  0.033],
-       [ 0.   ,  0.   ,  1.   , -0.084],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    #     array([[ 0.90135442, -0.43260253,  0.02037798,  0.06      ],
-    #    [ 0.43291094,  0.89867671, -0.07048616,  0.012     ],
-    #    [ 0.01217927,  0.07235486,  0.99730459, -0.09      ],
-    #    [ 0.        ,  0.        ,  0.        ,  1.        ]])
-    elif device_name == "Hololens2":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   ,  0.056],
-       [ 0.   ,  1.   ,  0.   ,  0.048],
-       [ 0.   ,  0.   ,  1.   , -0.045],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    #     array([[ 0.98084624, -0.19094047,  0.03850183,  0.04      ],
-    #    [ 0.19423046,  0.94387723, -0.26715223, -0.02      ],
-    #    [ 0.01466918,  0.26951349,  0.96288488, -0.13      ],
-    #    [ 0.        ,  0.        ,  0.        ,  1.        ]])
-    elif device_name == "ORBSLAM3":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   , -0.064],
-       [ 0.   ,  1.   ,  0.   ,  0.044],
-       [ 0.   ,  0.   ,  1.   ,  0.056],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    else:
-        print(f"Error: device name '{device_name}' not supported")
-
-    #transform_matrix = np.eye(4)
-    traj_gt_xr = copy.deepcopy(traj_gt)
-    traj_gt_xr.transform(t=transform_matrix, right_mul=True, propagate=False)
-    return traj_gt_xr
-
+def get_traj_from_gt(device_name, traj_gt, calibration_file=None, session=None):
+    # Ground truth moved to the device frame with the extrinsic of the
+    # calibration registry (extrinsics.json by default, see extrinsic_calibration.py)
+    registry = extrinsics.get_registry(calibration_file, session)
+    return registry.transform_trajectory(device_name, traj_gt, reference="gt")
 
 
-def get_traj_from_avpgt(device_name, traj_gt):
-    transform_matrix = np.eye(4, dtype=float)
-    if device_name == "XReal2Ultra":
-        transform_matrix = np.array([[ 1.   ,  0.   ,  0.   ,  0.01 ],
-       [ 0.   ,  1.   ,  0.   ,  0.094],
-       [ 0.   ,  0.   ,  1.   , -0.06 ],
-       [ 0.   ,  0.   ,  0.   ,  1.   ]])
-    else:
-        print(f"Error: device name '{device_name}' not supported")
 
-    #transform_matrix = np.eye(4)
-    traj_gt_xr = copy.deepcopy(traj_gt)
-    traj_gt_xr.transform(t=transform_matrix, right_mul=True, propagate=False)
-    return traj_gt_xr
+def get_traj_from_avpgt(device_name, traj_gt, calibration_file=None, session=None):
+    # Same with the AppleVisionPro trajectory as ground truth
+    registry = extrinsics.get_registry(calibration_file, session)
+    return registry.transform_trajectory(device_name, traj_gt, reference="avpgt")
 
 
 def check_orb_abnormal_traj(traj_est, traj_ref, speed_threshold=6):
-    # 1. Find out regions that is lost tracking
-    zero_indices = np.where(traj_est.speeds == 0.0)[0]
-    lost_regions = []
-    if len(zero_indices) > 0:
-        start = zero_indices[0]
-        end = zero_indices[0]
-
-        for num in zero_indices[1:]:
-            if num == end + 1 :
-                end = num
-            else:
-                if(end - start > 1):
-                    lost_regions.append([start,end])
-                end = num
-                start = num
-    # 2. Find out moments that has map merge/relocalization
-    shift_checkpoints = np.where(traj_est.speeds>speed_threshold)[0]
-    # 3. Merge the first two regions
-    checkpoints = []
-    checkpoints.append(0)
-    checkpoints.append(traj_est.num_poses-1)
-    lost_checkpoints = []
-    for lost_region in lost_regions:
-        lost_checkpoints.append(lost_region[0])
-        lost_checkpoints.append(lost_region[1])
-    checkpoints = checkpoints + lost_checkpoints
-    checkpoints = checkpoints + list(shift_checkpoints)
-    checkpoints = list(set(checkpoints))
-    checkpoints = sorted(checkpoints)
-    # 4. Generate align regions
-    align_regions = []
-    start = checkpoints[0]
-    for idx, checkpoint in enumerate(checkpoints[1:]):
-        if(checkpoint - start <= 1):
-            ## when there are consecutive checkpoints
-            # When start in lost and end in shift, 
-            # they need to be in seperate region
-            if (start in lost_checkpoints and checkpoint in shift_checkpoints):
-                start = checkpoint
-            # When start in shift and end in shift, 
-            # they need to be in the same region
-            if (start in shift_checkpoints and checkpoint in shift_checkpoints):
-                pass
-            
-        else:
-            align_regions.append([start, checkpoint])
-            start = checkpoint
-    align_regions_dict = {}
-    align_regions_dict['align_regions'] = align_regions
-    align_regions_dict['lost_regions'] = lost_regions
-    align_regions_dict['shift_checkpoints'] = shift_checkpoints
+    # Lost tracking and map merge/relocalization regions, no rescale checkpoints
+    align_regions_dict = alignRegions.find_align_regions(traj_est, speed_threshold, rescale_threshold=None)
 
     if len(align_regions_dict['align_regions']) > 0:
-        # print("Actual subtrajectories for alignment: {}".format(align_regions))
-        xyz = traj_est._positions_xyz
-        quat = traj_est._orientations_quat_wxyz
-        time = traj_est.timestamps
-        # split trajectory to subtrajectories
-        subtrajectories = []
-        for idx, region in enumerate(align_regions_dict['align_regions']):
-            xyz_sub = xyz[region[0]:region[1], :]
-            xyz_sub[0,:] = xyz_sub[1,:]
-            xyz_sub[-1,:] = xyz_sub[-2,:]
-            
-            quat_sub = quat[region[0]:region[1], :]
-            quat_sub[0,:] = quat_sub[1,:]
-            quat_sub[-1,:] = quat_sub[-2,:]
-
-            # Perform subtrajectory alignment
-            time_sub = time[region[0]:region[1]]
-            traj_sub = PoseTrajectory3D(xyz_sub, quat_sub, time_sub)
-            #print("Original estimated subtrajectory length: {}".format(traj_sub.num_poses))
-            try:
-                traj_ref_copy = copy.deepcopy(traj_ref)
-                traj_ref_copy, traj_sub = sync.associate_trajectories(traj_ref_copy, traj_sub, max_diff=0.05)
-                
-                #n = int(traj_sub.timestamps.shape[0]/2)
-                #traj_sub.align(traj_ref_copy, correct_scale=True, correct_only_scale=False, n=n)
-                traj_sub.align(traj_ref_copy, correct_scale=False, correct_only_scale=False)
-                
-                subtrajectories.append(traj_sub)
-            except Exception as e:
-                print("subtrajectory alignment failed: {}".format(e))
-                traj_ref_copy = copy.deepcopy(traj_ref)
-                traj_ref_sub, traj_sub = sync.associate_trajectories(traj_ref_copy, traj_sub, max_diff=0.05)
-                subtrajectories.append(traj_ref_sub)
-
-            #self.plot_trajectory(subtrajectories[-1], traj_ref, trial=idx)
-
-        traj_est_aligned = core.trajectory.merge(subtrajectories)
+        # Every region aligned on its own (SE(3)), one association for all regions
+        traj_est_aligned, _ = piecewiseAlign.piecewise_align(traj_est, traj_ref, align_regions_dict['regions'],
+                                                             max_diff=0.05, with_scale=False)
         traj_ref, traj_est_aligned = sync.associate_trajectories(traj_ref, traj_est_aligned, max_diff=0.05)
         #n = int(traj_est_aligned.timestamps.shape[0]/2)
         #print("aligned length: {}".format(n))
@@ -394,8 +227,8 @@ def calculate_RE(traj_est, traj_gt, est_offset=0):
     data = (traj_ref, traj_est_copy)
     
     # load error metric setting
-    rpe_metric = metrics.RPE(pose_relation=pose_relation, delta=delta,
-                            delta_unit=delta_unit, all_pairs=all_pairs)
+    rpe_metric = FastRPE(pose_relation=pose_relation, delta=delta,
+                         delta_unit=delta_unit, all_pairs=all_pairs)
     # calculate the error
     rpe_metric.process_data(data)
     # devided by the subjectory length --> invariant to the length
@@ -475,46 +308,17 @@ def calculate_APE(traj_est, traj_gt, est_offset=0):
 
 
 
-def find_traj_est_offset(traj_est, traj_gt, iter=10, lower=-3, upper=3):
-    # We assume the RPE is a convex function to the offset
-    idx = 0
-    median = (lower+upper)/2
-    old_offset_list = [lower, median, upper]
-    new_offset_list = [lower, median, upper]
-    error_list = [None, None, None]
-    while(idx<iter):
-        for i, offset in enumerate(new_offset_list):
-            traj_est_cp = copy.deepcopy(traj_est)
-            traj_gt_cp = copy.deepcopy(traj_gt)
-            
-            rpe_metric = calculate_RE(traj_est_cp, traj_gt_cp, est_offset=offset)
-            error_list[i] = np.mean(np.array(rpe_metric.error))
-            #ape_metric = calculate_APE(traj_est_cp, traj_gt_cp, est_offset=offset)
-            #error_list[i] = ape_metric.get_statistic(metrics.StatisticsType.rmse)
-        # conditions
-        old_offset_list = new_offset_list
-        if np.argmin(error_list) == 0:
-            #print("Case 1")
-            upper = median
-            lower = lower - 0.5*(median-lower)
-            median = (lower+median)/2
-        elif np.argmax(error_list) == 2:
-            #print("Case 2")
-            upper = median
-            #lower = lower
-            median = (lower+median)/2
-        elif np.argmax(error_list) == 0:
-            #print("Case 3")
-            lower = median
-            median = (median+upper)/2
-            #upper = upper
-        elif np.argmin(error_list) == 2:
-            #print("Case 4")
-            upper = upper + 0.5*(upper-median)
-            lower = median
-            median = (upper+median)/2
-        new_offset_list = [lower, median, upper]
-        print(f"Iteration {idx} - Best offset = {old_offset_list[np.argmin(error_list)]} - checkpoint {old_offset_list}")
-        idx += 1
-    best_offset = old_offset_list[np.argmin(error_list)]
-    return best_offset
+def find_traj_est_offset(traj_est, traj_gt, iter=10, lower=-3, upper=3, device_name=None, sync_report=None):
+    # Coarse speed correlation + Brent refinement, see time_offset.py
+    # (iter is no longer used, Brent stops at the offset tolerance)
+    # With a sync report of the probe sync mode (file, folder to search or
+    # loaded dict) the search range shrinks to the offset it expects
+    if device_name is not None and sync_report is not None:
+        entry = syncReport.device_sync(sync_report, device_name, traj_gt.timestamps[0])
+        if entry is not None:
+            lower, upper = syncReport.offset_search_range(entry, traj_gt.timestamps[0])
+            print(f"Sync report offset of {device_name}: {syncReport.expected_offset(entry, traj_gt.timestamps[0])} "
+                  f"- search [{lower}, {upper}]")
+    result = time_offset.estimate_time_offset(traj_est, traj_gt, lower=lower, upper=upper)
+    print(f"Best offset = {result['offset']} - coarse {result['coarse_offset']} - confidence {result['confidence']:.3f}")
+    return result['offset']
@@ -13,6 +13,7 @@ import QuartzCore
 import ARKit
 import Combine
 import Network
+import CryptoKit
 
 class HeadTracking: ObservableObject {
     static let shared = HeadTracking()
@@ -177,42 +178,69 @@ class HeadTracking: ObservableObject {
         }
     }
 
-    func sendCSVFile(serverURL: String, fileURL: URL) async throws {
+    // Upload protocol of websocket_server.py: hello with the device name and an
+    // upload id, chunks with (seq, offset) headers and an end message with the
+    // SHA-256. After a disconnect the server returns the offset to resume from.
+    func sendCSVFile(serverURL: String, fileURL: URL, maxAttempts: Int = 5) async throws {
+        let uploadId = fileURL.deletingPathExtension().lastPathComponent
+        let data = try Data(contentsOf: fileURL, options: .mappedIfSafe)
+        let checksum = SHA256.hash(data: data).map { String(format: "%02x", $0) }.joined()
+        var lastError: Error?
+
+        for attempt in 1...maxAttempts {
+            do {
+                try await sendCSVAttempt(serverURL: serverURL, data: data, uploadId: uploadId, checksum: checksum)
+                return
+            } catch {
+                lastError = error
+                print("Upload attempt \(attempt) failed: \(error)")
+                try await Task.sleep(nanoseconds: UInt64(attempt) * 1_000_000_000)
+            }
+        }
+        throw lastError!
+    }
+
+    private func receiveJSON(_ webSocketTask: URLSessionWebSocketTask) async throws -> [String: Any] {
+        guard case .string(let text) = try await webSocketTask.receive(),
+              let json = try JSONSerialization.jsonObject(with: Data(text.utf8)) as? [String: Any] else {
+            throw URLError(.badServerResponse)
+        }
+        if json["type"] as? String == "error" {
+            throw NSError(domain: "Upload", code: 1, userInfo: [NSLocalizedDescriptionKey: json["message"] as? String ?? ""])
+        }
+        return json
+    }
+
+    private func sendCSVAttempt(serverURL: String, data: Data, uploadId: String, checksum: String) async throws {
         let session = URLSession(configuration: .default)
         let webSocketTask = session.webSocketTask(with: URL(string: serverURL)!)
         webSocketTask.resume()
-        
-        // Read file data
-        let data = try Data(contentsOf: fileURL)
-        
-        // Use smaller chunks (e.g., 64KB)
+        defer { webSocketTask.cancel(with: .normalClosure, reason: nil) }
+
+        let hello = ["type": "hello", "device": "AppleVisionPro", "upload_id": uploadId]
+        try await webSocketTask.send(.string(String(data: try JSONSerialization.data(withJSONObject: hello), encoding: .utf8)!))
+        let ready = try await receiveJSON(webSocketTask)
+        var offset = ready["offset"] as? Int ?? 0
+        var seq = UInt32(ready["seq"] as? Int ?? 0)
+
+        // Use smaller chunks (e.g., 64KB), one in flight: the acks pace the upload
         let chunkSize = 65_536 // 64KB
-        var offset = 0
-        
         while offset < data.count {
             let end = min(offset + chunkSize, data.count)
-            let chunk = data.subdata(in: offset..<end)
-            let message = URLSessionWebSocketTask.Message.data(chunk)
-            
-            // Send chunk
-            try await webSocketTask.send(message)
-            print("Sent chunk: \(offset)-\(end)")
-            offset = end
-        }
-        
-        print("All chunks sent successfully")
-        
-        // Explicitly send close frame to initiate handshake
-        try await webSocketTask.send(.string("EOF")) // Optional: Signal end of file
-        webSocketTask.cancel(with: .normalClosure, reason: nil)
-        
-        // Wait for server's close acknowledgment
-        do {
-            _ = try await webSocketTask.receive()
-            print("Server acknowledged closure")
-        } catch {
-            print("Connection closed: \(error)")
+            var message = Data()
+            withUnsafeBytes(of: seq.littleEndian) { message.append(contentsOf: $0) }
+            withUnsafeBytes(of: UInt64(offset).littleEndian) { message.append(contentsOf: $0) }
+            message.append(data.subdata(in: offset..<end))
+            try await webSocketTask.send(.data(message))
+            let ack = try await receiveJSON(webSocketTask)
+            offset = ack["offset"] as? Int ?? end
+            seq += 1
         }
+
+        let endMessage: [String: Any] = ["type": "end", "size": data.count, "sha256": checksum]
+        try await webSocketTask.send(.string(String(data: try JSONSerialization.data(withJSONObject: endMessage), encoding: .utf8)!))
+        let done = try await receiveJSON(webSocketTask)
+        print("Upload finished: \(done["file"] ?? "")")
     }
     
 //    func sendCSVFile(serverURL: String, fileURL: URL) async throws {
@@ -122,7 +122,9 @@ class UDPSync: ObservableObject {
                 return
             }
             
-            if data.count == MemoryLayout<Double>.size {
+            if data.count == 16 && data.prefix(4) == Data("SYNQ".utf8) {
+                self.handleProbe(data, on: connection)
+            } else if data.count == MemoryLayout<Double>.size {
                 self.handleTimestamp(data)
             } else if let message = String(data: data, encoding: .ascii) {
                 self.handleTextMessage(message)
@@ -150,6 +152,35 @@ class UDPSync: ObservableObject {
         }
     }
     
+    // Probe "SYNQ" seq:uint32 t1:double, answered with "SYNR" seq t1 t2 t3 (little endian)
+    // so the server can measure the round trip and the offset of the local clock
+    private func handleProbe(_ data: Data, on connection: NWConnection) {
+        let receiveTimestamp = Date().timeIntervalSince1970
+        let seq = data.withUnsafeBytes { $0.loadUnaligned(fromByteOffset: 4, as: UInt32.self) }
+        let serverTimestamp = data.withUnsafeBytes { $0.loadUnaligned(fromByteOffset: 8, as: Double.self) }
+
+        var reply = Data("SYNR".utf8)
+        withUnsafeBytes(of: seq.littleEndian) { reply.append(contentsOf: $0) }
+        withUnsafeBytes(of: serverTimestamp.bitPattern.littleEndian) { reply.append(contentsOf: $0) }
+        withUnsafeBytes(of: receiveTimestamp.bitPattern.littleEndian) { reply.append(contentsOf: $0) }
+        withUnsafeBytes(of: Date().timeIntervalSince1970.bitPattern.littleEndian) { reply.append(contentsOf: $0) }
+        connection.send(content: reply, completion: .contentProcessed { error in
+            if let error = error {
+                print("Probe reply error: \(error)")
+            }
+        })
+
+        if !firstTimestampReceived {
+            firstTimestampReceived = true
+            let formatter = DateFormatter()
+            formatter.dateFormat = "yyyy_MM_dd_HH_mm"
+            SharedVariables.shared.uploadFileName = "AppleVisionPro_\(formatter.string(from: Date())).csv"
+        }
+        DispatchQueue.main.async {
+            self.differencesList.append(serverTimestamp - receiveTimestamp)
+        }
+    }
+
     private func handleTextMessage(_ message: String) {
         switch message {
         case "Stop Sync":
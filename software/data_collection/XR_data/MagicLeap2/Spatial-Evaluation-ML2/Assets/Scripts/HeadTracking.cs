@@ -142,7 +142,7 @@ public class HeadTracking : MonoBehaviour
         // Debug.Log("BetaTest: Capturing frame data...");
         var headPosition = headPositionAction.ReadValue<Vector3>();
         var headRotation = headRotationAction.ReadValue<Quaternion>();
-        var currentTime = Time.timeAsDouble;
+        var currentTime = SharedVariables.LocalTime;
 
         if (!SharedVariables.Instance.timestampOffsetComputed)
         {
@@ -33,6 +33,11 @@ public class SharedVariables : MonoBehaviour
 
     // public UnityEvent<bool> SavePointCloudDataEvent;
 
+    // Local clock of the sync probes and the pose timestamps: a monotonic Stopwatch
+    // started once per process, unlike Time.timeAsDouble it advances within a frame
+    private static readonly System.Diagnostics.Stopwatch localClock = System.Diagnostics.Stopwatch.StartNew();
+    public static double LocalTime => localClock.Elapsed.TotalSeconds;
+
     public double timestampOffset = 0;
 
     public bool timestampOffsetComputed = false;
@@ -134,7 +134,11 @@ public class UDPSync : MonoBehaviour
             {
                 byte[] data = receiveClient.Receive(ref remoteEP);
 
-                if (data.Length == sizeof(double)) // Timestamp message
+                if (data.Length == 16 && Encoding.ASCII.GetString(data, 0, 4) == "SYNQ") // Round-trip sync probe
+                {
+                    HandleProbe(data, remoteEP);
+                }
+                else if (data.Length == sizeof(double)) // Timestamp message
                 {
                     // Handle endianness
                     if (!firstTimestampReceived)
@@ -154,7 +158,7 @@ public class UDPSync : MonoBehaviour
                     double serverTimestamp = BitConverter.ToDouble(data, 0);
                     // Debug.Log("Received Timestamp: " + serverTimestamp);
 
-                    double localTimestamp = Time.timeAsDouble;
+                    double localTimestamp = SharedVariables.LocalTime;
                     double difference = serverTimestamp - localTimestamp;
                     // Debug.Log("BetaTest: Difference: " + difference);
 
@@ -195,6 +199,34 @@ public class UDPSync : MonoBehaviour
         }
     }
 
+    // Probe "SYNQ" seq:uint32 t1:double, answered with "SYNR" seq t1 t2 t3 (little endian)
+    // so the server can measure the round trip and the offset of the local clock
+    void HandleProbe(byte[] data, IPEndPoint remoteEP)
+    {
+        double receiveTimestamp = SharedVariables.LocalTime;
+        uint seq = BitConverter.ToUInt32(data, 4);
+        double serverTimestamp = BitConverter.ToDouble(data, 8);
+
+        byte[] reply = new byte[32];
+        Encoding.ASCII.GetBytes("SYNR").CopyTo(reply, 0);
+        BitConverter.GetBytes(seq).CopyTo(reply, 4);
+        BitConverter.GetBytes(serverTimestamp).CopyTo(reply, 8);
+        BitConverter.GetBytes(receiveTimestamp).CopyTo(reply, 16);
+        BitConverter.GetBytes(SharedVariables.LocalTime).CopyTo(reply, 24);
+        receiveClient.Send(reply, reply.Length, remoteEP);
+
+        if (!firstTimestampReceived)
+        {
+            firstTimestampReceived = true;
+            var date = DateTime.Now.ToString("yyyy_MM_dd_HH_mm");
+            SharedVariables.Instance.uploadFileName = $"device_trajectory_logs/MagicLeap2_{date}.csv";
+        }
+        lock (differencesList)
+        {
+            differencesList.Add(serverTimestamp - receiveTimestamp);
+        }
+    }
+
     void ComputeAverageOffset()
     {
         lock (differencesList)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import os
+import mmap
+import argparse
+
+import numpy as np
+
+
+class ViconLogReader:
+    """Windowed reader for the text logs of MultiTrajectoryLogger.
+
+    Every line is "timestamp x y z qx qy qz qw" (TUM) and lines are appended
+    in arrival order, so the timestamps are sorted up to small jitter. The
+    file is memory-mapped and the line of a timestamp is found by binary
+    search over byte offsets. Only the lines of the requested window are
+    parsed, so extracting a trial from a full-day log does not load the log.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        # mmap cannot map an empty file
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b""
+        # The logger may be writing the last line right now
+        self.end = self.mm.rfind(b"\n") + 1 if self.size > 0 else 0
+
+    def close(self):
+        if self.size > 0:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_line_start(self, pos):
+        # First line start at or after pos
+        if pos <= 0:
+            return 0
+        idx = self.mm.find(b"\n", pos - 1, self.end)
+        return self.end if idx < 0 else idx + 1
+
+    def timestamp_at(self, line_start):
+        # None for a line without a timestamp, e.g. one cut by a crash while writing
+        line_end = self.mm.find(b"\n", line_start, self.end)
+        space = self.mm.find(b" ", line_start, self.end if line_end < 0 else line_end)
+        if space < 0:
+            return None
+        try:
+            return float(self.mm[line_start:space])
+        except ValueError:
+            return None
+
+    def find_offset(self, timestamp):
+        """Byte offset of the first line with a timestamp >= timestamp."""
+        lo, hi = 0, self.end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.next_line_start(mid)
+            # Lines without a timestamp are skipped
+            value = self.timestamp_at(start) if start < hi else None
+            while start < hi and value is None:
+                start = self.next_line_start(start + 1)
+                value = self.timestamp_at(start) if start < hi else None
+            if start >= hi:
+                hi = mid
+            elif value < timestamp:
+                lo = self.next_line_start(start + 1)
+            else:
+                hi = start
+        return lo
+
+    def window_offsets(self, start_time=None, end_time=None, margin=0.5):
+        # Byte range holding [start_time, end_time], widened by margin seconds
+        # for out of order stamps
+        begin = 0 if start_time is None else self.find_offset(start_time - margin)
+        end = self.end if end_time is None else self.find_offset(end_time + margin)
+        return begin, end
+
+    @staticmethod
+    def parse(chunk):
+        """Parse complete log lines into an nx8 float64 array."""
+        values = chunk.split()
+        if len(values) % 8 == 0:
+            try:
+                return np.array(values, dtype=np.float64).reshape(-1, 8)
+            except ValueError:
+                pass
+        # Broken lines, e.g. from a crash while writing: skip them
+        rows = []
+        for line in chunk.splitlines():
+            fields = line.split()
+            if len(fields) != 8:
+                continue
+            try:
+                rows.append([float(field) for field in fields])
+            except ValueError:
+                continue
+        return np.array(rows, dtype=np.float64).reshape(-1, 8)
+
+    def read_window(self, start_time=None, end_time=None, margin=0.5):
+        """Poses with start_time <= timestamp <= end_time.
+
+        Returns:
+            timestamps (np.ndarray): n
+            positions_xyz (np.ndarray): nx3
+            orientations_quat_wxyz (np.ndarray): nx4
+        """
+        begin, end = self.window_offsets(start_time, end_time, margin)
+        return self.split(self.select(self.parse(self.mm[begin:end]), start_time, end_time))
+
+    def read_trajectory(self, start_time=None, end_time=None, margin=0.5):
+        # evo is only needed for this one
+        from evo.core.trajectory import PoseTrajectory3D
+        timestamps, positions_xyz, orientations_quat_wxyz = self.read_window(start_time, end_time, margin)
+        return PoseTrajectory3D(positions_xyz, orientations_quat_wxyz, timestamps)
+
+    def iter_blocks(self, start_time=None, end_time=None, block_size=1000, chunk_bytes=1 << 20, margin=0.5):
+        """Yield (timestamps, positions_xyz, orientations_quat_wxyz) blocks.
+
+        Every block has block_size poses, except the last one. The window is
+        parsed chunk by chunk, so memory does not grow with the window.
+        """
+        begin, end = self.window_offsets(start_time, end_time, margin)
+        pending = np.empty((0, 8))
+        while begin < end:
+            # Cut the chunk at a line end
+            stop = min(begin + chunk_bytes, end)
+            if stop < end:
+                stop = self.next_line_start(stop)
+            rows = self.select(self.parse(self.mm[begin:stop]), start_time, end_time)
+            begin = stop
+            pending = np.concatenate((pending, rows)) if len(pending) > 0 else rows
+            while len(pending) >= block_size:
+                yield self.split(pending[:block_size])
+                pending = pending[block_size:]
+        if len(pending) > 0:
+            yield self.split(pending)
+
+    def extract_window(self, output_path, start_time, end_time, margin=0.5):
+        """Write the window as a TUM file and return its number of poses.
+
+        Only the lines within margin seconds of the window edges are parsed
+        to place the out of order stamps. The lines in between are copied
+        as they are, so the cost does not depend on the window length.
+        """
+        if end_time - start_time <= 2 * margin:
+            edges = [(self.find_offset(start_time - margin), self.find_offset(end_time + margin))]
+            body = (0, 0)
+        else:
+            body = (self.find_offset(start_time + margin), self.find_offset(end_time - margin))
+            edges = [(self.find_offset(start_time - margin), body[0]),
+                     (body[1], self.find_offset(end_time + margin))]
+
+        count = 0
+        with open(output_path, "wb") as f:
+            for idx, (begin, end) in enumerate(edges):
+                for line in self.mm[begin:end].splitlines(keepends=True):
+                    try:
+                        timestamp = float(line[:line.index(b" ")])
+                    except ValueError:
+                        continue
+                    if start_time <= timestamp <= end_time and len(line.split()) == 8:
+                        f.write(line)
+                        count += 1
+                if idx == 0 and body[1] > body[0]:
+                    f.write(self.mm[body[0]:body[1]])
+                    count += self.mm[body[0]:body[1]].count(b"\n")
+        return count
+
+    @staticmethod
+    def window_mask(rows, start_time, end_time):
+        keep = np.ones(len(rows), dtype=bool)
+        if start_time is not None:
+            keep &= rows[:, 0] >= start_time
+        if end_time is not None:
+            keep &= rows[:, 0] <= end_time
+        return keep
+
+    @staticmethod
+    def select(rows, start_time, end_time):
+        return rows[ViconLogReader.window_mask(rows, start_time, end_time)]
+
+    @staticmethod
+    def split(rows):
+        # TUM rows to timestamps, positions and (w, x, y, z) quaternions
+        return rows[:, 0], rows[:, 1:4], rows[:, [7, 4, 5, 6]]
+
+
+def read_collection_window(folder="."):
+    # Collection window written by server.py
+    with open(os.path.join(folder, "collection_start.txt"), "r") as f:
+        start_time = float(f.read().strip())
+    with open(os.path.join(folder, "collection_end.txt"), "r") as f:
+        end_time = float(f.read().strip())
+    return start_time, end_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cut a collection window out of ViconLogger logs")
+    parser.add_argument("logs", nargs="+", help="Vicon log files")
+    parser.add_argument("--window-dir", default=".", help="Folder of collection_start.txt and collection_end.txt")
+    parser.add_argument("--start", type=float, default=None, help="Start timestamp, overrides the window files")
+    parser.add_argument("--end", type=float, default=None, help="End timestamp, overrides the window files")
+    parser.add_argument("--output-dir", default="./vicon_trajectory_windows", help="Folder for the cut logs")
+    args = parser.parse_args()
+
+    start_time, end_time = args.start, args.end
+    if start_time is None or end_time is None:
+        window_start, window_end = read_collection_window(args.window_dir)
+        start_time = window_start if start_time is None else start_time
+        end_time = window_end if end_time is None else end_time
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for log_file in args.logs:
+        output_path = os.path.join(args.output_dir, os.path.basename(log_file))
+        with ViconLogReader(log_file) as reader:
+            count = reader.extract_window(output_path, start_time, end_time)
+        print(f"{log_file}: {count} poses in [{start_time}, {end_time}] -> {output_path}")
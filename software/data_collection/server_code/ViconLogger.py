@@ -6,47 +6,198 @@ import os
 import signal
 import sys
 import socket
+import struct
 import threading
+import time
+from collections import deque
+
+from pose_packets import pack_pose_packets, VICON_MAGIC
+
+# One pose per record: timestamp x y z qx qy qz qw, little endian float64
+RECORD = struct.Struct('<8d')
+
+
+class BufferedRecordWriter:
+    """Writes pose records of several objects from a background thread.
+
+    The ROS callbacks only append a tuple to a per-object deque (a single
+    producer / single consumer queue, append and popleft need no lock).
+    The writer thread drains the queues every flush_interval seconds and
+    writes fixed-width binary records, or TUM lines with binary=False. The
+    files are fsynced every fsync_interval seconds, so a crash loses at
+    most fsync_interval seconds of poses plus what is still queued. A queue
+    longer than max_queue drops new poses and counts them. forward(obj,
+    records) is called with every drained batch, e.g. to stream the poses.
+    """
+
+    def __init__(self, file_paths, binary=True, flush_interval=0.05, fsync_interval=1.0,
+                 max_queue=100000, report_interval=10.0, log=print, forward=None):
+        self.binary = binary
+        self.forward = forward
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_queue = max_queue
+        self.report_interval = report_interval
+        self.log = log
+        self.queues = {obj: deque() for obj in file_paths}
+        self.file_handles = {obj: open(path, 'ab' if binary else 'a') for obj, path in file_paths.items()}
+        # Every counter has a single writing thread: the writer thread counts in
+        # counters, put (ROS callback thread) counts the poses of full queues
+        self.counters = {obj: {"written": 0, "dropped": 0, "max_queue_depth": 0} for obj in file_paths}
+        self.queue_full_drops = {obj: 0 for obj in file_paths}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, obj, record):
+        queue = self.queues.get(obj)
+        if queue is None:
+            return
+        if len(queue) >= self.max_queue:
+            self.queue_full_drops[obj] += 1
+            return
+        queue.append(record)
+
+    def _drain(self):
+        for obj, queue in self.queues.items():
+            counters = self.counters[obj]
+            counters["max_queue_depth"] = max(counters["max_queue_depth"], len(queue))
+            records = []
+            try:
+                while True:
+                    records.append(queue.popleft())
+            except IndexError:
+                pass
+            if not records:
+                continue
+            if self.forward is not None:
+                try:
+                    self.forward(obj, records)
+                except (IOError, OSError) as e:
+                    self.log(f"Forward error for {obj}: {str(e)}")
+            if self.binary:
+                data = b''.join(RECORD.pack(*record) for record in records)
+            else:
+                data = ''.join(f"{r[0]} {r[1]} {r[2]} {r[3]} {r[4]} {r[5]} {r[6]} {r[7]}\n" for r in records)
+            try:
+                self.file_handles[obj].write(data)
+                counters["written"] += len(records)
+            except IOError as e:
+                counters["dropped"] += len(records)
+                self.log(f"Write error for {obj}: {str(e)}")
+
+    def _fsync(self):
+        for obj, fh in self.file_handles.items():
+            try:
+                fh.flush()
+                os.fsync(fh.fileno())
+            except (IOError, OSError) as e:
+                self.log(f"Sync error for {obj}: {str(e)}")
+
+    def _run(self):
+        last_fsync = last_report = time.time()
+        while not self.stop_event.wait(self.flush_interval):
+            self._drain()
+            now = time.time()
+            if now - last_fsync >= self.fsync_interval:
+                self._fsync()
+                last_fsync = now
+            if now - last_report >= self.report_interval:
+                self.log(self.report())
+                last_report = now
+
+    def stats(self):
+        # Per object: poses written, dropped, current and max queue depth
+        return {obj: dict(counters, dropped=counters["dropped"] + self.queue_full_drops[obj],
+                          queue_depth=len(self.queues[obj])) for obj, counters in self.counters.items()}
+
+    def report(self):
+        return "Vicon logger: " + ", ".join(
+            f"{obj} written {s['written']} dropped {s['dropped']} queue {s['queue_depth']} (max {s['max_queue_depth']})"
+            for obj, s in self.stats().items())
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        # Poses that arrived after the last drain
+        self._drain()
+        self._fsync()
+        for fh in self.file_handles.values():
+            fh.close()
+
+
+def read_binary_log(file_path):
+    """Records of a binary log as a list of (timestamp, x, y, z, qx, qy, qz, qw)."""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    # A record cut by a crash is ignored
+    data = data[:len(data) - len(data) % RECORD.size]
+    return list(RECORD.iter_unpack(data))
+
+
+def export_tum(bin_path, csv_path=None):
+    """Convert a binary log to the TUM text format of the text logger.
+
+    Returns:
+        csv_path (str): the written file, bin_path with .csv by default
+    """
+    if csv_path is None:
+        csv_path = os.path.splitext(bin_path)[0] + '.csv'
+    with open(csv_path, 'w') as f:
+        f.writelines(f"{r[0]} {r[1]} {r[2]} {r[3]} {r[4]} {r[5]} {r[6]} {r[7]}\n"
+                     for r in read_binary_log(bin_path))
+    return csv_path
+
 
 class MultiTrajectoryLogger:
-    def __init__(self, object_names=None, output_dir='./vicon_trajectory_logs'):
+    def __init__(self, object_names=None, output_dir='./vicon_trajectory_logs', binary=True, export_csv=True,
+                 live_addr=None):
+        # binary: log fixed-width records (.bin) instead of text lines (.csv)
+        # export_csv: convert the binary logs to TUM csv files on stop
+        # live_addr: (host, port) of live_monitor.py to stream the poses to
         self.object_names = object_names or []
         self.output_dir = output_dir
+        self.binary = binary
+        self.export_csv = export_csv
         self.subscribers = []
-        self.file_handles = {}
+        self.file_paths = {}
+        self.writer = None
         self.is_collecting = False
+        self.live_addr = live_addr
+        self.live_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if live_addr else None
 
         os.makedirs(self.output_dir, exist_ok=True)
 
     def _setup_files(self):
         self.base_timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        extension = 'bin' if self.binary else 'csv'
+        self.file_paths = {}
         for obj in self.object_names:
-            filename = f"{obj}_{self.base_timestamp}.csv"
-            file_path = os.path.join(self.output_dir, filename)
-            try:
-                fh = open(file_path, 'a')
-                self.file_handles[obj] = fh
+            filename = f"{obj}_{self.base_timestamp}.{extension}"
+            self.file_paths[obj] = os.path.join(self.output_dir, filename)
+        try:
+            forward = self._forward_live if self.live_socket is not None else None
+            self.writer = BufferedRecordWriter(self.file_paths, binary=self.binary, log=rospy.loginfo,
+                                               forward=forward)
+            for file_path in self.file_paths.values():
                 rospy.loginfo(f"Created log file: {file_path}")
-            except IOError as e:
-                rospy.logerr(f"Error opening file for {obj}: {str(e)}")
+        except IOError as e:
+            rospy.logerr(f"Error opening log files: {str(e)}")
+
+    def _forward_live(self, object_name, records):
+        for packet in pack_pose_packets(VICON_MAGIC, object_name, records):
+            self.live_socket.sendto(packet, self.live_addr)
 
     def _callback_factory(self, object_name):
         def callback(data):
-            if object_name not in self.file_handles:
+            writer = self.writer
+            if writer is None:
                 return
 
-            timestamp = data.header.stamp.secs + data.header.stamp.nsecs / 1e9
+            stamp = data.header.stamp
             t = data.transform.translation
             r = data.transform.rotation
-            
-            entry = (f"{timestamp} {t.x} {t.y} {t.z} "
-                     f"{r.x} {r.y} {r.z} {r.w}\n")
-            
-            try:
-                self.file_handles[object_name].write(entry)
-                self.file_handles[object_name].flush()
-            except IOError as e:
-                rospy.logerr(f"Write error for {object_name}: {str(e)}")
+            writer.put(object_name, (stamp.secs + stamp.nsecs / 1e9, t.x, t.y, t.z, r.x, r.y, r.z, r.w))
 
         return callback
 
@@ -72,13 +223,17 @@ class MultiTrajectoryLogger:
         for sub in self.subscribers:
             sub.unregister()
         self.subscribers.clear()
-        for obj, fh in self.file_handles.items():
-            try:
-                fh.close()
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
+            rospy.loginfo(writer.report())
+            for obj, file_path in self.file_paths.items():
                 rospy.loginfo(f"Closed log file for {obj}")
-            except IOError as e:
-                rospy.logerr(f"Error closing file for {obj}: {str(e)}")
-        self.file_handles.clear()
+                if self.binary and self.export_csv:
+                    try:
+                        rospy.loginfo(f"Exported {export_tum(file_path)}")
+                    except IOError as e:
+                        rospy.logerr(f"Error exporting {file_path}: {str(e)}")
         self.is_collecting = False
 
 def signal_handler(sig, frame):
@@ -121,9 +276,21 @@ def udp_listener(logger):
             rospy.logerr(f"Error in UDP listener: {str(e)}")
 
 if __name__ == '__main__':
+    # --export <file.bin> ... converts binary logs left by a killed logger to TUM csv files
+    if '--export' in sys.argv:
+        for bin_path in sys.argv[sys.argv.index('--export') + 1:]:
+            print(f"Exported {export_tum(bin_path)}")
+        sys.exit(0)
+
     rospy.init_node('multi_trajectory_logger', anonymous=True)  # 
 
-    logger = MultiTrajectoryLogger(object_names=[], output_dir='./vicon_trajectory_logs')
+    # --live host:port streams the poses to live_monitor.py
+    argv = rospy.myargv(argv=sys.argv)
+    live_addr = None
+    if '--live' in argv:
+        host, _, port = argv[argv.index('--live') + 1].partition(':')
+        live_addr = (host, int(port))
+    logger = MultiTrajectoryLogger(object_names=[], output_dir='./vicon_trajectory_logs', live_addr=live_addr)
     
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
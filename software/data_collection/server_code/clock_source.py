@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import math
+import struct
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+# Clock sources for the sync server. A source keeps its latest sample as one
+# (timestamp, received) tuple attribute: the receiving thread replaces the
+# tuple and readers take it in one attribute read, so latest() needs no lock.
+#   timestamp: ROS time of the latest Vicon message
+#   received: time.monotonic() when the sample arrived in the process that
+#             received it (CLOCK_MONOTONIC is shared by the processes)
+
+
+class ClockSource:
+    name = "base"
+
+    def __init__(self):
+        self.sample = (0.0, time.monotonic())
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def latest(self):
+        """(timestamp, received) of the latest sample"""
+        return self.sample
+
+    def now(self):
+        return self.latest()[0]
+
+    def extrapolated(self):
+        # Latest timestamp advanced by the time since it was received, for
+        # stamps finer than the Vicon rate
+        timestamp, received = self.latest()
+        return timestamp + (time.monotonic() - received)
+
+
+class SystemClock(ClockSource):
+    # Wall clock, for runs without ROS
+    name = "system"
+
+    def latest(self):
+        return time.time(), time.monotonic()
+
+
+class SimulatedClock(ClockSource):
+    """Clock advancing like a Vicon stream of rate Hz, starting at start.
+
+    The latest sample is the last tick before now, so the source-to-send
+    latency is spread over one tick as with the real stream.
+    """
+    name = "simulated"
+
+    def __init__(self, start=0.0, rate=100.0):
+        super().__init__()
+        self.start_time = start
+        self.rate = rate
+        self.t0 = time.monotonic()
+
+    def latest(self):
+        ticks = math.floor((time.monotonic() - self.t0) * self.rate)
+        return self.start_time + ticks / self.rate, self.t0 + ticks / self.rate
+
+
+class RosClock(ClockSource):
+    """In-process subscription to a Vicon topic.
+
+    The rospy callback thread stores the header stamp, so no pipe or text
+    formatting is between the message and the sync packets.
+    """
+    name = "ros"
+
+    def __init__(self, topic="/vicon/wand/wand"):
+        super().__init__()
+        self.topic = topic
+        self.subscriber = None
+
+    def callback(self, data):
+        self.sample = (data.header.stamp.to_sec(), time.monotonic())
+
+    def start(self):
+        import rospy
+        from geometry_msgs.msg import TransformStamped
+        # The asyncio loop of the server owns the signals
+        rospy.init_node('sync_server_clock', anonymous=True, disable_signals=True)
+        self.subscriber = rospy.Subscriber(self.topic, TransformStamped, self.callback, queue_size=1,
+                                           tcp_nodelay=True)
+
+    def stop(self):
+        if self.subscriber is not None:
+            self.subscriber.unregister()
+            self.subscriber = None
+
+
+class SubprocessClock(ClockSource):
+    # Timestamps printed by listener_time.py, the former setup
+    name = "subprocess"
+
+    def __init__(self, command=("python3", "-u", "listener_time.py")):
+        super().__init__()
+        self.command = list(command)
+        self.process = None
+        self.thread = None
+
+    def run(self):
+        for line in self.process.stdout:
+            try:
+                self.sample = (float(line.strip()), time.monotonic())
+            except ValueError:
+                print(f"Invalid timestamp received: {line}")
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, text=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+# Shared memory ring: a uint64 write counter followed by SHM_SLOTS slots of
+# (sequence, timestamp, received). The writer fills slot counter % SHM_SLOTS
+# and then increments the counter. The reader takes the slot of counter - 1
+# and accepts it if its sequence still matches, otherwise it was overwritten
+# while reading and the reader retries.
+SHM_SLOTS = 64
+SHM_HEADER = struct.Struct("<Q")
+SHM_SLOT = struct.Struct("<Qdd")
+SHM_SIZE = SHM_HEADER.size + SHM_SLOTS * SHM_SLOT.size
+SHM_NAME = "xr_sync_clock"
+
+
+class SharedClockWriter:
+    """Writer side of the shared memory ring, used by listener_time.py --shm"""
+
+    def __init__(self, name=SHM_NAME):
+        from multiprocessing import shared_memory
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=SHM_SIZE)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.count = SHM_HEADER.unpack_from(self.buf, 0)[0]
+
+    def write(self, timestamp, received=None):
+        received = time.monotonic() if received is None else received
+        SHM_SLOT.pack_into(self.buf, SHM_HEADER.size + (self.count % SHM_SLOTS) * SHM_SLOT.size,
+                           self.count, timestamp, received)
+        self.count += 1
+        SHM_HEADER.pack_into(self.buf, 0, self.count)
+
+    def close(self, unlink=True):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class SharedMemoryClock(ClockSource):
+    """Reader side of the shared memory ring written by another process"""
+    name = "shm"
+
+    def __init__(self, name=SHM_NAME):
+        super().__init__()
+        self.shm_name = name
+        self.shm = None
+
+    def start(self):
+        from multiprocessing import shared_memory
+        self.shm = shared_memory.SharedMemory(name=self.shm_name)
+
+    def latest(self):
+        if self.shm is None:
+            return self.sample
+        buf = self.shm.buf
+        for _ in range(SHM_SLOTS):
+            count = SHM_HEADER.unpack_from(buf, 0)[0]
+            if count == 0:
+                return self.sample
+            seq, timestamp, received = SHM_SLOT.unpack_from(
+                buf, SHM_HEADER.size + ((count - 1) % SHM_SLOTS) * SHM_SLOT.size)
+            if seq == count - 1:
+                self.sample = (timestamp, received)
+                break
+        return self.sample
+
+    def stop(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+class LatencyHistogram:
+    """Histogram of latencies in seconds with fixed bins.
+
+    Args:
+        bin_width: seconds per bin
+        max_latency: upper edge of the last regular bin, larger values are
+                     counted in an overflow bin
+    """
+
+    def __init__(self, bin_width=0.0001, max_latency=0.05):
+        self.bin_width = bin_width
+        self.counts = np.zeros(int(round(max_latency / bin_width)) + 1, dtype=np.int64)
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, latency):
+        idx = min(int(max(latency, 0.0) / self.bin_width), len(self.counts) - 1)
+        self.counts[idx] += 1
+        self.total += 1
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        # Upper edge of the bin holding the q-th percentile
+        if self.total == 0:
+            return 0.0
+        idx = int(np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.total))
+        if idx >= len(self.counts) - 1:
+            return self.max
+        return min((idx + 1) * self.bin_width, self.max)
+
+    def summary(self):
+        return {"count": self.total,
+                "p50_ms": 1000 * self.percentile(50),
+                "p90_ms": 1000 * self.percentile(90),
+                "p99_ms": 1000 * self.percentile(99),
+                "max_ms": 1000 * self.max}
+
+
+def make_clock(name, topic="/vicon/wand/wand", shm_name=SHM_NAME, start=0.0):
+    if name == "ros":
+        return RosClock(topic)
+    if name == "shm":
+        return SharedMemoryClock(shm_name)
+    if name == "subprocess":
+        return SubprocessClock()
+    if name == "simulated":
+        return SimulatedClock(start)
+    if name == "system":
+        return SystemClock()
+    raise ValueError(f"Unknown clock source {name}, use ros, shm, subprocess, simulated or system")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import json
+import struct
+import time
+
+import numpy as np
+
+# Round-trip sync probes, all little endian:
+#   request  server -> device  "SYNQ" seq:uint32 t1:double
+#   reply    device -> server  "SYNR" seq:uint32 t1:double t2:double t3:double
+# t1: server send time (ROS time), t2: device receive time, t3: device send
+# time (device clock), t4: server receive time of the reply (ROS time).
+PROBE_REQUEST = struct.Struct("<4sId")
+PROBE_REPLY = struct.Struct("<4sIddd")
+REQUEST_MAGIC = b"SYNQ"
+REPLY_MAGIC = b"SYNR"
+SYNC_REPORT_FILE = "sync_report.json"
+
+
+def probe_offsets(probes):
+    """Offset and round trip time of every probe.
+
+    Args:
+        probes (np.ndarray): nx4 array of (t1, t2, t3, t4)
+    Returns:
+        offsets (np.ndarray): device clock minus ROS time, n
+        rtts (np.ndarray): round trip time without the device turnaround, n
+    """
+    t1, t2, t3, t4 = probes.T
+    return ((t2 - t1) + (t3 - t4)) / 2, (t4 - t1) - (t3 - t2)
+
+
+def estimate_clock_offset(probes, keep_fraction=0.25, min_probes=3):
+    """Offset, drift and uncertainty of a device clock from its sync probes.
+
+    Only the probes with the smallest round trip times are used, their
+    offset error is bounded by half the round trip time. With enough of them
+    the offset is fitted as a line over the server time, the slope is the
+    drift of the device clock.
+
+    Args:
+        probes (np.ndarray): nx4 array of (t1, t2, t3, t4)
+        keep_fraction (float): fraction of the probes kept by round trip time
+        min_probes (int): minimum number of probes kept
+    Returns:
+        result (dict): "time" (ROS time the offset refers to), "offset"
+                       (device clock minus ROS time at "time"), "drift"
+                       (seconds per second), "uncertainty", "min_rtt",
+                       "median_rtt", "probes_received", "probes_used",
+                       "device_correction" (mean server minus device time,
+                       as applied by the device apps) and "est_offset"
+                       (offset to add to the corrected device timestamps)
+        None if there are no probes
+    """
+    probes = np.asarray(probes, dtype=np.float64).reshape(-1, 4)
+    if len(probes) == 0:
+        return None
+    offsets, rtts = probe_offsets(probes)
+    keep = np.argsort(rtts)[:max(min_probes, int(np.ceil(keep_fraction * len(probes))))]
+    mid_times = (probes[keep, 0] + probes[keep, 3]) / 2
+    ref_time = float(np.median(mid_times))
+
+    drift = 0.0
+    offset = float(np.median(offsets[keep]))
+    residual_std = 0.0
+    if len(keep) >= 3 and np.ptp(mid_times) > 1.0:
+        drift, offset = np.polyfit(mid_times - ref_time, offsets[keep], 1)
+        residual_std = float(np.std(offsets[keep] - (offset + drift * (mid_times - ref_time)), ddof=2)
+                             if len(keep) > 3 else 0.0)
+    elif len(keep) > 1:
+        residual_std = float(np.std(offsets[keep], ddof=1))
+
+    # The apps average server minus device time of the received timestamps
+    device_correction = float(np.mean(probes[:, 0] - probes[:, 1]))
+    return {
+        "time": ref_time,
+        "offset": float(offset),
+        "drift": float(drift),
+        "uncertainty": float(np.min(rtts) / 2 + residual_std),
+        "min_rtt": float(np.min(rtts)),
+        "median_rtt": float(np.median(rtts)),
+        "probes_received": int(len(probes)),
+        "probes_used": int(len(keep)),
+        "device_correction": device_correction,
+        "est_offset": float(-offset - device_correction),
+    }
+
+
+def append_sync_report(device_name, result, report_file=SYNC_REPORT_FILE, **info):
+    """Append the sync result of one device to the sync report.
+
+    The report is {"syncs": [...]} with one entry per device sync, the
+    analysis picks the latest sync of a device before a trajectory.
+    """
+    report = {"syncs": []}
+    if os.path.exists(report_file):
+        with open(report_file, "r") as f:
+            report = json.load(f)
+    entry = {"device": device_name, "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    entry.update(result)
+    entry.update(info)
+    report["syncs"].append(entry)
+    tmp_file = "{}.{}.tmp".format(report_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_file, report_file)
+    return entry
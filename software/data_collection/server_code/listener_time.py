@@ -1,20 +1,36 @@
 #!/usr/bin/env python3
 import rospy
 from geometry_msgs.msg import TransformStamped
-import os
-import socket
-from datetime import datetime
+import argparse
 import time
 
+from clock_source import SharedClockWriter, SHM_NAME
+
+writer = None
+
 def callback(data):
     # Combine secs and nsecs into a millisecond-level timestamp
     timestamp = data.header.stamp.secs + data.header.stamp.nsecs / 1000000000
-    print(timestamp)
+    if writer is not None:
+        writer.write(timestamp, time.monotonic())
+    else:
+        print(timestamp)
 
-def listener():
+def listener(topic):
     rospy.init_node('listener', anonymous=True)
-    rospy.Subscriber("/vicon/wand/wand", TransformStamped, callback)
+    rospy.Subscriber(topic, TransformStamped, callback)
     rospy.spin()
 
 if __name__ == '__main__':
-    listener()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Vicon timestamps for the sync server")
+    parser.add_argument('--topic', default="/vicon/wand/wand")
+    parser.add_argument('--shm', nargs='?', const=SHM_NAME, default=None,
+                        help="Write to the shared memory ring for server.py --clock shm instead of stdout")
+    args = parser.parse_args(rospy.myargv()[1:])
+    if args.shm is not None:
+        writer = SharedClockWriter(args.shm)
+    try:
+        listener(args.topic)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+from collections import deque
+
+import numpy as np
+
+from pose_packets import PACKET_HEADER, RECORD, DEVICE_MAGIC, VICON_MAGIC, pack_pose_packets
+
+# Incremental Umeyama alignment shared with the offline evaluation
+ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "analysis")
+sys.path.append(ANALYSIS_DIR)
+import onlineAlign
+
+
+def unpack_pose_packet(data):
+    """(magic, name, nx8 records) of a packet, None if it is not a pose packet"""
+    if len(data) < PACKET_HEADER.size:
+        return None
+    magic, name, count = PACKET_HEADER.unpack_from(data)
+    if magic not in (DEVICE_MAGIC, VICON_MAGIC) or len(data) != PACKET_HEADER.size + count * RECORD.size:
+        return None
+    records = np.frombuffer(data, dtype='<f8', offset=PACKET_HEADER.size).reshape(count, 8)
+    return magic, name.rstrip(b'\0').decode(), records
+
+
+class PoseRing:
+    """Bounded buffer of the latest rows, readable as one contiguous array.
+
+    Rows are appended to a buffer of twice the capacity; when it is full the
+    last capacity rows move to the front. view() never copies.
+    """
+
+    def __init__(self, capacity, columns=8):
+        self.capacity = capacity
+        self.data = np.empty((2 * capacity, columns))
+        self.start = 0
+        self.end = 0
+        self.total = 0
+
+    def append(self, rows):
+        rows = rows[-self.capacity:]
+        n = len(rows)
+        if self.end + n > len(self.data):
+            keep = min(self.end - self.start, self.capacity - n)
+            self.data[:keep] = self.data[self.end - keep:self.end]
+            self.start, self.end = 0, keep
+        self.data[self.end:self.end + n] = rows
+        self.end += n
+        self.start = max(self.start, self.end - self.capacity)
+        self.total += n
+
+    def view(self):
+        return self.data[self.start:self.end]
+
+    def since(self, total):
+        # Rows appended after the first total rows, as far as still buffered
+        return self.view()[max(0, len(self.view()) - (self.total - total)):]
+
+    def __len__(self):
+        return self.end - self.start
+
+
+class SlidingUmeyama:
+    """Rigid alignment (Umeyama, no scale) of the point pairs of a time window.
+
+    The pair sums are an onlineAlign.AlignmentStats: new pairs are added,
+    expired pairs removed, so the alignment and its RMSE cost O(1) per
+    pair. The sums are recomputed from the pairs every recompute_every
+    expiries against rounding drift.
+    """
+
+    def __init__(self, window, capacity=100000, recompute_every=10000):
+        self.window = window
+        self.pairs = PoseRing(capacity, columns=7)
+        self.recompute_every = recompute_every
+        self.expired = 0
+        self.stats = onlineAlign.AlignmentStats()
+
+    def add(self, timestamps, x, y):
+        """Add pairs, x: estimated positions, y: reference positions (nx3)"""
+        if len(self.pairs) + len(timestamps) > self.pairs.capacity:
+            self.expire(np.inf, keep=self.pairs.capacity - len(timestamps))
+        self.pairs.append(np.column_stack((timestamps, x, y)))
+        self.stats.add(x, y)
+        self.expire(timestamps[-1] - self.window)
+
+    def expire(self, min_time, keep=None):
+        pairs = self.pairs.view()
+        count = int(np.searchsorted(pairs[:, 0], min_time))
+        if keep is not None:
+            count = max(count, len(pairs) - keep)
+        if count == 0:
+            return
+        old = pairs[:count]
+        self.pairs.start += count
+        self.expired += count
+        if self.expired >= self.recompute_every:
+            self.expired = 0
+            pairs = self.pairs.view()
+            self.stats = onlineAlign.AlignmentStats()
+            self.stats.add(pairs[:, 1:4], pairs[:, 4:7])
+        else:
+            self.stats.remove(old[:, 1:4], old[:, 4:7])
+
+    def solve(self):
+        """(rotation, translation, scale) with y ~ R x + t, None with less than 3 pairs"""
+        if self.stats.n < 3:
+            return None
+        return self.stats.solve()
+
+    def rmse(self):
+        alignment = self.solve()
+        return None if alignment is None else self.stats.rmse(alignment)
+
+
+class DeviceMonitor:
+    """Live error and packet metrics of one device"""
+
+    def __init__(self, name, reference, window=10.0, rpe_delta=1.0, capacity=20000, offset=0.0, lever_arm=None):
+        self.name = name
+        self.reference = reference
+        self.offset = offset
+        self.lever_arm = lever_arm
+        self.rpe_delta = rpe_delta
+        self.ring = PoseRing(capacity)
+        self.processed = 0
+        self.alignment = SlidingUmeyama(window)
+        # (time, squared relative error) of the window
+        self.rpe_errors = deque()
+        self.rpe_sum = 0.0
+        self.packets = 0
+        self.arrivals = deque()
+        self.last_arrival = None
+        self.gaps = 0
+        self.unmatched = 0
+
+    def receive(self, records, arrival, gap_threshold=0.5):
+        if self.last_arrival is not None and arrival - self.last_arrival > gap_threshold:
+            self.gaps += 1
+        self.last_arrival = arrival
+        self.packets += 1
+        self.arrivals.append((arrival, len(records)))
+        records = records.copy()
+        records[:, 0] += self.offset
+        self.ring.append(records)
+
+    def packet_rate(self, now, span=5.0):
+        while self.arrivals and self.arrivals[0][0] < now - span:
+            self.arrivals.popleft()
+        return len(self.arrivals) / span, sum(count for _, count in self.arrivals) / span
+
+    def update(self, vicon, max_diff):
+        """Match the new device poses with the Vicon poses, returns the number of new pairs"""
+        new_rows = self.ring.since(self.processed)
+        reference = vicon.view()
+        if len(new_rows) == 0 or len(reference) < 2:
+            return 0
+        # Wait for the Vicon poses after the device poses
+        later = new_rows[:, 0] > reference[-1, 0]
+        ready = int(np.argmax(later)) if np.any(later) else len(new_rows)
+        if ready == 0:
+            return 0
+        rows = new_rows[:ready]
+        self.processed = self.ring.total - len(new_rows) + ready
+
+        # Linear interpolation between the enclosing Vicon poses
+        ref_times = reference[:, 0]
+        upper = np.clip(np.searchsorted(ref_times, rows[:, 0]), 1, len(ref_times) - 1)
+        lower = upper - 1
+        span = ref_times[upper] - ref_times[lower]
+        valid = (span <= 2 * max_diff) & (rows[:, 0] >= ref_times[lower]) & (span > 0)
+        self.unmatched += int(np.count_nonzero(~valid))
+        if not np.any(valid):
+            return 0
+        rows, lower, upper, span = rows[valid], lower[valid], upper[valid], span[valid]
+        weight = ((rows[:, 0] - ref_times[lower]) / span)[:, None]
+        ref_xyz = (1 - weight) * reference[lower, 1:4] + weight * reference[upper, 1:4]
+        if self.lever_arm is not None:
+            ref_xyz = ref_xyz + rotate(reference[lower, 4:8], self.lever_arm)
+
+        self.alignment.add(rows[:, 0], rows[:, 1:4], ref_xyz)
+        self.update_rpe(rows[:, 0])
+        return len(rows)
+
+    def update_rpe(self, timestamps):
+        # Relative position error over rpe_delta, in the frame of the current alignment
+        solution = self.alignment.solve()
+        if solution is None:
+            return
+        rotation = solution[0]
+        pairs = self.alignment.pairs.view()
+        times = pairs[:, 0]
+        current = np.searchsorted(times, timestamps)
+        previous = np.searchsorted(times, timestamps - self.rpe_delta)
+        valid = (previous < current) & (current < len(times))
+        valid[valid] &= np.abs(times[previous[valid]] - (timestamps[valid] - self.rpe_delta)) < 0.1 * self.rpe_delta
+        if not np.any(valid):
+            return
+        current, previous = current[valid], previous[valid]
+        est_delta = (pairs[current, 1:4] - pairs[previous, 1:4]).dot(rotation.T)
+        ref_delta = pairs[current, 4:7] - pairs[previous, 4:7]
+        errors = np.sum((est_delta - ref_delta) ** 2, axis=1)
+        for timestamp, error in zip(timestamps[valid], errors):
+            self.rpe_errors.append((timestamp, error))
+        self.rpe_sum += float(errors.sum())
+        min_time = timestamps[-1] - self.alignment.window
+        while self.rpe_errors and self.rpe_errors[0][0] < min_time:
+            self.rpe_sum -= self.rpe_errors.popleft()[1]
+
+    def metrics(self, now):
+        packet_rate, pose_rate = self.packet_rate(now)
+        latest = self.ring.view()[-1, 0] if len(self.ring) else None
+        return {
+            "reference": self.reference,
+            "packets": self.packets,
+            "poses": self.ring.total,
+            "packet_rate": packet_rate,
+            "pose_rate": pose_rate,
+            "since_last_packet": None if self.last_arrival is None else now - self.last_arrival,
+            "gaps": self.gaps,
+            "latest_timestamp": latest,
+            "window_pairs": self.alignment.stats.n,
+            "unmatched": self.unmatched,
+            "ape_rmse": self.alignment.rmse(),
+            "rpe_rmse": float(np.sqrt(max(self.rpe_sum, 0.0) / len(self.rpe_errors))) if self.rpe_errors else None,
+        }
+
+
+def rotate(quats_xyzw, vector):
+    # Rotate one vector by every quaternion (x, y, z, w)
+    u, w = quats_xyzw[:, :3], quats_xyzw[:, 3:]
+    uv = np.cross(u, vector)
+    return vector + 2 * (w * uv + np.cross(u, uv))
+
+
+class LiveMonitorProtocol(asyncio.DatagramProtocol):
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def datagram_received(self, data, addr):
+        self.monitor.handle_packet(data, addr)
+
+
+class LiveMonitor:
+    """Online APE/RPE of the streaming devices against the Vicon stream.
+
+    Args:
+        window: seconds of the sliding alignment and error window
+        rpe_delta: seconds between the poses of the relative error
+        max_diff: max seconds between a device pose and the Vicon poses
+        references: device name -> Vicon object, default the same name
+        offsets: device name -> seconds added to its timestamps
+        lever_arms: device name -> device origin in the Vicon body frame
+    """
+
+    def __init__(self, window=10.0, rpe_delta=1.0, max_diff=0.02, references=None, offsets=None, lever_arms=None,
+                 vicon_capacity=20000):
+        self.window = window
+        self.rpe_delta = rpe_delta
+        self.max_diff = max_diff
+        self.references = references or {}
+        self.offsets = offsets or {}
+        self.lever_arms = lever_arms or {}
+        self.vicon_capacity = vicon_capacity
+        self.vicon = {}
+        self.devices = {}
+        self.invalid_packets = 0
+        self.started = time.monotonic()
+
+    def handle_packet(self, data, addr=None):
+        packet = unpack_pose_packet(data)
+        if packet is None:
+            self.invalid_packets += 1
+            return
+        magic, name, records = packet
+        if magic == VICON_MAGIC:
+            if name not in self.vicon:
+                self.vicon[name] = PoseRing(self.vicon_capacity)
+            self.vicon[name].append(records)
+            return
+        device = self.devices.get(name)
+        if device is None:
+            device = DeviceMonitor(name, self.references.get(name, name), self.window, self.rpe_delta,
+                                   offset=self.offsets.get(name, 0.0), lever_arm=self.lever_arms.get(name))
+            self.devices[name] = device
+            print(f"New device stream: {name} from {addr}")
+        device.receive(records, time.monotonic())
+
+    def update(self):
+        for device in self.devices.values():
+            vicon = self.vicon.get(device.reference)
+            if vicon is not None:
+                device.update(vicon, self.max_diff)
+
+    def metrics(self):
+        now = time.monotonic()
+        return {
+            "uptime": now - self.started,
+            "invalid_packets": self.invalid_packets,
+            "vicon": {name: {"poses": ring.total, "latest_timestamp": ring.view()[-1, 0] if len(ring) else None}
+                      for name, ring in self.vicon.items()},
+            "devices": {name: device.metrics(now) for name, device in self.devices.items()},
+        }
+
+    async def run_updates(self, interval=0.1):
+        while True:
+            self.update()
+            await asyncio.sleep(interval)
+
+    async def handle_http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()).strip():
+                pass
+            path = request.split()[1].decode() if len(request.split()) > 1 else '/'
+            if path.startswith('/metrics'):
+                body, content_type = json.dumps(self.metrics()).encode(), 'application/json'
+            else:
+                body, content_type = DASHBOARD_HTML.encode(), 'text/html'
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='0.0.0.0', port=7000, http_host='127.0.0.1', http_port=8080):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: LiveMonitorProtocol(self), local_addr=(host, port))
+        http_server = await asyncio.start_server(self.handle_http, http_host, http_port)
+        print(f"Pose streams on udp {host}:{port}, dashboard on http://{http_host}:{http_port}/")
+        async with http_server:
+            await self.run_updates()
+
+
+DASHBOARD_HTML = """<!DOCTYPE html>
+<html><head><title>Live tracking errors</title>
+<style>body{font-family:sans-serif} td,th{padding:4px 12px;text-align:right} .bad{color:#c00}</style></head>
+<body><h3>Live tracking errors</h3><table id="t"></table>
+<script>
+const cols = ["packet_rate", "pose_rate", "since_last_packet", "gaps", "window_pairs", "ape_rmse", "rpe_rmse"];
+function fmt(v) { return v === null ? "-" : (typeof v === "number" ? v.toFixed(3) : v); }
+async function refresh() {
+  const m = await (await fetch("/metrics")).json();
+  let html = "<tr><th>device</th>" + cols.map(c => "<th>" + c + "</th>").join("") + "</tr>";
+  for (const [name, d] of Object.entries(m.devices)) {
+    const stale = d.since_last_packet !== null && d.since_last_packet > 1.0;
+    html += "<tr class='" + (stale ? "bad" : "") + "'><td>" + name + "</td>"
+          + cols.map(c => "<td>" + fmt(d[c]) + "</td>").join("") + "</tr>";
+  }
+  document.getElementById("t").innerHTML = html;
+}
+setInterval(refresh, 1000); refresh();
+</script></body></html>
+"""
+
+
+def load_tum(file_path):
+    # TUM csv as an nx8 array, header and comment lines skipped
+    return np.loadtxt(file_path, comments='#', ndmin=2)
+
+
+def replay(streams, addr, speed=1.0, interval=0.01):
+    """Send recorded TUM files as live pose packets, paced by their timestamps.
+
+    Args:
+        streams: list of (magic, name, TUM file path), DEVICE_MAGIC for
+                 device streams and VICON_MAGIC for Vicon objects
+        addr: (host, port) of the live monitor
+        speed: replay speed, 2.0 replays twice as fast
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = [(magic, name, load_tum(file_path)) for magic, name, file_path in streams]
+    start_time = min(rows[0, 0] for _, _, rows in data if len(rows))
+    end_time = max(rows[-1, 0] for _, _, rows in data if len(rows))
+    sent = [0] * len(data)
+    t0 = time.monotonic()
+    while True:
+        now = start_time + (time.monotonic() - t0) * speed
+        for idx, (magic, name, rows) in enumerate(data):
+            stop = int(np.searchsorted(rows[:, 0], now, side='right'))
+            if stop > sent[idx]:
+                for packet in pack_pose_packets(magic, name, rows[sent[idx]:stop].tolist()):
+                    sock.sendto(packet, addr)
+                sent[idx] = stop
+        if now > end_time:
+            break
+        time.sleep(interval)
+    sock.close()
+    return sent
+
+
+def parse_pairs(values, convert=str):
+    # ["a=b", ...] -> {"a": convert("b")}
+    pairs = {}
+    for value in values or []:
+        key, _, item = value.partition('=')
+        pairs[key] = convert(item)
+    return pairs
+
+
+def lever_arms_from_calibration(calibration_file, devices):
+    # Translation of the device extrinsics, see analysis/extrinsics.py
+    import extrinsics
+    registry = extrinsics.get_registry(calibration_file)
+    return {device: registry.transform(device)[:3, 3] for device in devices or registry.devices()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Live pose streaming monitor and replay tool")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="Receive pose streams and serve the error dashboard")
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=7000, help="UDP port of the pose packets")
+    serve_parser.add_argument('--http-port', type=int, default=8080, help="Port of the json/html dashboard")
+    serve_parser.add_argument('--window', type=float, default=10.0, help="Seconds of the alignment window")
+    serve_parser.add_argument('--rpe-delta', type=float, default=1.0, help="Seconds of the relative error")
+    serve_parser.add_argument('--max-diff', type=float, default=0.02, help="Max seconds to the Vicon poses")
+    serve_parser.add_argument('--reference', nargs='*', help="device=ViconObject, default the device name")
+    serve_parser.add_argument('--offset', nargs='*', help="device=seconds added to the device timestamps")
+    serve_parser.add_argument('--calibration', default=None, help="Extrinsics file for the device lever arms")
+
+    replay_parser = subparsers.add_parser('replay', help="Send recorded TUM files as live streams")
+    replay_parser.add_argument('--device', nargs='*', default=[], help="name=file.csv device streams")
+    replay_parser.add_argument('--vicon', nargs='*', default=[], help="name=file.csv Vicon streams")
+    replay_parser.add_argument('--target', default='127.0.0.1:7000', help="host:port of the live monitor")
+    replay_parser.add_argument('--speed', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        offsets = parse_pairs(args.offset, float)
+        lever_arms = lever_arms_from_calibration(args.calibration, None) if args.calibration else None
+        monitor = LiveMonitor(args.window, args.rpe_delta, args.max_diff, parse_pairs(args.reference), offsets,
+                              lever_arms)
+        try:
+            asyncio.run(monitor.serve(args.host, args.port, http_port=args.http_port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        host, _, port = args.target.partition(':')
+        streams = ([(DEVICE_MAGIC, name, path) for name, path in parse_pairs(args.device).items()]
+                   + [(VICON_MAGIC, name, path) for name, path in parse_pairs(args.vicon).items()])
+        sent = replay(streams, (host, int(port)), args.speed)
+        print("Sent " + ", ".join(f"{name}: {count}" for (_, name, _), count in zip(streams, sent)))
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import struct
+
+# Pose packets, little endian: header (magic, name, count) followed by count
+# records "timestamp x y z qx qy qz qw" (same record as the Vicon logs).
+# ViconLogger --live forwards VICN packets of its objects. The device apps
+# (ML2, AVP) do not stream POSE packets yet, they only upload their csv
+# after a trial; device streams come from 'live_monitor.py replay' of
+# recorded files or any client sending this packet format.
+# Standard library only, ViconLogger imports it on the capture machine.
+PACKET_HEADER = struct.Struct('<4s16sH')
+RECORD = struct.Struct('<8d')
+DEVICE_MAGIC = b'POSE'
+VICON_MAGIC = b'VICN'
+# Keeps a packet below a typical MTU
+MAX_RECORDS = 20
+
+
+def pack_pose_packets(magic, name, records):
+    """Packets for a list of records, MAX_RECORDS records per packet"""
+    name_bytes = name.encode()[:16]
+    packets = []
+    for start in range(0, len(records), MAX_RECORDS):
+        chunk = records[start:start + MAX_RECORDS]
+        packets.append(PACKET_HEADER.pack(magic, name_bytes, len(chunk))
+                       + b''.join(RECORD.pack(*record) for record in chunk))
+    return packets
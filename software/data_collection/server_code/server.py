@@ -1,215 +1,432 @@
+import asyncio
+import argparse
+import json
+import os
 import socket
-import threading
-import time
 import struct
-import subprocess
 import sys
-import copy
-
-# Shared timestamp with thread-safe access
-current_timestamp = 0.0
-timestamp_lock = threading.Lock()
-
-# Device management
-devices = {}
-devices_lock = threading.Lock()
-
-def timestamp_updater():
-    """Update global timestamp from ROS listener subprocess"""
-    global current_timestamp
-    
-    process = subprocess.Popen(
-        ['python3', '-u', 'listener_time.py'],
-        stdout=subprocess.PIPE,
-        text=True,
-        bufsize=0
-    )
-    
-    try:
+import time
+
+from clock_source import make_clock, LatencyHistogram
+from clock_sync import (PROBE_REQUEST, PROBE_REPLY, REQUEST_MAGIC, REPLY_MAGIC, SYNC_REPORT_FILE,
+                        estimate_clock_offset, append_sync_report)
+
+# Device states
+SYNCING = 'syncing'
+SYNCED = 'synced'
+COLLECTING = 'collecting'
+
+
+class DeviceSession:
+    """State of one registered device: syncing -> synced -> collecting."""
+
+    def __init__(self, name, ip, port):
+        self.name = name
+        self.ip = ip
+        self.addr = (ip, port)
+        self.status = SYNCING
+        self.sync_end = None
+        self.registrations = 1
+        self.packets_sent = 0
+        # Round-trip probes: seq -> t1 of the sent ones, (t1, t2, t3, t4) of the answered ones
+        self.pending = {}
+        self.probes = []
+        self.sync_result = None
+
+    def restart_sync(self, sync_end):
+        self.status = SYNCING
+        self.sync_end = sync_end
+        self.pending = {}
+        self.probes = []
+
+    def as_dict(self):
+        return {'ip': self.ip, 'addr': list(self.addr), 'status': self.status,
+                'registrations': self.registrations, 'packets_sent': self.packets_sent,
+                'probes_received': len(self.probes), 'sync_result': self.sync_result}
+
+
+class SyncServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data[:4] == REPLY_MAGIC:
+            self.server.handle_probe_reply(data, addr)
+        else:
+            self.server.handle_registration(data, addr)
+
+    def error_received(self, exc):
+        print(f"Error receiving data: {exc}")
+
+
+class SyncServer:
+    """ROS time sync and collection control for the XR devices.
+
+    One asyncio event loop serves all devices. Devices register with a
+    "<name>:<ip>" datagram and then receive the ROS timestamp (one packed
+    double) every sync_interval seconds for sync_duration seconds, followed
+    by "Stop Sync". A single ticker with absolute deadlines serves all
+    syncing devices, so the timing does not drift or depend on the number
+    of devices. Registrations of a device that is still syncing are
+    ignored, a registration after its sync restarts the sync.
+
+    In the "probe" sync mode the devices get round-trip probes instead of
+    the timestamps (see clock_sync.py). Every answered probe gives an offset
+    and round trip time, at the end of the sync the device offset, drift
+    and uncertainty are appended to the sync report for the analysis.
+
+    Args:
+        host, port: UDP address for device registrations
+        device_port: UDP port of the devices for timestamps and commands
+        sync_duration: seconds of timestamps per device
+        sync_interval: seconds between timestamps
+        broadcast_addr: (ip, port) to broadcast the timestamps to once per
+                        tick instead of sending to every device
+        logger_addr: UDP address of the ViconLogger listener
+        sensor_port: UDP port of the SensorCollector
+        sync_mode: "timestamp" (timestamps to every device, or to
+                   broadcast_addr if given) or "probe" (round trips)
+        report_file: sync report of the probe mode
+        clock: ClockSource giving the timestamps, see clock_source.py.
+               The source-to-send latency of every timestamp packet is
+               recorded in self.latency.
+    """
+
+    def __init__(self, host='0.0.0.0', port=6666, device_port=8888, sync_duration=8.0, sync_interval=0.1,
+                 broadcast_addr=None, logger_addr=('0.0.0.0', 10000), sensor_port=11111, clock=None,
+                 sync_mode='timestamp', report_file=SYNC_REPORT_FILE):
+        self.host = host
+        self.port = port
+        self.device_port = device_port
+        self.sync_duration = sync_duration
+        self.sync_interval = sync_interval
+        self.broadcast_addr = broadcast_addr
+        self.logger_addr = logger_addr
+        self.sensor_port = sensor_port
+        self.clock = clock if clock is not None else make_clock('ros')
+        self.latency = LatencyHistogram()
+        if sync_mode not in ('timestamp', 'probe'):
+            raise ValueError(f"Unknown sync mode {sync_mode}, use timestamp or probe")
+        self.sync_mode = sync_mode
+        self.report_file = report_file
+
+        self.devices = {}
+        self.transport = None
+        self.ticker_task = None
+        self.tasks = []
+        self.stop_event = None
+        # Lateness of the timestamp ticks in seconds, for the status
+        self.tick_count = 0
+        self.tick_lateness_max = 0.0
+        self.tick_lateness_sum = 0.0
+
+    def now(self):
+        return self.clock.now()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        await loop.create_datagram_endpoint(lambda: SyncServerProtocol(self), local_addr=(self.host, self.port),
+                                            allow_broadcast=self.broadcast_addr is not None)
+        self.clock.start()
+        print(f"ROS Sync server listening on {self.host}:{self.port}")
+
+    def handle_registration(self, data, addr):
+        try:
+            device_name, device_ip = data.decode().strip().split(':')
+        except ValueError:
+            print(f"Invalid message format from {addr}: {data}")
+            return
+
+        session = self.devices.get(device_name)
+        if session is not None and session.status == SYNCING and session.ip == device_ip:
+            # Devices repeat the registration until the first timestamp arrives
+            session.registrations += 1
+            return
+        if session is not None:
+            print(f"Device {device_name} connected before, retry to sync")
+            session.registrations += 1
+            session.ip, session.addr = device_ip, (device_ip, self.device_port)
+        else:
+            session = DeviceSession(device_name, device_ip, self.device_port)
+            self.devices[device_name] = session
+        session.restart_sync(asyncio.get_running_loop().time() + self.sync_duration)
+        print(f"Started sync for {device_name} at {device_ip}")
+
+        if self.ticker_task is None or self.ticker_task.done():
+            self.ticker_task = asyncio.ensure_future(self.sync_ticker())
+
+    async def sync_ticker(self):
+        """Send the timestamp to all syncing devices every sync_interval"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
         while True:
-            line = process.stdout.readline()
-            if not line:
+            syncing = [session for session in self.devices.values() if session.status == SYNCING]
+            if not syncing:
                 break
-            
-            try:
-                new_ts = float(line.strip())
-                with timestamp_lock:
-                    current_timestamp = new_ts
-                #print(f"Updated timestamp to: {new_ts}")
-                
-            except ValueError:
-                print(f"Invalid timestamp received: {line}")
-                
-    except KeyboardInterrupt:
-        pass
-    finally:
-        process.terminate()
-        process.wait()
-
-# def timestamp_updater():
-#     global current_timestamp
-
-#     while True:
-#         try:
-#             current_timestamp = time.time()
-#             time.sleep(0.01)
-#         except Exception as e:
-#             print(f"Error updating timestamp: {e}")
-
-def handle_device(device_name, addr, sock):
-    """Handle device synchronization with ROS-based timestamps"""
-    start_time = time.time()
-    duration = 8
-    end_time = start_time + duration
-    interval = 0.1  # 100ms
+            timestamp, received = self.clock.latest()
+            data = struct.pack('d', timestamp)
+            if self.broadcast_addr is not None and self.sync_mode == 'timestamp':
+                self.transport.sendto(data, self.broadcast_addr)
+            now = loop.time()
+            for session in syncing:
+                if now >= session.sync_end:
+                    self.transport.sendto(b"Stop Sync", session.addr)
+                    session.status = SYNCED
+                    print(f"Sent stop command to {session.name} at {session.addr}")
+                    if self.sync_mode == 'probe':
+                        self.finish_probe_sync(session)
+                    continue
+                if self.sync_mode == 'probe':
+                    self.send_probe(session)
+                elif self.broadcast_addr is None:
+                    self.transport.sendto(data, session.addr)
+                session.packets_sent += 1
+            self.latency.record(time.monotonic() - received)
 
-    try:
-        while time.time() < end_time:
-            with timestamp_lock:
-                ts = current_timestamp
-            
-            data = struct.pack('d', ts)
-            sock.sendto(data, addr)
-            time.sleep(interval)
-
-        sock.sendto(b"Stop Sync", addr)
-        print(f"Sent stop command to {device_name} at {addr}")
-
-        with devices_lock:
-            devices[device_name]['status'] = 'synced'
-
-        with devices_lock:
-            all_synced = all(device['status'] == 'synced' for device in devices.values())
-
-        if all_synced:
-            with timestamp_lock:
-                final_ts = current_timestamp
-            with open('sync_completion.txt', 'w') as f:
-                f.write(str(final_ts))
-            print(f"All devices synced at ROS time: {final_ts}")
-
-    except Exception as e:
-        print(f"Error handling {device_name}: {e}")
-
-def command_listener(sock):
-    """Handle console input for collection control"""
-    print("\nEnter commands:")
-    print("  'begin' - Start collection for all synced devices")
-    print("  'end'   - Stop collection for all devices")
-    print("  'exit'   - Shutdown server\n")
-    
-    while True:
-        try:
-            cmd = input("> ").strip().lower()
-            
-            if cmd == "begin":
-                with devices_lock:
-                    # Check synchronization status
-                    all_synced = all(device['status'] == 'synced' for device in devices.values())
-                    if not all_synced:
-                        print("Error: Not all devices are synced!")
-                        continue
-                    
-                    names = list(devices.keys())
-                    print("names: ", names)
-                    device_names = copy.deepcopy(names)
-                    
-                    if 'SensorCollector' in device_names:
-                        device_names.remove('SensorCollector')
-                    print("device_names: ", device_names)
-                    msg = f"Start Collection: {device_names}"
-                    sock.sendto(msg.encode('utf-8'), ("0.0.0.0", 10000))
-                    msg = f"Start Collection"
-                    if 'SensorCollector' in names:
-                        sock.sendto(msg.encode('utf-8'), (devices['SensorCollector']['addr'][0], 11111))
-
-                    
-                    # Record start timestamp
-                    with timestamp_lock:
-                        start_ts = current_timestamp
-                    with open('collection_start.txt', 'w') as f:
-                        f.write(str(start_ts))
-                    print(f"Collection started at {start_ts}")
-
-            elif cmd == "end":
-                with devices_lock:
-                    # Send stop command to all devices
-                    for name, info in devices.items():
-                        sock.sendto(b"Stop Collection", info['addr'])
-                        print(f"Sent stop command to {name}")
-                    
-                    msg = f"End Collection"
-                    sock.sendto(msg.encode('utf-8'), ("0.0.0.0", 10000))
-                    if 'SensorCollector' in names:
-                        msg = f"End Collection"
-                        sock.sendto(msg.encode('utf-8'), (devices['SensorCollector']['addr'][0], 11111))
-
-                    # Record end timestamp
-                    with timestamp_lock:
-                        end_ts = current_timestamp
-                    with open('collection_end.txt', 'w') as f:
-                        f.write(str(end_ts))
-                    print(f"Collection stopped at {end_ts}")
-
-            elif cmd == "exit":
-                print("Shutting down server...")
-                sys.exit(0)
-
-            else:
-                print("Unknown command. Valid commands: begin, end, exit")
-
-        except Exception as e:
-            print(f"Command processing error: {e}")
+            if any(session.status == SYNCED for session in syncing) and self.all_synced():
+                final_ts = self.now()
+                with open('sync_completion.txt', 'w') as f:
+                    f.write(str(final_ts))
+                print(f"All devices synced at ROS time: {final_ts}")
 
-def main():
-    host = '0.0.0.0'
-    port = 6666
+            # Absolute deadlines: a late tick does not shift the later ones
+            next_tick += self.sync_interval
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            lateness = loop.time() - next_tick
+            self.tick_count += 1
+            self.tick_lateness_sum += lateness
+            self.tick_lateness_max = max(self.tick_lateness_max, lateness)
+
+    def send_probe(self, session):
+        seq = session.packets_sent
+        t1 = self.clock.extrapolated()
+        session.pending[seq] = t1
+        self.transport.sendto(PROBE_REQUEST.pack(REQUEST_MAGIC, seq, t1), session.addr)
+
+    def handle_probe_reply(self, data, addr):
+        t4 = self.clock.extrapolated()
+        if len(data) != PROBE_REPLY.size:
+            print(f"Invalid probe reply from {addr}")
+            return
+        _, seq, t1, t2, t3 = PROBE_REPLY.unpack(data)
+        for session in self.devices.values():
+            if session.ip == addr[0] and session.pending.get(seq) == t1:
+                del session.pending[seq]
+                session.probes.append((t1, t2, t3, t4))
+                return
+
+    def finish_probe_sync(self, session):
+        result = estimate_clock_offset(session.probes)
+        if result is None:
+            print(f"No probe replies from {session.name}, no sync report entry")
+            return
+        session.sync_result = append_sync_report(session.name, result, self.report_file,
+                                                 probes_sent=session.packets_sent)
+        print(f"{session.name}: offset {result['offset']:.6f} s, drift {1e6 * result['drift']:.1f} ppm, "
+              f"uncertainty {1000 * result['uncertainty']:.2f} ms, min rtt {1000 * result['min_rtt']:.2f} ms "
+              f"({result['probes_used']}/{result['probes_received']} probes)")
 
-    # Start ROS timestamp updater
-    ros_thread = threading.Thread(target=timestamp_updater, daemon=True)
-    ros_thread.start()
+    def all_synced(self):
+        return all(session.status == SYNCED for session in self.devices.values())
 
-    # Create UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((host, port))
+    def send(self, message, addr):
+        self.transport.sendto(message.encode('utf-8'), addr)
 
-    # Start command listener in main thread
-    command_thread = threading.Thread(
-        target=command_listener,
-        args=(sock,),
-        daemon=True
-    )
-    command_thread.start()
+    def begin(self):
+        # Start collection for all synced devices
+        if not self.devices or not self.all_synced():
+            return False, "Error: Not all devices are synced!"
+        names = list(self.devices.keys())
+        device_names = [name for name in names if name != 'SensorCollector']
+        self.send(f"Start Collection: {device_names}", self.logger_addr)
+        if 'SensorCollector' in names:
+            self.send("Start Collection", (self.devices['SensorCollector'].ip, self.sensor_port))
+        for session in self.devices.values():
+            session.status = COLLECTING
 
-    print(f"ROS Sync server listening on {host}:{port}")
+        # Record start timestamp
+        start_ts = self.now()
+        with open('collection_start.txt', 'w') as f:
+            f.write(str(start_ts))
+        return True, f"Collection started at {start_ts}"
 
-    while True:
+    def end(self):
+        # Stop collection for all devices
+        for name, session in self.devices.items():
+            self.transport.sendto(b"Stop Collection", session.addr)
+            print(f"Sent stop command to {name}")
+        self.send("End Collection", self.logger_addr)
+        if 'SensorCollector' in self.devices:
+            self.send("End Collection", (self.devices['SensorCollector'].ip, self.sensor_port))
+        for session in self.devices.values():
+            if session.status == COLLECTING:
+                session.status = SYNCED
+
+        # Record end timestamp
+        end_ts = self.now()
+        with open('collection_end.txt', 'w') as f:
+            f.write(str(end_ts))
+        return True, f"Collection stopped at {end_ts}"
+
+    def status(self):
+        return {
+            'timestamp': self.now(),
+            'devices': {name: session.as_dict() for name, session in self.devices.items()},
+            'ticks': self.tick_count,
+            'tick_lateness_mean': self.tick_lateness_sum / self.tick_count if self.tick_count else 0.0,
+            'tick_lateness_max': self.tick_lateness_max,
+            'clock': self.clock.name,
+            'clock_latency': self.latency.summary(),
+        }
+
+    def execute(self, command):
+        """Run a control command, returns a json-serializable result dict.
+
+        Commands: begin, end, status, forget <device>, exit
+        """
+        parts = command.strip().split()
+        cmd = parts[0].lower() if parts else ''
+        if cmd == 'begin':
+            ok, message = self.begin()
+        elif cmd == 'end':
+            ok, message = self.end()
+        elif cmd == 'status':
+            return dict(self.status(), ok=True, message='')
+        elif cmd == 'forget' and len(parts) == 2:
+            ok = self.devices.pop(parts[1], None) is not None
+            message = f"Removed {parts[1]}" if ok else f"Unknown device {parts[1]}"
+        elif cmd == 'exit':
+            ok, message = True, "Shutting down server..."
+            self.stop_event.set()
+        else:
+            ok, message = False, "Unknown command. Valid commands: begin, end, status, forget <device>, exit"
+        print(message)
+        return {'ok': ok, 'message': message}
+
+    async def handle_control(self, reader, writer):
+        # One command per line, one json result per line
         try:
-            data, addr = sock.recvfrom(1024)
-            decoded = data.decode().strip()
-            device_name, device_ip = decoded.split(':')
-            
-            with devices_lock:
-                if device_name in devices:
-                    print(f"Device {device_name} connected before, retry to sync")
-                    # continue 
-
-                devices[device_name] = {
-                    'status': 'syncing',
-                    'ip': device_ip,
-                    'addr': (device_ip,8888)
-                }
-
-            threading.Thread(
-                target=handle_device,
-                args=(device_name, (device_ip,8888), sock)
-            ).start()
-            print(f"Started sync for {device_name} at {device_ip}")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write((json.dumps(self.execute(line.decode())) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
 
-        except ValueError:
-            print(f"Invalid message format from {addr}: {data}")
-        except Exception as e:
-            print(f"Error receiving data: {e}")
+    async def console(self):
+        """Handle console input for collection control"""
+        print("\nEnter commands:")
+        print("  'begin'  - Start collection for all synced devices")
+        print("  'end'    - Stop collection for all devices")
+        print("  'status' - Show the device sessions")
+        print("  'exit'   - Shutdown server\n")
+        # stdin is watched by the event loop, no thread is left blocked in input() on exit
+        loop = asyncio.get_running_loop()
+        fd = sys.stdin.fileno()
+        lines = asyncio.Queue()
+        buffer = bytearray()
+
+        def read_stdin():
+            data = os.read(fd, 4096)
+            if not data:
+                loop.remove_reader(fd)
+                if buffer:
+                    lines.put_nowait(buffer.decode(errors='replace'))
+                lines.put_nowait(None)
+                return
+            buffer.extend(data)
+            while b'\n' in buffer:
+                line, _, rest = bytes(buffer).partition(b'\n')
+                buffer[:] = rest
+                lines.put_nowait(line.decode(errors='replace'))
+
+        try:
+            loop.add_reader(fd, read_stdin)
+        except (NotImplementedError, PermissionError):
+            # Windows event loop or a regular file on stdin
+            print("Console input not available, use --command")
+            return
+        try:
+            while True:
+                print("> ", end="", flush=True)
+                command = await lines.get()
+                if command is None:
+                    break
+                if command.strip():
+                    self.execute(command)
+        finally:
+            loop.remove_reader(fd)
+
+    async def serve(self, control_port=None, console=True):
+        await self.start()
+        if control_port is not None:
+            control_server = await asyncio.start_server(self.handle_control, '127.0.0.1', control_port)
+            self.tasks.append(asyncio.ensure_future(control_server.serve_forever()))
+            print(f"Control commands on 127.0.0.1:{control_port}")
+        if console:
+            self.tasks.append(asyncio.ensure_future(self.console()))
+        await self.stop_event.wait()
+        await self.close()
+
+    async def close(self):
+        for task in self.tasks + [self.ticker_task]:
+            if task is not None:
+                task.cancel()
+        self.clock.stop()
+        if self.transport is not None:
+            self.transport.close()
+
+
+def send_command(command, host='127.0.0.1', port=6667, timeout=5.0):
+    """Send a control command to a running server, returns its result dict"""
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall((command + '\n').encode())
+        response = sock.makefile('r').readline()
+    return json.loads(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ROS time sync and collection control server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6666, help="UDP port for device registrations")
+    parser.add_argument('--device-port', type=int, default=8888, help="UDP port of the devices")
+    parser.add_argument('--sync-duration', type=float, default=8.0, help="Seconds of timestamps per device")
+    parser.add_argument('--sync-interval', type=float, default=0.1, help="Seconds between timestamps")
+    parser.add_argument('--broadcast', default=None, help="Broadcast ip for the timestamps, e.g. 10.197.255.255")
+    parser.add_argument('--sync-mode', default='timestamp', choices=['timestamp', 'probe'],
+                        help="Send timestamps (to every device, or to --broadcast), or round-trip probes "
+                             "that estimate the device clock offsets")
+    parser.add_argument('--report', default=SYNC_REPORT_FILE, help="Sync report of the probe mode")
+    parser.add_argument('--clock', default='ros', choices=['ros', 'shm', 'subprocess', 'simulated', 'system'],
+                        help="Timestamp source: in-process rospy subscription, shared memory ring of "
+                             "'listener_time.py --shm', stdout of listener_time.py, simulated or wall clock")
+    parser.add_argument('--topic', default="/vicon/wand/wand", help="Vicon topic of the ros clock")
+    parser.add_argument('--control-port', type=int, default=6667, help="TCP port for control commands")
+    parser.add_argument('--no-console', action='store_true', help="Do not read commands from stdin")
+    parser.add_argument('--command', default=None, help="Send a command to a running server and exit")
+    args = parser.parse_args()
+
+    if args.command is not None:
+        print(json.dumps(send_command(args.command, port=args.control_port), indent=2))
+        return
+
+    broadcast_addr = (args.broadcast, args.device_port) if args.broadcast else None
+    server = SyncServer(args.host, args.port, args.device_port, args.sync_duration, args.sync_interval,
+                        broadcast_addr=broadcast_addr, clock=make_clock(args.clock, topic=args.topic),
+                        sync_mode=args.sync_mode, report_file=args.report)
+    try:
+        asyncio.run(server.serve(control_port=args.control_port, console=not args.no_console))
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
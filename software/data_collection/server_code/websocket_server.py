@@ -1,62 +1,334 @@
 import asyncio
 import websockets
 import os
+import re
+import json
+import time
+import struct
+import hashlib
 from datetime import datetime
 
 UPLOAD_DIR = "device_trajectory_logs"
+PARTIAL_DIR = ".partial"
 
-async def handle_client(websocket):
-    file_data = bytearray()
-    try:
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        
-        # Generate filename upfront
-        timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-        filename = f"AppleVisionPro_{timestamp}.csv"
-        filepath = os.path.join(UPLOAD_DIR, filename)
-        
-        # Receive chunks until connection closes
+# Upload protocol, one websocket connection per attempt:
+#   client: {"type": "hello", "device": "AppleVisionPro", "upload_id": "<id>"}
+#   server: {"type": "ready", "offset": <bytes already received>, "seq": <next chunk seq>}
+#   client: binary chunks, CHUNK_HEADER (seq, offset) followed by the data
+#   server: {"type": "ack", "seq": ..., "offset": ...} for every chunk
+#   client: {"type": "end", "size": <total bytes>, "sha256": "<hex>"}
+#   server: {"type": "done", "file": ..., "size": ..., "sha256": ...} or {"type": "error", ...}
+# The chunks go to a partial file as they arrive. After a disconnect the
+# client reconnects with the same upload_id and continues at the returned
+# offset. The finished file is renamed to <device>_<timestamp>.csv, with a
+# _1, _2, ... suffix if that name is taken (uploads of the same second).
+# The partial file is only open while a client sends; uploads without a
+# connection for expire_after seconds are given up and their files removed.
+# Clients without the hello message (binary data, then "EOF") are still
+# accepted as AppleVisionPro uploads.
+CHUNK_HEADER = struct.Struct("<IQ")
+
+
+def safe_name(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)[:128] or "unknown"
+
+
+class UploadState:
+    """Partial upload on disk with its running checksum."""
+
+    def __init__(self, upload_dir, device, upload_id):
+        self.device = device
+        self.upload_id = upload_id
+        partial_dir = os.path.join(upload_dir, PARTIAL_DIR)
+        os.makedirs(partial_dir, exist_ok=True)
+        base = os.path.join(partial_dir, f"{device}_{upload_id}")
+        self.part_path = base + ".part"
+        self.meta_path = base + ".json"
+        self.lock = asyncio.Lock()
+        self.file = None
+        self.sha256 = None
+        self.filename = None
+        self.seq = 0
+        self.size = 0
+        self.last_active = time.monotonic()
+
+    def open(self):
+        """Open the partial file for appending, runs in a worker thread.
+
+        The first open of an upload reads its meta file and rebuilds the
+        checksum from the partial file (resume after a server restart), or
+        starts a new partial file.
+        """
+        if self.sha256 is None:
+            sha256 = hashlib.sha256()
+            if os.path.exists(self.meta_path) and os.path.exists(self.part_path):
+                with open(self.meta_path, "r") as f:
+                    meta = json.load(f)
+                self.filename = meta["filename"]
+                self.seq = meta["seq"]
+                with open(self.part_path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        sha256.update(block)
+            else:
+                timestamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+                self.filename = f"{self.device}_{timestamp}.csv"
+                open(self.part_path, "wb").close()
+            self.sha256 = sha256
+        self.file = open(self.part_path, "ab")
+        self.size = self.file.tell()
+        self.write_meta()
+
+    def write_meta(self):
+        with open(self.meta_path, "w") as f:
+            json.dump({"device": self.device, "upload_id": self.upload_id, "filename": self.filename,
+                       "seq": self.seq, "size": self.size}, f)
+
+    def append(self, data):
+        # Runs in a worker thread, the event loop keeps serving the others
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        self.seq += 1
+
+    def checkpoint(self):
+        self.file.flush()
+        self.write_meta()
+
+    def finish(self, upload_dir):
+        """fsync and rename the partial file, returns the final path"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        filepath = os.path.join(upload_dir, reserve_filename(upload_dir, self.filename))
+        os.replace(self.part_path, filepath)
+        os.remove(self.meta_path)
+        return filepath
+
+    def close(self):
+        if self.file is not None and not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+    def discard(self):
+        # Close and remove the partial and meta files
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def reserve_filename(upload_dir, filename):
+    # First free name of filename, filename_1, ..., created exclusively so
+    # that two uploads of the same second never replace each other
+    stem, ext = os.path.splitext(filename)
+    idx = 0
+    while True:
+        candidate = filename if idx == 0 else f"{stem}_{idx}{ext}"
+        try:
+            open(os.path.join(upload_dir, candidate), "x").close()
+            return candidate
+        except FileExistsError:
+            idx += 1
+
+
+def remove_stale_partials(partial_dir, max_age, keep=()):
+    """Remove the partial uploads not modified for max_age seconds, runs in a worker thread.
+
+    Args:
+        keep: part and meta paths of the uploads known to the server
+    Returns:
+        removed (int): number of removed files
+    """
+    removed = 0
+    now = time.time()
+    for entry in os.scandir(partial_dir):
+        if entry.path in keep or not entry.name.endswith((".part", ".json")):
+            continue
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class UploadServer:
+    """Streaming upload ingestion for the device trajectory logs.
+
+    Args:
+        upload_dir: folder of the finished uploads
+        max_uploads: uploads receiving at the same time, the others wait
+                     before their "ready" message
+        checkpoint_interval: chunks between flushes of the partial file
+        expire_after: seconds without a connection before an unfinished
+                      upload is given up and its partial file removed
+    """
+
+    def __init__(self, upload_dir=UPLOAD_DIR, max_uploads=4, checkpoint_interval=16, expire_after=24 * 3600):
+        self.upload_dir = upload_dir
+        self.slots = asyncio.Semaphore(max_uploads)
+        self.checkpoint_interval = checkpoint_interval
+        self.expire_after = expire_after
+        # (device, upload_id) -> UploadState of the unfinished uploads
+        self.uploads = {}
+        os.makedirs(os.path.join(self.upload_dir, PARTIAL_DIR), exist_ok=True)
+
+    def get_upload(self, device, upload_id):
+        # No disk access here, the upload is opened under its lock
+        key = (device, upload_id)
+        if key not in self.uploads:
+            self.uploads[key] = UploadState(self.upload_dir, device, upload_id)
+        return self.uploads[key]
+
+    async def expire_uploads(self):
+        # Give up the uploads without a connection for expire_after seconds,
+        # also those left on disk by an earlier server run
+        now = time.monotonic()
+        for key, state in list(self.uploads.items()):
+            if not state.lock.locked() and now - state.last_active > self.expire_after:
+                del self.uploads[key]
+                await asyncio.to_thread(state.discard)
+                print(f"{state.device} upload {state.upload_id}: expired")
+        keep = {path for state in self.uploads.values() for path in (state.part_path, state.meta_path)}
+        await asyncio.to_thread(remove_stale_partials, os.path.join(self.upload_dir, PARTIAL_DIR),
+                                self.expire_after, keep)
+
+    async def handle_client(self, websocket):
+        try:
+            await self.expire_uploads()
+            first = await websocket.recv()
+            hello = None
+            if isinstance(first, str) and first.startswith("{"):
+                hello = json.loads(first)
+            async with self.slots:
+                if hello is not None and hello.get("type") == "hello":
+                    await self.receive_upload(websocket, hello)
+                else:
+                    await self.receive_legacy(websocket, first)
+        except websockets.ConnectionClosed:
+            print("Connection closed, partial upload kept for resume")
+        except Exception as e:
+            print(f"Error handling client: {e}")
+            try:
+                await websocket.send(json.dumps({"type": "error", "message": str(e)}))
+            except websockets.ConnectionClosed:
+                pass
+        finally:
+            # Properly close connection with status code 1000 (Normal Closure)
+            await websocket.close(code=1000)
+
+    async def receive_upload(self, websocket, hello):
+        device = safe_name(hello.get("device", "unknown"))
+        upload_id = safe_name(str(hello.get("upload_id", datetime.now().strftime("%Y_%m_%d_%H_%M_%S"))))
+        state = self.get_upload(device, upload_id)
+        if state.lock.locked():
+            await websocket.send(json.dumps({"type": "error", "message": "Upload is active on another connection"}))
+            return
+        async with state.lock:
+            try:
+                # Resuming after a server restart reads the whole partial file
+                await asyncio.to_thread(state.open)
+                await self.receive_chunks(websocket, state)
+            finally:
+                # The handle is only kept while the client sends
+                state.last_active = time.monotonic()
+                await asyncio.to_thread(state.close)
+
+    async def receive_chunks(self, websocket, state):
+        await websocket.send(json.dumps({"type": "ready", "offset": state.size, "seq": state.seq}))
+        print(f"{state.device} upload {state.upload_id}: receiving from offset {state.size}")
+        # One message at a time: a slow disk stops the reads, which stops the client
         async for message in websocket:
             if isinstance(message, bytes):
-                file_data.extend(message)
+                seq, offset = CHUNK_HEADER.unpack_from(message)
+                if offset + len(message) - CHUNK_HEADER.size <= state.size:
+                    # Resent chunk that was written before the disconnect
+                    await websocket.send(json.dumps({"type": "ack", "seq": seq, "offset": state.size}))
+                    continue
+                if offset != state.size:
+                    await websocket.send(json.dumps({"type": "error", "message": "Gap in upload",
+                                                     "offset": state.size, "seq": state.seq}))
+                    return
+                await asyncio.to_thread(state.append, memoryview(message)[CHUNK_HEADER.size:])
+                if state.seq % self.checkpoint_interval == 0:
+                    await asyncio.to_thread(state.checkpoint)
+                await websocket.send(json.dumps({"type": "ack", "seq": seq, "offset": state.size}))
+                continue
+
+            end = json.loads(message)
+            if end.get("type") != "end":
+                continue
+            checksum = state.sha256.hexdigest()
+            if end.get("size", state.size) != state.size or end.get("sha256", checksum) != checksum:
+                await websocket.send(json.dumps({"type": "error", "message": "Size or checksum mismatch",
+                                                 "size": state.size, "sha256": checksum}))
+                # The partial file is useless, start over on the next attempt
+                await asyncio.to_thread(state.discard)
+                del self.uploads[(state.device, state.upload_id)]
+                return
+            filepath = await asyncio.to_thread(state.finish, self.upload_dir)
+            del self.uploads[(state.device, state.upload_id)]
+            print(f"Saved {state.size} bytes to {filepath}")
+            await websocket.send(json.dumps({"type": "done", "file": os.path.basename(filepath),
+                                             "size": state.size, "sha256": checksum}))
+            return
+
+    async def receive_legacy(self, websocket, first):
+        # Data chunks then "EOF", no resume
+        state = UploadState(self.upload_dir, "AppleVisionPro", datetime.now().strftime("%Y_%m_%d_%H_%M_%S_%f"))
+        await asyncio.to_thread(state.open)
+        message = first
+        while message != "EOF":
+            if isinstance(message, bytes):
+                await asyncio.to_thread(state.append, message)
                 print(f"Received chunk: {len(message)} bytes")
-            elif message == "EOF":
-                break  # Client signals end of transmission
-        
-        # Save file after receiving all chunks
-        if file_data:
-            with open(filepath, "wb") as f:
-                f.write(file_data)
-            print(f"Saved {len(file_data)} bytes to {filename}")
-            
+            try:
+                message = await websocket.recv()
+            except websockets.ConnectionClosed:
+                break
+        if state.size > 0:
+            filepath = await asyncio.to_thread(state.finish, self.upload_dir)
+            print(f"Saved {state.size} bytes to {os.path.basename(filepath)}")
+        else:
+            await asyncio.to_thread(state.discard)
         # Acknowledge successful reception
         await websocket.send("File received successfully")
-        
-    except Exception as e:
-        print(f"Error handling client: {e}")
-        await websocket.send(f"Error: {str(e)}")
-    finally:
-        # Properly close connection with status code 1000 (Normal Closure)
-        await websocket.close(code=1000)
-
-async def main(host, port):
-    # Increased max_size to 100MB and added ping settings
+
+    def close(self):
+        for state in self.uploads.values():
+            state.close()
+
+
+async def main(host, port, upload_dir=UPLOAD_DIR, max_uploads=4, max_chunk=4 * 1024 * 1024):
+    server = UploadServer(upload_dir, max_uploads)
+    # Small messages and queue: memory per upload stays at a few chunks
     async with websockets.serve(
-        handle_client,
+        server.handle_client,
         host,
         port,
-        max_size=100 * 1024 * 1024,  # 100MB
+        max_size=max_chunk + CHUNK_HEADER.size,
+        max_queue=4,
         ping_interval=20,
         ping_timeout=20
     ):
         print(f"Server started at ws://{host}:{port}")
-        await asyncio.Future()  # Run forever
+        try:
+            await asyncio.Future()  # Run forever
+        finally:
+            server.close()
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="192.168.0.108", help="Host address")
     parser.add_argument("--port", type=int, default=8765, help="Port number")
+    parser.add_argument("--upload-dir", default=UPLOAD_DIR, help="Folder of the received files")
+    parser.add_argument("--max-uploads", type=int, default=4, help="Uploads receiving at the same time")
+    parser.add_argument("--max-chunk", type=int, default=4 * 1024 * 1024, help="Largest chunk in bytes")
     args = parser.parse_args()
-    
-    asyncio.run(main(args.host, args.port))
+
+    asyncio.run(main(args.host, args.port, args.upload_dir, args.max_uploads, args.max_chunk))